@@ -0,0 +1,57 @@
+"""
+Compares parsing with every address padded to the model seq_length against dynamic length parsing, where addresses
+are sorted by length and each batch is trimmed to its longest address, with and without packed sequences to skip the
+remaining padding.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from address_parser.bench.synthetic import synthetic_addresses
+from address_parser.rnn.checkpoint import load_model
+from address_parser.rnn.util import parse_raw_addresses
+
+BATCH_SIZES = [64, 512]
+NUM_ADDRESSES = 4096
+
+
+MODES = {
+    "padded": dict(dynamic_length=False),
+    "trimmed": dict(dynamic_length=True, packed=False),
+    "packed": dict(dynamic_length=True, packed=True),
+}
+
+
+def _time_parse(addresses, model, batch_size, mode):
+    start = time.perf_counter()
+    parsed = parse_raw_addresses(addresses, model, batch_size=batch_size, **MODES[mode])
+    return time.perf_counter() - start, parsed
+
+
+def main(model_path, num_addresses, seed):
+    model = load_model(model_path, backend="eager")
+    addresses = synthetic_addresses(num_addresses, seed=seed)
+    lengths = np.array([len(a) for a in addresses])
+    print(f"{num_addresses} synthetic addresses, model seq_length {model.seq_length}, "
+          f"address length p5/p50/p95 {np.percentile(lengths, [5, 50, 95]).tolist()}")
+    # Warm up
+    parse_raw_addresses(addresses[:256], model)
+    for batch_size in BATCH_SIZES:
+        padded_time, padded = _time_parse(addresses, model, batch_size, "padded")
+        print(f"batch size {batch_size}: padded {num_addresses / padded_time:.0f} addresses/sec")
+        for mode in ["trimmed", "packed"]:
+            mode_time, parsed = _time_parse(addresses, model, batch_size, mode)
+            agreement = np.mean([p == d for p, d in zip(padded, parsed)])
+            print(f"batch size {batch_size}: {mode} {num_addresses / mode_time:.0f} addresses/sec, "
+                  f"speedup {padded_time / mode_time:.2f}x, {agreement * 100:.1f}% of addresses parsed identically "
+                  f"to padded")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', default="pretrained/address_char_rnn.pt", help="Path to trained model")
+    parser.add_argument('--num-addresses', type=int, default=NUM_ADDRESSES, help="Number of synthetic addresses")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for generating synthetic addresses")
+    args = parser.parse_args()
+    main(args.model_path, args.num_addresses, args.seed)
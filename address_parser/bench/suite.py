@@ -0,0 +1,256 @@
+"""
+Benchmark suite for each stage of parsing, run on synthetic addresses so it can be run anywhere:
+    encode: encode_addresses on raw address strings
+    forward: predict on batches of encoded addresses
+    decode: components_from_pred on the model predictions
+    e2e: parse_raw_addresses on raw address strings
+
+Every stage is run at each batch size and torch thread count, recording the throughput in addresses per second, the
+p50 and p99 latency per batch and the peak memory allocated while running it, keeping the best of REPEATS runs. The
+whole suite can be run several times with --runs, keeping the median of each measurement across the runs. Results
+are saved as JSON and can be compared against a baseline saved from an earlier run, exiting with an error if any
+measurement has regressed by more than the tolerance of its metric, so it can be run in CI.
+
+Peak memory is measured with tracemalloc in a separate pass, as tracing slows everything down. tracemalloc sees
+allocations by python and numpy but not those made by torch's own allocator, so it understates the memory used by the
+forward stage.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from address_parser.bench.synthetic import synthetic_addresses
+from address_parser.paf.util import encode_addresses
+from address_parser.rnn.util import components_from_pred, parse_raw_addresses, predict
+
+STAGES = ["encode", "forward", "decode", "e2e"]
+BATCH_SIZES = [1, 32, 256, 1024]
+# Each measurement runs at least this many batches and this many addresses
+MIN_BATCHES = 10
+MIN_ADDRESSES = 1024
+# Each measurement is repeated and the best of the repeats kept, which is far less sensitive to noise from anything
+# else running on the machine than a single run
+REPEATS = 3
+# Number of batches run again with tracemalloc to measure peak memory
+MEMORY_BATCHES = 3
+# Distinct synthetic addresses, batches cycle through them
+NUM_ADDRESSES = 4096
+# Fractional change in a measurement, in the bad direction, that counts as a regression. Set well above the spread
+# between single runs and the median of 7 runs on a shared single core machine: up to 15% for throughput and p50
+# latency, but up to double for p99 latency, which only a few slow batches decide. Peak memory barely varies.
+TOLERANCES = {"throughput": 0.35, "p50_ms": 0.35, "p99_ms": 1.0, "peak_memory_mb": 0.25}
+# Number of runs of the whole suite whose median is kept, baselines should be recorded with several
+RUNS = 1
+# Direction of improvement of each metric
+METRICS = {"throughput": "higher", "p50_ms": "lower", "p99_ms": "lower", "peak_memory_mb": "lower"}
+# Changes smaller than these are ignored, as they're within the noise of the timer and the allocator
+MIN_LATENCY_CHANGE_MS = 0.1
+MIN_MEMORY_CHANGE_MB = 1.0
+
+
+def default_thread_counts():
+    return sorted({1, os.cpu_count() or 1})
+
+
+def _batches(addresses, batch_size):
+    num_batches = max(MIN_BATCHES, math.ceil(MIN_ADDRESSES / batch_size))
+    it = itertools.cycle(addresses)
+    return [list(itertools.islice(it, batch_size)) for _ in range(num_batches)]
+
+
+def _stage_inputs(stage, batches, model):
+    """
+    Prepares the input of the stage for each batch ahead of time, so only the stage itself is measured
+    """
+    import torch
+    if stage in ("encode", "e2e"):
+        return batches
+    encoded = [encode_addresses(batch, model.seq_length) for batch in batches]
+    if stage == "forward":
+        return [torch.from_numpy(e.encoded) for e in encoded]
+    with torch.inference_mode():
+        return [(predict(torch.from_numpy(e.encoded), model).numpy(), e.text, e.offsets) for e in encoded]
+
+
+def _stage_fn(stage, model):
+    if stage == "encode":
+        return lambda batch: encode_addresses(batch, model.seq_length)
+    if stage == "forward":
+        return lambda batch: predict(batch, model)
+    if stage == "decode":
+        return lambda inputs: components_from_pred(*inputs)
+    return lambda batch: parse_raw_addresses(batch, model, batch_size=len(batch))
+
+
+def run_stage(stage, model, addresses, batch_size, threads):
+    """
+    Returns the measurements of a stage at a batch size and thread count
+    """
+    import torch
+    torch.set_num_threads(threads)
+    batches = _batches(addresses, batch_size)
+    inputs = _stage_inputs(stage, batches, model)
+    fn = _stage_fn(stage, model)
+    repeats = []
+    with torch.inference_mode():
+        # Warm up
+        fn(inputs[0])
+        for _ in range(REPEATS):
+            latencies = []
+            for batch in inputs:
+                start = time.perf_counter()
+                fn(batch)
+                latencies.append(time.perf_counter() - start)
+            repeats.append(np.array(latencies))
+
+        tracemalloc.start()
+        for batch in inputs[:MEMORY_BATCHES]:
+            fn(batch)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "stage": stage,
+        "batch_size": batch_size,
+        "threads": threads,
+        "throughput": max(batch_size * len(latencies) / latencies.sum() for latencies in repeats),
+        "p50_ms": min(np.percentile(latencies, 50) for latencies in repeats) * 1000,
+        "p99_ms": min(np.percentile(latencies, 99) for latencies in repeats) * 1000,
+        "peak_memory_mb": peak / 2 ** 20,
+    }
+
+
+def run_suite(model, stages=STAGES, batch_sizes=BATCH_SIZES, thread_counts=None, num_addresses=NUM_ADDRESSES,
+              seed=0):
+    import torch
+    thread_counts = thread_counts or default_thread_counts()
+    addresses = synthetic_addresses(num_addresses, seed=seed)
+    results = []
+    for stage, batch_size, threads in itertools.product(stages, batch_sizes, thread_counts):
+        result = run_stage(stage, model, addresses, batch_size, threads)
+        print(f"{stage:<8} batch {batch_size:<5} threads {threads:<3} {result['throughput']:>10.0f} addr/s "
+              f"p50 {result['p50_ms']:>8.2f}ms p99 {result['p99_ms']:>8.2f}ms "
+              f"peak {result['peak_memory_mb']:>7.2f}MB")
+        results.append(result)
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "numpy": np.__version__,
+        },
+        "config": {"num_addresses": num_addresses, "seed": seed, "seq_length": model.seq_length},
+        "results": results,
+    }
+
+
+def _key(result):
+    return result["stage"], result["batch_size"], result["threads"]
+
+
+def median_results(runs):
+    """
+    :param runs: Results of several run_suite runs with the same settings
+
+    Returns the results with the median of each measurement across the runs, which is far steadier between runs on a
+    noisy machine than any one run
+    """
+    median = dict(runs[0], results=[])
+    for result in runs[0]["results"]:
+        matching = [r for run in runs for r in run["results"] if _key(r) == _key(result)]
+        median["results"].append(dict(result, **dict(
+            (metric, float(np.median([r[metric] for r in matching]))) for metric in METRICS
+        )))
+    median["config"] = dict(runs[0]["config"], runs=len(runs))
+    return median
+
+
+def compare_results(results, baseline, tolerance=None):
+    """
+    :param results: Results of run_suite
+    :param baseline: Results of an earlier run_suite to compare against
+    :param tolerance: Fractional change in the bad direction allowed before a measurement counts as a regression,
+        for every metric. Defaults to the tolerance of each metric in TOLERANCES.
+
+    Returns a list of regressions, as dicts of the stage, batch size, thread count, metric, baseline and current
+    values. Measurements that are only in one of the two runs are skipped.
+    """
+    baseline_results = dict((_key(r), r) for r in baseline["results"])
+    regressions = []
+    for result in results["results"]:
+        base = baseline_results.get(_key(result))
+        if base is None:
+            continue
+        for metric, better in METRICS.items():
+            if metric not in base:
+                continue
+            change = (result[metric] - base[metric]) / base[metric] if base[metric] else 0.0
+            if better == "higher":
+                change = -change
+            if metric == "peak_memory_mb" and result[metric] - base[metric] < MIN_MEMORY_CHANGE_MB:
+                continue
+            if metric.endswith("_ms") and result[metric] - base[metric] < MIN_LATENCY_CHANGE_MS:
+                continue
+            if change > (TOLERANCES[metric] if tolerance is None else tolerance):
+                regressions.append({
+                    "stage": result["stage"], "batch_size": result["batch_size"], "threads": result["threads"],
+                    "metric": metric, "baseline": base[metric], "current": result[metric]
+                })
+    return regressions
+
+
+def main(model_path, output_path, baseline_path=None, tolerance=None, stages=STAGES, batch_sizes=BATCH_SIZES,
+         thread_counts=None, num_addresses=NUM_ADDRESSES, seed=0, runs=RUNS):
+    from address_parser.rnn.checkpoint import load_model
+    model = load_model(model_path, backend="eager")
+    all_runs = []
+    for run in range(runs):
+        if runs > 1:
+            print(f"Run {run + 1} of {runs}")
+        all_runs.append(run_suite(model, stages, batch_sizes, thread_counts, num_addresses, seed))
+    results = median_results(all_runs)
+    print(f"Saving results to {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if baseline_path:
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r['stage']} batch {r['batch_size']} threads {r['threads']} {r['metric']}: "
+                  f"{r['baseline']:.2f} -> {r['current']:.2f}")
+        if regressions:
+            sys.exit(1)
+        tolerances = TOLERANCES if tolerance is None else dict.fromkeys(METRICS, tolerance)
+        print(f"No regressions against {baseline_path} beyond the tolerances "
+              f"{', '.join(f'{metric} {t:.0%}' for metric, t in tolerances.items())}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', default="pretrained/address_char_rnn.pt", help="Path to trained model")
+    parser.add_argument('--output-path', default="bench_results.json", help="Path to save the results JSON")
+    parser.add_argument('--baseline-path', help="Results JSON of an earlier run to check for regressions against")
+    parser.add_argument('--tolerance', type=float,
+                        help="Fractional change in the bad direction that counts as a regression for every metric, "
+                             "defaults to the tolerance of each metric in TOLERANCES")
+    parser.add_argument('--runs', type=int, default=RUNS,
+                        help="Number of runs of the suite to take the median of, use several to record a baseline")
+    parser.add_argument('--stages', nargs="+", default=STAGES, choices=STAGES, help="Stages to benchmark")
+    parser.add_argument('--batch-sizes', nargs="+", type=int, default=BATCH_SIZES, help="Batch sizes to run")
+    parser.add_argument('--threads', nargs="+", type=int, help="Torch thread counts, defaults to 1 and all cores")
+    parser.add_argument('--num-addresses', type=int, default=NUM_ADDRESSES, help="Number of synthetic addresses")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for generating synthetic addresses")
+    args = parser.parse_args()
+    main(args.model_path, args.output_path, args.baseline_path, args.tolerance, args.stages, args.batch_sizes,
+         args.threads, args.num_addresses, args.seed, args.runs)
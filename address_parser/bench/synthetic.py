@@ -0,0 +1,75 @@
+"""
+Synthetic UK style address records for benchmarking, since the PAF data can't be shipped with this repo. Records have
+the same fields as PAF_SCHEMA and address strings are built from them with the same shuffle_components templates the
+model is trained on, so lengths and layouts follow what the model sees in practice.
+"""
+import random
+
+from address_parser.paf import PAF_SCHEMA, ADDRESS_FIELD_CLASSES
+from address_parser.paf.util import shuffle_components
+
+STREET_NAMES = ["high", "church", "station", "mill", "victoria", "park", "christopher", "fleet", "london", "manor",
+                "queens", "kings", "green", "new", "school", "north", "south", "west", "chapel", "albert"]
+STREET_DESCRIPTORS = ["street", "road", "avenue", "lane", "close", "drive", "way", "place", "gardens", "crescent"]
+BUILDING_NAMES = ["the old vicarage", "rose cottage", "the gherkin", "orchard house", "mill house", "the lodge",
+                  "ivy cottage", "court house", "the barn", "willow house"]
+SUB_BUILDING_PREFIXES = ["flat", "apartment", "unit", "suite"]
+LOCALITIES = ["moorgate", "fairwarp", "headingley", "clifton", "didsbury", "chesterton", "hampstead", "jesmond"]
+POSTTOWNS = ["london", "uckfield", "leeds", "bristol", "manchester", "cambridge", "newcastle upon tyne", "oxford",
+             "birmingham", "york"]
+POSTCODE_AREAS = ["ec", "tn", "ls", "bs", "m", "cb", "ne", "ox", "b", "yo", "sw", "n"]
+
+
+def _postcode(rng):
+    outward = f"{rng.choice(POSTCODE_AREAS)}{rng.randint(1, 20)}"
+    if rng.random() < 0.1:
+        outward += rng.choice("abcdehjkmnprstuvwxy")
+    inward = f"{rng.randint(0, 9)}{rng.choice('abdefghjlnpqrstuwxyz')}{rng.choice('abdefghjlnpqrstuwxyz')}"
+    return f"{outward} {inward}".upper()
+
+
+def synthetic_record(rng):
+    """
+    A PAF-like record with every field of PAF_SCHEMA, using the PAF conventions of an upper case postcode and post
+    town and a single space for a missing building number.
+    """
+    record = dict((field, "") for field in PAF_SCHEMA)
+    record["postcode"] = _postcode(rng)
+    record["posttown"] = rng.choice(POSTTOWNS).upper()
+    record["thoroughfare_and_descriptor"] = f"{rng.choice(STREET_NAMES)} {rng.choice(STREET_DESCRIPTORS)}".title()
+    record["building_number"] = str(rng.randint(1, 300)) if rng.random() < 0.8 else " "
+    if rng.random() < 0.3:
+        record["building_name"] = rng.choice(BUILDING_NAMES).title()
+    if rng.random() < 0.2:
+        record["sub_building_name"] = f"{rng.choice(SUB_BUILDING_PREFIXES)} {rng.randint(1, 40)}".title()
+    if rng.random() < 0.3:
+        record["dependent_locality"] = rng.choice(LOCALITIES).title()
+    record["udprn"] = str(rng.randint(10 ** 7, 10 ** 8 - 1))
+    record["postcode_type"] = "S"
+    record["delivery_point_suffix"] = "1A"
+    return record
+
+
+def synthetic_records(n, seed=0):
+    rng = random.Random(seed)
+    return [synthetic_record(rng) for _ in range(n)]
+
+
+def synthetic_paf_lines(n, seed=0):
+    """
+    Records as lines of a PAF CSV file, in PAF_SCHEMA column order
+    """
+    return [",".join(r[field] for field in PAF_SCHEMA) + "\n" for r in synthetic_records(n, seed)]
+
+
+def synthetic_addresses(n, seed=0):
+    """
+    Raw address strings laid out by shuffle_components, the same way training examples are generated.
+    """
+    # shuffle_components draws from the global random state
+    random.seed(seed)
+    addresses = []
+    for record in synthetic_records(n, seed):
+        address_dict = dict((t[0], (t[1] or "").lower()) for t in record.items() if t[0] in ADDRESS_FIELD_CLASSES)
+        addresses.append("".join(part for part, _ in shuffle_components(address_dict)))
+    return addresses
@@ -0,0 +1,64 @@
+"""
+Compares training throughput with each of the SEQUENCE_LAYOUTS of batches: every example padded to the full sequence
+length, and length bucketed batches trimmed to their longest example with padding masked out of the loss, run with
+and without packed sequences. See train.py.
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+from torch import nn, optim
+
+from address_parser.bench.synthetic import synthetic_records
+from address_parser.paf.util import augment_addresses
+from address_parser.rnn import AddressRNN, train
+from address_parser.rnn.util import SEQUENCE_LAYOUTS
+
+NUM_BATCHES = 40
+SEQ_LENGTHS = [60, 100]
+
+
+def _samples_per_sec(batches, seq_length, sequence_layout):
+    torch.manual_seed(0)
+    model = AddressRNN(vocab=train.VOCAB, lstm_dim=train.LSTM_DIM, lstm_layers=train.LSTM_LAYERS,
+                       output_dim=train.OUTPUT_DIM, seq_length=seq_length, batch_first=True)
+    model.train()
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=train.LR)
+    if sequence_layout != "padded":
+        batches = list(train.bucketed_batches(batches, np.random.default_rng(0)))
+    packed = sequence_layout == "packed"
+    # Warm up
+    train.train_step(model, optimizer, criterion, *batches[0], packed=packed)
+    start = time.perf_counter()
+    for batch in batches:
+        train.train_step(model, optimizer, criterion, *batch, packed=packed)
+    return sum(len(batch[0]) for batch in batches) / (time.perf_counter() - start)
+
+
+def main(num_batches, batch_size, threads, seed):
+    torch.set_num_threads(threads)
+    records = synthetic_records(num_batches * batch_size, seed=seed)
+    for seq_length in SEQ_LENGTHS:
+        features, labels = augment_addresses(records, seq_length, random.Random(seed))
+        batches = [(features[i:i + batch_size], labels[i:i + batch_size])
+                   for i in range(0, len(features), batch_size)]
+        lengths = (labels != train.PADDING_CLASS).sum(axis=1)
+        print(f"seq_length {seq_length}, address length p50/p95 {np.percentile(lengths, [50, 95]).tolist()}")
+        padded = _samples_per_sec(batches, seq_length, "padded")
+        print(f"  padded: {padded:.0f} samples/sec")
+        for sequence_layout in SEQUENCE_LAYOUTS[1:]:
+            samples_per_sec = _samples_per_sec(batches, seq_length, sequence_layout)
+            print(f"  {sequence_layout}: {samples_per_sec:.0f} samples/sec, speedup {samples_per_sec / padded:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-batches', type=int, default=NUM_BATCHES, help="Number of batches to train on")
+    parser.add_argument('--batch-size', type=int, default=train.BATCH_SIZE, help="Number of examples per batch")
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help="Torch thread count")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for generating synthetic addresses")
+    args = parser.parse_args()
+    main(args.num_batches, args.batch_size, args.threads, args.seed)
@@ -68,3 +68,44 @@ VOCAB_CHAR_TO_IDX = dict((t[1], t[0]) for t in VOCAB_IDX_TO_CHAR.items())
 STREET_VARIANTS = ["st", "st.", "street"]
 AVENUE_VARIANTS = ["av", "av.", "ave", "avenue"]
 ROAD_VARIANTS = ["rd", "rd.", "road"]
+# TODO: Maybe more variations of country, also think about ways to include NI, Wales, England.
+#  Also consider getting rid of country altogether.
+COUNTRY_VARIANTS = ["uk", "u.k", "u.k.", "united kingdom", "united k", "united k."]
+# Groups of equivalent representations that a field value is randomly mapped between, to build robustness. The value
+# is mapped with the first group that has a variant in it.
+FIELD_VARIANTS = {
+    AddressField.THOROUGHFARE_AND_DESCRIPTOR.value: [STREET_VARIANTS, AVENUE_VARIANTS, ROAD_VARIANTS],
+}
+
+_SUB_BUILDING = AddressField.SUB_BUILDING_NAME.value
+_BUILDING_NAME = AddressField.BUILDING_NAME.value
+_BUILDING_NUMBER = AddressField.BUILDING_NUMBER.value
+_THOROUGHFARE = AddressField.THOROUGHFARE_AND_DESCRIPTOR.value
+_LOCALITY = AddressField.DEPENDENT_LOCALITY.value
+_POSTTOWN = AddressField.POSTTOWN.value
+_POSTCODE = AddressField.POSTCODE.value
+_COUNTRY = AddressField.COUNTRY.value
+# Orders of fields that training addresses are laid out in, all equally likely. Empty fields are left out and the
+# fields are joined with a separator drawn from SEPARATORS, see shuffle_components.
+ADDRESS_LAYOUTS = [
+    # Full address, typical ordering
+    [_SUB_BUILDING, _BUILDING_NAME, _BUILDING_NUMBER, _THOROUGHFARE, _LOCALITY, _POSTTOWN, _POSTCODE, _COUNTRY],
+    # No sub-building name
+    [_BUILDING_NAME, _BUILDING_NUMBER, _THOROUGHFARE, _LOCALITY, _POSTTOWN, _POSTCODE, _COUNTRY],
+    # No dependent locality
+    [_SUB_BUILDING, _BUILDING_NAME, _BUILDING_NUMBER, _THOROUGHFARE, _POSTTOWN, _POSTCODE, _COUNTRY],
+    # No sub-building name or dependent locality
+    [_BUILDING_NAME, _BUILDING_NUMBER, _THOROUGHFARE, _POSTTOWN, _POSTCODE, _COUNTRY],
+    # No post town
+    [_SUB_BUILDING, _BUILDING_NAME, _BUILDING_NUMBER, _THOROUGHFARE, _LOCALITY, _POSTCODE, _COUNTRY],
+    # No post town or dependent locality
+    [_SUB_BUILDING, _BUILDING_NAME, _BUILDING_NUMBER, _THOROUGHFARE, _POSTCODE, _COUNTRY],
+    # No country
+    [_SUB_BUILDING, _BUILDING_NAME, _BUILDING_NUMBER, _THOROUGHFARE, _LOCALITY, _POSTTOWN, _POSTCODE],
+    # No country or sub-building name
+    [_BUILDING_NAME, _BUILDING_NUMBER, _THOROUGHFARE, _LOCALITY, _POSTTOWN, _POSTCODE],
+    # No country or sub-building name or dependent locality
+    [_BUILDING_NAME, _BUILDING_NUMBER, _THOROUGHFARE, _POSTTOWN, _POSTCODE],
+    # No country or post town
+    [_SUB_BUILDING, _BUILDING_NAME, _BUILDING_NUMBER, _THOROUGHFARE, _LOCALITY, _POSTCODE],
+]
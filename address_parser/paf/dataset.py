@@ -0,0 +1,163 @@
+"""
+Sharded dataset of preprocessed training examples, stored as fixed width uint8 matrices that are memory-mapped rather
+than loaded, so datasets much bigger than memory can be trained on.
+
+A dataset is a directory of shards and a manifest:
+    manifest.json: format_version, seq_length, the vocabulary and labels the examples were encoded with, the total
+        number of examples and the list of shards with the number of examples in each
+    features-<i>.npy: uint8 matrix of shape (examples, seq_length) of encoded addresses, see encode_address_and_labels
+    labels-<i>.npy: uint8 matrix of shape (examples, seq_length) of the class of each character
+"""
+import json
+import os
+
+import numpy as np
+
+from address_parser.paf import VOCAB, ADDRESS_FIELD_CLASSES
+
+DATASET_FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+# Number of examples per shard, about 100MB of features and labels each with a seq_length of 100
+SHARD_SIZE = 500000
+
+
+class ShardedDatasetWriter:
+    """
+    Writes examples to a new dataset directory, holding at most one shard of examples in memory at a time. The
+    manifest is only written on close, so a dataset that wasn't finished can't be opened.
+    """
+    def __init__(self, path, seq_length, shard_size=SHARD_SIZE):
+        self.path = path
+        self.seq_length = seq_length
+        self.shard_size = shard_size
+        self.shards = []
+        self._features = np.empty((shard_size, seq_length), dtype=np.uint8)
+        self._labels = np.empty((shard_size, seq_length), dtype=np.uint8)
+        self._buffered = 0
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, MANIFEST_FILE)):
+            raise FileExistsError(f"{path} already contains a dataset")
+
+    @property
+    def num_examples(self):
+        return sum(shard["num_examples"] for shard in self.shards) + self._buffered
+
+    def write(self, features, labels):
+        """
+        :param features: Encoded addresses of shape (n, seq_length)
+        :param labels: Classes of each character of shape (n, seq_length)
+        """
+        features = np.asarray(features)
+        labels = np.asarray(labels)
+        if features.shape != labels.shape or features.shape[1:] != (self.seq_length,):
+            raise ValueError(f"Expected features and labels of shape (n, {self.seq_length}), got {features.shape} "
+                             f"and {labels.shape}")
+        start = 0
+        while start < len(features):
+            n = min(len(features) - start, self.shard_size - self._buffered)
+            self._features[self._buffered:self._buffered + n] = features[start:start + n]
+            self._labels[self._buffered:self._buffered + n] = labels[start:start + n]
+            self._buffered += n
+            start += n
+            if self._buffered == self.shard_size:
+                self._flush()
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        i = len(self.shards)
+        shard = {"features": f"features-{i:05d}.npy", "labels": f"labels-{i:05d}.npy", "num_examples": self._buffered}
+        np.save(os.path.join(self.path, shard["features"]), self._features[:self._buffered])
+        np.save(os.path.join(self.path, shard["labels"]), self._labels[:self._buffered])
+        self.shards.append(shard)
+        self._buffered = 0
+
+    def close(self):
+        self._flush()
+        manifest = {
+            "format_version": DATASET_FORMAT_VERSION,
+            "seq_length": self.seq_length,
+            "vocab": list(VOCAB),
+            "labels": list(ADDRESS_FIELD_CLASSES),
+            "num_examples": self.num_examples,
+            "shards": self.shards,
+        }
+        with open(os.path.join(self.path, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # Leave the dataset without a manifest if writing it failed part way
+        if exc_type is None:
+            self.close()
+
+
+class ShardedDataset:
+    """
+    Read-only view of a dataset written by ShardedDatasetWriter. Shards are memory-mapped when first accessed, so
+    opening a dataset is instant and only the examples that are read are paged in.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), "r") as f:
+            self.manifest = json.load(f)
+        if self.manifest["format_version"] > DATASET_FORMAT_VERSION:
+            raise ValueError(f"Dataset format version {self.manifest['format_version']} is newer than the supported "
+                             f"version {DATASET_FORMAT_VERSION}")
+        if self.manifest["vocab"] != list(VOCAB) or self.manifest["labels"] != list(ADDRESS_FIELD_CLASSES):
+            raise ValueError("Dataset was encoded with a different vocabulary or labels to the current ones")
+        self.seq_length = self.manifest["seq_length"]
+        self.shards = self.manifest["shards"]
+        # Index of the first example of each shard, and the total number of examples at the end
+        self._offsets = np.cumsum([0] + [shard["num_examples"] for shard in self.shards])
+        self._mmaps = {}
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def shard(self, i):
+        """
+        Memory-mapped features and labels of shard i
+        """
+        if i not in self._mmaps:
+            shard = self.shards[i]
+            self._mmaps[i] = (np.load(os.path.join(self.path, shard["features"]), mmap_mode="r"),
+                              np.load(os.path.join(self.path, shard["labels"]), mmap_mode="r"))
+        return self._mmaps[i]
+
+    def __getitem__(self, idx):
+        """
+        Returns (features, labels) of an example, or matrices of them for a slice or array of example indexes
+        """
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(len(self)))
+        elif np.isscalar(idx):
+            features, labels = self[np.array([idx])]
+            return features[0], labels[0]
+        idx = np.asarray(idx, dtype=np.int64)
+        if len(idx) and (idx.min() < -len(self) or idx.max() >= len(self)):
+            raise IndexError(f"Index out of range for dataset of {len(self)} examples")
+        idx = np.where(idx < 0, idx + len(self), idx)
+        features = np.empty((len(idx), self.seq_length), dtype=np.uint8)
+        labels = np.empty((len(idx), self.seq_length), dtype=np.uint8)
+        shard_idx = np.searchsorted(self._offsets, idx, side="right") - 1
+        for i in np.unique(shard_idx):
+            in_shard = shard_idx == i
+            shard_features, shard_labels = self.shard(i)
+            features[in_shard] = shard_features[idx[in_shard] - self._offsets[i]]
+            labels[in_shard] = shard_labels[idx[in_shard] - self._offsets[i]]
+        return features, labels
+
+    def batches(self, batch_size, shuffle=False, seed=0, drop_last=False):
+        """
+        Yields (features, labels) batches, in order or shuffled by the seed, which can be anything np.random.default_rng
+        takes. Only one batch is in memory at a time.
+        """
+        order = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        end = len(self) - len(self) % batch_size if drop_last else len(self)
+        for start in range(0, end, batch_size):
+            batch_idx = order[start:start + batch_size]
+            # Reading examples in file order is kinder to the page cache, the order within a batch doesn't matter
+            yield self[np.sort(batch_idx) if shuffle else batch_idx]
@@ -0,0 +1,282 @@
+"""
+Compact reference index of the PAF data, for checking parsed addresses against the addresses that actually exist.
+
+An index is a directory of numpy arrays and a manifest, memory-mapped rather than loaded so opening one is instant
+however big it is:
+    manifest.json: format_version, the indexed fields and the number of postcodes and strings of each field
+    postcodes.npy: Sorted postcodes without spaces (see postcode_key), each packed into a uint64 as its 8 bytes
+        padded with nulls, read big-endian so that the integers sort in the same order as the strings
+    <field>-strings.npy: Sorted fixed width byte strings of every distinct value of the field, normalised as parsed
+        components are (see normalise_address_str)
+    <field>-indptr.npy, <field>-ids.npy: The values of the field in each postcode, as the ids (positions in the
+        string table) of postcode i at ids[indptr[i]:indptr[i + 1]], sorted
+
+Every lookup is a binary search over sorted arrays, and lookups of whole batches of addresses are vectorised, so
+millions of them take a second or so.
+
+correct_parsed checks parsed addresses against the index, filling in or fixing the post town from the postcode, as
+every address in a postcode shares a post town, and flagging other components that don't exist in the postcode.
+"""
+import argparse
+import csv
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+
+from address_parser.paf import PAF_SCHEMA, AddressField
+from address_parser.paf.sample import PAF_ENCODING
+from address_parser.paf.util import normalise_address_str
+
+INDEX_FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+INDEX_FIELDS = [
+    AddressField.POSTTOWN.value,
+    AddressField.DEPENDENT_LOCALITY.value,
+    AddressField.DOUBLE_DEPENDENT_LOCALITY.value,
+    AddressField.THOROUGHFARE_AND_DESCRIPTOR.value,
+    AddressField.DEPENDENT_THOROUGHFARE_AND_DESCRIPTOR.value,
+]
+# Fields that are the same for every address in a postcode, so can be filled in from the postcode alone. Localities
+# and streets can be missing from some of the addresses in a postcode.
+FILLABLE_FIELDS = [AddressField.POSTTOWN.value]
+# Outcomes of checking a component against the index, see correct_parsed
+VALID = "valid"
+INVALID = "invalid"
+FILLED = "filled"
+CORRECTED = "corrected"
+UNKNOWN_POSTCODE = "unknown_postcode"
+# Full postcodes are at most 7 characters without the space
+_POSTCODE_WIDTH = 8
+# Postcodes are only ever letters and digits, so everything else is dropped from them
+_NOT_POSTCODE_BYTES = bytes(b for b in range(128) if not chr(b).isalnum())
+
+
+def postcode_key(postcode):
+    """
+    Normalised postcode without spaces or punctuation, as postcodes are stored in the index
+    """
+    return (postcode or "").lower().encode("ascii", "ignore").translate(None, _NOT_POSTCODE_BYTES).decode("ascii")
+
+
+def postcode_keys(postcodes):
+    """
+    Postcodes normalised as by postcode_key and packed into uint64s as in postcodes.npy, without the round trip
+    through str for every postcode. Binary searches over integers are several times faster than over byte strings.
+    """
+    keys = np.array([(p or "").lower().encode("ascii", "ignore").translate(None, _NOT_POSTCODE_BYTES)
+                     for p in postcodes], dtype=f"S{_POSTCODE_WIDTH}")
+    return keys.view(">u8").astype(np.uint64)
+
+
+def _read_records(paf_path, encoding):
+    with open(paf_path, "r", newline="", encoding=encoding) as f:
+        for row in csv.reader(f):
+            if row and row != PAF_SCHEMA:
+                yield dict(zip(PAF_SCHEMA, row))
+
+
+def build_index(paf_path, index_path, encoding=PAF_ENCODING):
+    """
+    :param paf_path: PAF CSV file or sample, in PAF_SCHEMA column order with or without a header
+    :param index_path: Directory to write the index to
+    :param encoding: Encoding of the PAF file. Samples written by sample.py are UTF-8, which only differs from the PAF
+        encoding outside ASCII, and nothing outside ASCII is kept by normalise_address_str anyway.
+
+    Returns the number of records indexed.
+    """
+    values = dict((field, defaultdict(set)) for field in INDEX_FIELDS)
+    postcodes = set()
+    records = 0
+    for record in _read_records(paf_path, encoding):
+        postcode = postcode_key(record["postcode"])
+        if not postcode:
+            continue
+        postcodes.add(postcode)
+        for field in INDEX_FIELDS:
+            value = normalise_address_str(record.get(field, "")).strip()
+            if value:
+                values[field][postcode].add(value)
+        records += 1
+
+    os.makedirs(index_path, exist_ok=True)
+    if os.path.exists(os.path.join(index_path, MANIFEST_FILE)):
+        raise FileExistsError(f"{index_path} already contains an index")
+    postcodes = sorted(postcodes)
+    np.save(os.path.join(index_path, "postcodes.npy"), postcode_keys(postcodes))
+    strings = {}
+    for field in INDEX_FIELDS:
+        table = sorted(set().union(*values[field].values()))
+        ids = dict((value, i) for i, value in enumerate(table))
+        per_postcode = [sorted(ids[v] for v in values[field].get(postcode, ())) for postcode in postcodes]
+        indptr = np.zeros(len(postcodes) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in per_postcode], out=indptr[1:])
+        # An empty table would be written with a zero width dtype, which numpy can't load
+        table_arr = np.array(table, dtype=bytes) if table else np.empty(0, dtype="S1")
+        np.save(os.path.join(index_path, f"{field}-strings.npy"), table_arr)
+        np.save(os.path.join(index_path, f"{field}-indptr.npy"), indptr)
+        np.save(os.path.join(index_path, f"{field}-ids.npy"),
+                np.fromiter((i for p in per_postcode for i in p), dtype=np.int32, count=indptr[-1]))
+        strings[field] = len(table)
+    manifest = {
+        "format_version": INDEX_FORMAT_VERSION,
+        "fields": INDEX_FIELDS,
+        "num_records": records,
+        "num_postcodes": len(postcodes),
+        "num_strings": strings,
+    }
+    with open(os.path.join(index_path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return records
+
+
+class MappedIndex:
+    """
+    Manifest and arrays of an index directory, shared by the PAF and UDPRN match indexes. Arrays are memory-mapped
+    when first used, so only the pages that lookups touch are read.
+    """
+    def __init__(self, path, format_version, name="Index"):
+        """
+        :param format_version: Newest format version of the index that can be read
+        :param name: Name of the index in errors
+        """
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), "r") as f:
+            self.manifest = json.load(f)
+        if self.manifest["format_version"] > format_version:
+            raise ValueError(f"{name} format version {self.manifest['format_version']} is newer than the supported "
+                             f"version {format_version}")
+        self._arrays = {}
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+        return self._arrays[name]
+
+
+class PafIndex(MappedIndex):
+    """
+    Read-only view of an index written by build_index
+    """
+    def __init__(self, path):
+        super().__init__(path, INDEX_FORMAT_VERSION)
+        self.fields = self.manifest["fields"]
+        self._keys = {}
+
+    def __len__(self):
+        return self.manifest["num_postcodes"]
+
+    def postcode_rows(self, postcodes):
+        """
+        Returns the row of each postcode in the index, or -1 for postcodes that aren't in it
+        """
+        table = self._array("postcodes")
+        keys = postcode_keys(postcodes)
+        rows = np.searchsorted(table, keys)
+        found = rows < len(table)
+        found[found] = table[rows[found]] == keys[found]
+        return np.where(found & (keys != 0), rows, -1)
+
+    def values(self, row, field):
+        """
+        Values of the field in the postcode at the row, e.g. the streets of a postcode
+        """
+        if row < 0:
+            return []
+        indptr = self._array(f"{field}-indptr")
+        ids = self._array(f"{field}-ids")[indptr[row]:indptr[row + 1]]
+        return [s.decode("ascii") for s in self._array(f"{field}-strings")[ids]]
+
+    def value_ids(self, field, values):
+        """
+        Returns the id of each value in the string table of the field, or -1 for values that aren't in it
+        """
+        table = self._array(f"{field}-strings")
+        # Values longer than any in the table are cut to its width by the conversion, so they're checked in full after
+        keys = np.array([(v or "").encode("ascii", "ignore") for v in values], dtype=bytes)
+        ids = np.searchsorted(table, keys.astype(table.dtype))
+        found = ids < len(table)
+        found[found] = table[ids[found]] == keys[found]
+        return np.where(found & (keys != b""), ids, -1)
+
+    def _pair_keys(self, field):
+        # Row and id pairs flattened into single sorted keys, so pairs can be looked up with one binary search
+        if field not in self._keys:
+            indptr = self._array(f"{field}-indptr")
+            rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+            self._keys[field] = rows * max(self.manifest["num_strings"][field], 1) + self._array(f"{field}-ids")
+        return self._keys[field]
+
+    def contains(self, rows, field, values):
+        """
+        Returns whether each value is one of the values of the field in the postcode at the corresponding row
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        ids = self.value_ids(field, values)
+        keys = rows * max(self.manifest["num_strings"][field], 1) + ids
+        table = self._pair_keys(field)
+        if not len(table):
+            return np.zeros(len(rows), dtype=bool)
+        positions = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+        return (rows >= 0) & (ids >= 0) & (table[positions] == keys)
+
+    def counts(self, rows, field):
+        """
+        Number of values of the field in the postcode at each row, 0 for rows of -1
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        indptr = self._array(f"{field}-indptr")
+        counts = indptr[rows + 1] - indptr[rows]
+        return np.where(rows >= 0, counts, 0)
+
+
+def correct_parsed(parsed, index):
+    """
+    :param parsed: Parsed components of each address, as returned by parse_raw_addresses
+    :param index: PafIndex
+
+    Checks each address against the values the index has for its postcode. Returns a corrected copy of each address
+    and the outcome of checking each of its components:
+        unknown_postcode: The postcode isn't in the index (or the address has none), so nothing else is checked
+        valid: The component is one of the values in the postcode
+        filled: The component was missing and filled in, as the postcode only has one value of a FILLABLE_FIELDS field
+        corrected: The component was replaced, as it isn't the only value of a FILLABLE_FIELDS field in the postcode
+        invalid: The component isn't one of the values in the postcode
+    """
+    rows = index.postcode_rows([components.get(AddressField.POSTCODE.value, "") for components in parsed])
+    corrected = [defaultdict(str, components) for components in parsed]
+    outcomes = [{AddressField.POSTCODE.value: VALID if row >= 0 else UNKNOWN_POSTCODE} for row in rows.tolist()]
+    for field in index.fields:
+        values = [components.get(field, "").strip() for components in parsed]
+        present = np.array([bool(v) for v in values])
+        valid = index.contains(rows, field, values)
+        single = (index.counts(rows, field) == 1) if field in FILLABLE_FIELDS else np.zeros(len(rows), dtype=bool)
+        # Only the addresses with something to report are looped over
+        for i in np.flatnonzero((rows >= 0) & (present | single)).tolist():
+            if valid[i]:
+                outcomes[i][field] = VALID
+            elif single[i]:
+                corrected[i][field] = index.values(rows[i], field)[0]
+                outcomes[i][field] = CORRECTED if present[i] else FILLED
+            else:
+                outcomes[i][field] = INVALID
+    return corrected, outcomes
+
+
+def main(paf_path, index_path, encoding=PAF_ENCODING):
+    print(f"Building PAF index of {paf_path}")
+    records = build_index(paf_path, index_path, encoding)
+    index = PafIndex(index_path)
+    print(f"Indexed {records} records in {len(index)} postcodes to {index_path}")
+    for field in index.fields:
+        print(f"  {field}: {index.manifest['num_strings'][field]} distinct values")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paf-path', required=True, help="Path to the PAF CSV file or a sample of it")
+    parser.add_argument('--index-path', required=True, help="Directory to write the index to")
+    parser.add_argument('--encoding', default=PAF_ENCODING, help="Encoding of the PAF file")
+    args = parser.parse_args()
+    main(args.paf_path, args.index_path, args.encoding)
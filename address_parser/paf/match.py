@@ -0,0 +1,274 @@
+"""
+Matches parsed addresses to the UDPRN (Unique Delivery Point Reference Number) of the PAF record they refer to.
+
+Each PAF record is represented by the set of character trigrams of its building number, building name, sub-building
+name and street, with each trigram tagged with its field so that e.g. "12" in a building number doesn't match "12" in
+a flat name. A parsed address is scored against a record by the Dice coefficient of their trigram sets,
+2 * |shared| / (|address| + |record|), so small differences in spelling or abbreviation cost a little rather than
+losing the match altogether.
+
+Candidates are blocked by postcode: records are sorted by postcode, so the records of a postcode are a contiguous
+range and an address with a known postcode is only scored against those. Addresses without a postcode, or with one
+that isn't in the PAF, fall back to an inverted index from each trigram to the records containing it, which gathers
+the records sharing the most trigrams with the address as candidates. Trigrams shared by too many records to tell
+them apart are left out of that.
+
+An index is a directory of numpy arrays and a manifest, memory-mapped rather than loaded:
+    manifest.json: format_version, the fields matched on and the number of records
+    postcodes.npy, postcode_indptr.npy: Sorted postcodes packed as in index.py, and the records of postcode i at
+        postcode_indptr[i]:postcode_indptr[i + 1]
+    udprns.npy: UDPRN of each record
+    record_indptr.npy, record_grams.npy: Sorted trigrams of record i at
+        record_grams[record_indptr[i]:record_indptr[i + 1]]
+    gram_keys.npy, gram_indptr.npy, gram_records.npy: Inverted index, the records containing trigram gram_keys[j] at
+        gram_records[gram_indptr[j]:gram_indptr[j + 1]]
+
+Trigrams are exact rather than hashed: the vocabulary is ASCII, so the three characters and the field fit in a
+uint32. Scoring is vectorised over all of the candidates of an address.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from address_parser.paf import AddressField
+from address_parser.paf.index import MANIFEST_FILE, MappedIndex, _read_records, postcode_keys
+from address_parser.paf.sample import PAF_ENCODING
+from address_parser.paf.util import chunks_from_iter, normalise_address_str
+
+MATCH_FORMAT_VERSION = 1
+MATCH_FIELDS = [
+    AddressField.BUILDING_NUMBER.value,
+    AddressField.BUILDING_NAME.value,
+    AddressField.SUB_BUILDING_NAME.value,
+    AddressField.THOROUGHFARE_AND_DESCRIPTOR.value,
+]
+TOP_K = 5
+# Trigrams in more records than this are too common to gather candidates with, e.g. "st " in street
+MAX_POSTINGS = 10000
+# Number of records gathered from the inverted index and scored in full, for addresses that can't be blocked
+MAX_CANDIDATES = 1000
+# Records read and turned into trigrams at a time while an index is built
+BUILD_CHUNK_SIZE = 10000
+_CHAR_BITS = 7
+
+
+def _field_grams(texts, field_idx):
+    """
+    Returns the record index and trigram of every trigram of each text, with the field index in the top bits
+    """
+    # Every text is padded with a space either side so the first and last characters get trigrams of their own, and
+    # texts are joined so that all of their trigrams are computed in one go
+    padded = [f" {t} " if t else "" for t in texts]
+    lengths = np.fromiter(map(len, padded), dtype=np.int64, count=len(padded))
+    chars = np.frombuffer("".join(padded).encode("ascii", "ignore"), dtype=np.uint8).astype(np.uint32)
+    if len(chars) < 3:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32)
+    grams = ((np.uint32(field_idx) << np.uint32(3 * _CHAR_BITS)) | (chars[:-2] << np.uint32(2 * _CHAR_BITS))
+             | (chars[1:-1] << np.uint32(_CHAR_BITS)) | chars[2:])
+    # Only the trigrams that start far enough from the end of their own text to lie within it
+    counts = np.maximum(lengths - 2, 0)
+    records = np.repeat(np.arange(len(texts), dtype=np.int64), counts)
+    # Start of each trigram's text, plus the position of the trigram within its text
+    text_starts = (np.cumsum(lengths) - lengths)[records]
+    positions = text_starts + np.arange(counts.sum()) - (np.cumsum(counts) - counts)[records]
+    return records, grams[positions]
+
+
+def record_grams(components_list):
+    """
+    :param components_list: Address components of each record or parsed address, mapping MATCH_FIELDS to values
+
+    Returns the trigrams of each address in CSR form, (indptr, grams), with the trigrams of each address sorted and
+    distinct.
+    """
+    records, grams = [], []
+    for field_idx, field in enumerate(MATCH_FIELDS):
+        texts = [normalise_address_str(c.get(field) or "").strip() for c in components_list]
+        field_records, field_grams = _field_grams(texts, field_idx)
+        records.append(field_records)
+        grams.append(field_grams)
+    # Sorting on record then trigram groups each address's trigrams together, in order, and finds the duplicates
+    keys = np.unique((np.concatenate(records) << np.int64(32)) | np.concatenate(grams).astype(np.int64))
+    indptr = np.searchsorted(keys >> np.int64(32), np.arange(len(components_list) + 1))
+    return indptr.astype(np.int64), (keys & np.int64(0xFFFFFFFF)).astype(np.uint32)
+
+
+def build_match_index(paf_path, index_path, encoding=PAF_ENCODING):
+    """
+    :param paf_path: PAF CSV file or sample, in PAF_SCHEMA column order with or without a header
+    :param index_path: Directory to write the index to
+    :param encoding: Encoding of the PAF file, see build_index
+
+    Records are read in chunks into columns of postcode keys, UDPRNs and trigrams, so only the arrays of the index are
+    held in memory while it's built. Returns the number of records indexed.
+    """
+    # Each column starts with an empty array so that a file without any records gives an empty index
+    keys = [np.empty(0, dtype=np.uint64)]
+    udprns = [np.empty(0, dtype=np.int64)]
+    counts = [np.empty(0, dtype=np.int64)]
+    grams = [np.empty(0, dtype=np.uint32)]
+    for chunk in chunks_from_iter(_read_records(paf_path, encoding), BUILD_CHUNK_SIZE):
+        chunk = [r for r in chunk if r.get("udprn", "").strip().isdigit()]
+        keys.append(postcode_keys([r["postcode"] for r in chunk]))
+        udprns.append(np.array([int(r["udprn"]) for r in chunk], dtype=np.int64))
+        chunk_indptr, chunk_grams = record_grams(chunk)
+        counts.append(np.diff(chunk_indptr))
+        grams.append(chunk_grams)
+    keys, udprns, counts, grams = map(np.concatenate, (keys, udprns, counts, grams))
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    # Records are sorted by postcode, keeping file order within each postcode
+    order = np.argsort(keys, kind="stable")
+    keys, udprns = keys[order], udprns[order]
+    grams, _ = _gather(indptr, grams, order)
+    np.cumsum(counts[order], out=indptr[1:])
+
+    os.makedirs(index_path, exist_ok=True)
+    if os.path.exists(os.path.join(index_path, MANIFEST_FILE)):
+        raise FileExistsError(f"{index_path} already contains an index")
+
+    def save(name, array):
+        np.save(os.path.join(index_path, f"{name}.npy"), array)
+
+    postcodes, postcode_starts = np.unique(keys, return_index=True)
+    save("postcodes", postcodes)
+    save("postcode_indptr", np.append(postcode_starts, len(keys)).astype(np.int64))
+    save("udprns", udprns)
+    save("record_indptr", indptr)
+    save("record_grams", grams)
+    # Inverted index, every record of each trigram in record order
+    gram_record_ids = np.repeat(np.arange(len(keys), dtype=np.int32), np.diff(indptr))
+    by_gram = np.argsort(grams, kind="stable")
+    gram_keys, gram_starts = np.unique(grams[by_gram], return_index=True)
+    save("gram_keys", gram_keys)
+    save("gram_indptr", np.append(gram_starts, len(grams)).astype(np.int64))
+    save("gram_records", gram_record_ids[by_gram])
+    manifest = {
+        "format_version": MATCH_FORMAT_VERSION,
+        "fields": MATCH_FIELDS,
+        "num_records": len(keys),
+        "num_postcodes": len(postcodes),
+        "num_grams": len(gram_keys),
+    }
+    with open(os.path.join(index_path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return len(keys)
+
+
+def _gather(indptr, values, rows):
+    """
+    Concatenated CSR rows of values, with the position in rows that each value came from
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    owners = np.repeat(np.arange(len(rows)), lengths)
+    # Position of each value within its own row, added to the start of the row
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return values[starts[owners] + offsets], owners
+
+
+class UdprnMatcher(MappedIndex):
+    """
+    Read-only view of an index written by build_match_index, scoring parsed addresses against PAF records
+    """
+    def __init__(self, path, max_postings=MAX_POSTINGS, max_candidates=MAX_CANDIDATES):
+        """
+        :param max_postings: Trigrams in more records than this aren't used to gather candidates
+        :param max_candidates: Number of records scored for addresses that can't be blocked by postcode
+        """
+        super().__init__(path, MATCH_FORMAT_VERSION, name="Match index")
+        self.max_postings = max_postings
+        self.max_candidates = max_candidates
+
+    def __len__(self):
+        return self.manifest["num_records"]
+
+    def _block(self, postcode_key):
+        postcodes = self._array("postcodes")
+        i = np.searchsorted(postcodes, postcode_key)
+        if postcode_key == 0 or i == len(postcodes) or postcodes[i] != postcode_key:
+            return None
+        indptr = self._array("postcode_indptr")
+        return np.arange(indptr[i], indptr[i + 1])
+
+    def _candidates(self, grams):
+        """
+        Records sharing the most trigrams with the address, from the inverted index
+        """
+        gram_keys = self._array("gram_keys")
+        idx = np.searchsorted(gram_keys, grams)
+        found = idx < len(gram_keys)
+        found[found] = gram_keys[idx[found]] == grams[found]
+        idx = idx[found]
+        indptr = self._array("gram_indptr")
+        idx = idx[indptr[idx + 1] - indptr[idx] <= self.max_postings]
+        if not len(idx):
+            return np.empty(0, dtype=np.int64)
+        records, _ = _gather(indptr, self._array("gram_records"), idx)
+        records, shared = np.unique(records, return_counts=True)
+        if len(records) > self.max_candidates:
+            records = records[np.argpartition(-shared, self.max_candidates)[:self.max_candidates]]
+        return records.astype(np.int64)
+
+    def _score(self, grams, records):
+        """
+        Dice coefficient of the address trigrams with those of each record
+        """
+        indptr = self._array("record_indptr")
+        if not len(grams):
+            return np.zeros(len(records))
+        candidate_grams, owners = _gather(indptr, self._array("record_grams"), records)
+        positions = np.minimum(np.searchsorted(grams, candidate_grams), len(grams) - 1)
+        shared = np.bincount(owners[grams[positions] == candidate_grams], minlength=len(records))
+        sizes = indptr[records + 1] - indptr[records]
+        return 2 * shared / (len(grams) + sizes)
+
+    def match(self, components, top_k=TOP_K):
+        """
+        :param components: Parsed components of an address, as returned by parse_raw_address
+        :param top_k: Number of candidates to return
+
+        Returns up to top_k (udprn, score) pairs, best first, with scores between 0 and 1.
+        """
+        return self.match_many([components], top_k)[0]
+
+    def match_many(self, parsed, top_k=TOP_K):
+        """
+        Matches each of a list of parsed addresses, see match
+        """
+        indptr, grams = record_grams(parsed)
+        keys = postcode_keys([components.get(AddressField.POSTCODE.value, "") for components in parsed])
+        udprns = self._array("udprns")
+        matches = []
+        for i in range(len(parsed)):
+            address_grams = grams[indptr[i]:indptr[i + 1]]
+            records = self._block(keys[i])
+            if records is None:
+                records = self._candidates(address_grams)
+            if not len(records):
+                matches.append([])
+                continue
+            scores = self._score(address_grams, records)
+            # Ties go to the first record, in postcode and file order
+            best = np.argsort(-scores, kind="stable")[:top_k]
+            matches.append(list(zip(udprns[records[best]].tolist(), scores[best].tolist())))
+        return matches
+
+
+def main(paf_path, index_path, encoding=PAF_ENCODING):
+    print(f"Building UDPRN match index of {paf_path}")
+    records = build_match_index(paf_path, index_path, encoding)
+    matcher = UdprnMatcher(index_path)
+    print(f"Indexed {records} records in {matcher.manifest['num_postcodes']} postcodes with "
+          f"{matcher.manifest['num_grams']} distinct trigrams to {index_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paf-path', required=True, help="Path to the PAF CSV file or a sample of it")
+    parser.add_argument('--index-path', required=True, help="Directory to write the index to")
+    parser.add_argument('--encoding', default=PAF_ENCODING, help="Encoding of the PAF file")
+    args = parser.parse_args()
+    main(args.paf_path, args.index_path, args.encoding)
@@ -1,17 +1,26 @@
 import argparse
-import pickle
+import os
+import random
+from collections import deque
+from multiprocessing import Pool
 
 from address_parser.paf import ADDRESS_FIELD_CLASSES
+from address_parser.paf.dataset import SHARD_SIZE, ShardedDatasetWriter
 from address_parser.paf.util import (
-    chunks_from_iter, csv_records_to_dicts, shuffle_components, split_component_chars, encode_address_and_labels
+    augment_addresses, chunks_from_iter, csv_records_to_dicts, shuffle_components, split_component_chars,
+    encode_address_and_labels
 )
 
 CHUNK_SIZE = 1000
+SEQ_LENGTH = 100
+# Maximum number of chunks queued or being preprocessed per worker, which bounds memory use
+CHUNKS_IN_FLIGHT_PER_WORKER = 4
 
 
-def _address_char_level_labels(address, seq_length):
+def _address_char_level_labels(address, seq_length, rng=None):
     """
-    Initial address prep.
+    Initial address prep of a single address, character by character. preprocess_addresses does the same for
+    batches of addresses at a time with augment_addresses, which is much faster.
 
     Steps
     1- Construct an address string from the input, getting rid of things like organisation name, udprn etc, as well as
@@ -64,7 +73,7 @@ def _address_char_level_labels(address, seq_length):
     """
     # Get rid of unneeded address fields and make all fields lower case
     address_dict = dict((t[0], (t[1] or '').lower()) for t in address.items() if t[0] in ADDRESS_FIELD_CLASSES)
-    address_parts = shuffle_components(address_dict)
+    address_parts = shuffle_components(address_dict, rng)
     address_char_components = split_component_chars(address_parts)
     # TODO: Add extra step before the encoding to:
     #     - Introduce typos randomly with some probability
@@ -73,33 +82,75 @@ def _address_char_level_labels(address, seq_length):
     return address_encoded, address_labels
 
 
-def preprocess_addresses(address_dicts, seq_length):
-    for address in address_dicts:
-        address_encoded, address_labels = _address_char_level_labels(address, seq_length)
-        yield address_encoded, address_labels
+def preprocess_addresses(address_dicts, seq_length, rng=None):
+    """
+    :param rng: random.Random that the variations of each address are drawn from, defaults to the global random state
+
+    Yields (encoded address, address char labels) pairs, preprocessing CHUNK_SIZE addresses at a time.
+    """
+    for chunk in chunks_from_iter(address_dicts, CHUNK_SIZE):
+        features, labels = augment_addresses(chunk, seq_length, rng)
+        yield from zip(features, labels)
+
+
+def chunk_rng(seed, chunk_idx):
+    """
+    Random state for the chunk of records at chunk_idx. Every chunk gets its own, so the variations generated for a
+    chunk don't depend on which process it was preprocessed in or what was preprocessed before it.
+    """
+    # Seeding with a string hashes it, so nearby seeds and chunk indexes still give unrelated streams
+    return random.Random(f"{seed}:{chunk_idx}")
+
+
+def preprocess_chunk(task):
+    """
+    :param task: Tuple of (chunk_idx, CSV lines of records, seq_length, seed)
+
+    Returns uint8 feature and label matrices of the chunk.
+    """
+    chunk_idx, lines, seq_length, seed = task
+    return augment_addresses(csv_records_to_dicts(lines), seq_length, chunk_rng(seed, chunk_idx))
 
 
-def main(paf_sample_file, output_file):
+def _preprocess_chunks(tasks, workers):
+    """
+    Yields the result of each task in order, preprocessing them across a pool of worker processes if there's more
+    than one worker. Only a bounded number of chunks are read ahead of the one being written out.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield preprocess_chunk(task)
+        return
+    with Pool(workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(preprocess_chunk, (task,)))
+            if len(pending) >= workers * CHUNKS_IN_FLIGHT_PER_WORKER:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def main(paf_sample_file, output_path, seq_length=SEQ_LENGTH, shard_size=SHARD_SIZE, workers=1, seed=0):
     """
     We have a structured address dataset that we can use to automatically construct a training set
     for address parsing.
+
+    The preprocessed examples are written to a sharded dataset (see address_parser.paf.dataset) as they're produced,
+    so only a chunk of records and a shard of examples are ever held in memory. With more than one worker, chunks of
+    records are preprocessed in parallel and written out in input order. Each chunk is seeded from the seed and its
+    position in the input, so the dataset is the same for a given seed whatever the number of workers.
     """
-    preprocessed = []
     chunks = 0
-    with open(paf_sample_file, "r") as f:
-        print(f"Processing data in chunks of size {CHUNK_SIZE}")
-        for chunk in chunks_from_iter(f.readlines(), CHUNK_SIZE):
-            address_dicts = csv_records_to_dicts(chunk)
-            preprocessed += list(preprocess_addresses(address_dicts, seq_length=100))
+    with open(paf_sample_file, "r") as f, ShardedDatasetWriter(output_path, seq_length, shard_size) as writer:
+        print(f"Processing data in chunks of size {CHUNK_SIZE} with {workers} worker(s)")
+        tasks = ((i, chunk, seq_length, seed) for i, chunk in enumerate(chunks_from_iter(f, CHUNK_SIZE)))
+        for features, labels in _preprocess_chunks(tasks, workers):
+            writer.write(features, labels)
             chunks += 1
             if chunks % 100 == 0:
                 print(f"Processed {chunks} chunks")
-
-    print(f"Writing output to {output_file}")
-    with open(output_file, "wb") as f_out:
-        output = {"address_features": [t[0] for t in preprocessed],
-                  "address_labels": [t[1] for t in preprocessed]}
-        pickle.dump(output, f_out)
+        print(f"Writing dataset of {writer.num_examples} examples to {output_path}")
 
 
 if __name__ == "__main__":
@@ -107,6 +158,12 @@ if __name__ == "__main__":
     # which should provide enough diversity to train an RNN.
     parser = argparse.ArgumentParser()
     parser.add_argument('--paf-sample-path', required=True, help="Path to sample PAF addresses CSV file")
-    parser.add_argument('--preprocessed-output-path', required=True, help='Path to pickle output file for pre-processed data')
+    parser.add_argument('--preprocessed-output-path', required=True,
+                        help='Directory to write the sharded dataset of pre-processed data to')
+    parser.add_argument('--seq-length', type=int, default=SEQ_LENGTH, help="Length addresses are padded to")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help="Number of examples per shard")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Number of processes to use")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the variations of each address")
     args = parser.parse_args()
-    main(args.paf_sample_path, args.preprocessed_output_path)
+    main(args.paf_sample_path, args.preprocessed_output_path, args.seq_length, args.shard_size, args.workers,
+         args.seed)
@@ -1,36 +1,193 @@
+"""
+Streaming sampler for the PAF file, which has almost 31M lines, so it's never read into memory as a whole.
+
+The file is split into byte ranges on line boundaries that are scanned in parallel, each a chunk of lines at a time.
+Every line is given a pseudo random key from the seed and the byte offset of the line, and the sample is picked by key:
+    bernoulli: Each line is kept independently with the given probability, i.e. the lines whose key is below the
+        probability scaled to the key range
+    reservoir: Exactly size lines (or every line if there are fewer) uniformly at random, i.e. the size lines with the
+        smallest keys. Each range only keeps its own smallest keys so memory is bounded by the size of the sample.
+Since the keys don't depend on how the file is split up, the sample is the same for a given seed whatever the number
+of workers. It's written out ordered by key, which shuffles it as the PAF data is sorted alphabetically.
+
+Reservoir samples can be stratified by postcode area (the leading letters of the postcode), in which case size lines
+are sampled from each area so small areas are as well represented as big ones.
+"""
 import argparse
-import random
+import csv
+import heapq
+import os
+import re
+from collections import defaultdict
+from multiprocessing import Pool
 
-import pandas as pd
+import numpy as np
 
-from address_parser.paf.util import chunks_from_iter, csv_records_to_dicts
+from address_parser.paf import PAF_SCHEMA
 
 CHUNK_SIZE = 10000
+METHODS = ["bernoulli", "reservoir"]
+SAMPLE_PROPORTION = 0.02
+PAF_ENCODING = "windows-1252"
+_KEY_RANGE = 2 ** 64
+_POSTCODE_AREA_RE = re.compile(rb"\s*\"?([A-Za-z]*)")
+
+
+def _splitmix64(x):
+    # Well mixed 64 bit hash, numpy uint64 arithmetic wraps around as needed
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def line_keys(offsets, seed):
+    """
+    Pseudo random uint64 keys of the lines starting at the given byte offsets
+    """
+    seed_hash = _splitmix64(np.array([seed], dtype=np.uint64))[0]
+    return _splitmix64(np.asarray(offsets, dtype=np.uint64) ^ seed_hash)
+
+
+def postcode_area(line):
+    """
+    Leading letters of the postcode, the first field of a PAF line, upper cased
+    """
+    return _POSTCODE_AREA_RE.match(line).group(1).upper().decode("ascii")
+
+
+def byte_ranges(path, n):
+    """
+    Splits a file into up to n (start, end) byte ranges of about the same size, each starting at the start of a line
+    """
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, "rb") as f:
+        for i in range(1, n):
+            # Move to the start of the first line that starts at or after the even split
+            f.seek(max(size * i // n - 1, 0))
+            f.readline()
+            if starts[-1] < f.tell() < size:
+                starts.append(f.tell())
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def read_line_chunks(path, start, end, chunk_size=CHUNK_SIZE):
+    """
+    Yields chunks of up to chunk_size pairs of (byte offset, line) for the lines that start in [start, end), skipping
+    blank lines
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        offset = start
+        chunk = []
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                chunk.append((offset, line))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            offset += len(line)
+        if chunk:
+            yield chunk
+
+
+def _scan_range(task):
+    """
+    Returns the candidate lines of a byte range as (key, line) pairs, for reservoir sampling grouped by stratum
+    """
+    path, start, end, method, proportion, size, stratify, seed = task
+    threshold = np.uint64(min(int(proportion * _KEY_RANGE), _KEY_RANGE - 1)) if method == "bernoulli" else None
+    # Reservoirs are heaps of (-key, line) so the biggest key kept is at the top
+    reservoirs = defaultdict(list)
+    selected = []
+    lines_scanned = 0
+    for chunk in read_line_chunks(path, start, end):
+        lines_scanned += len(chunk)
+        keys = line_keys([offset for offset, _ in chunk], seed)
+        if method == "bernoulli":
+            selected.extend((int(keys[i]), chunk[i][1]) for i in np.nonzero(keys < threshold)[0])
+            continue
+        candidates = range(len(chunk))
+        if not stratify and len(reservoirs[None]) == size:
+            # Once the reservoir is full, only keys smaller than the biggest one kept can make it in
+            candidates = np.nonzero(keys < np.uint64(-reservoirs[None][0][0]))[0].tolist()
+        for i in candidates:
+            key, line = int(keys[i]), chunk[i][1]
+            reservoir = reservoirs[postcode_area(line) if stratify else None]
+            if len(reservoir) < size:
+                heapq.heappush(reservoir, (-key, line))
+            elif key < -reservoir[0][0]:
+                heapq.heapreplace(reservoir, (-key, line))
+    print(f"Scanned {lines_scanned} lines of bytes {start}-{end}")
+    if method == "bernoulli":
+        return selected
+    return dict((stratum, [(-neg_key, line) for neg_key, line in reservoir])
+                for stratum, reservoir in reservoirs.items())
+
+
+def sample_paf(path, method="bernoulli", proportion=SAMPLE_PROPORTION, size=None, stratify=False, workers=None,
+               seed=0):
+    """
+    :param path: Path to the PAF CSV file
+    :param method: One of METHODS
+    :param proportion: Probability of keeping each line for bernoulli sampling
+    :param size: Number of lines to sample for reservoir sampling, per postcode area if stratified
+    :param stratify: Sample size lines from each postcode area, reservoir sampling only
+    :param workers: Number of processes scanning the file in parallel, defaults to the number of cores
+    :param seed: Seed for the sample, the same seed always gives the same sample
+
+    Returns the sampled lines, decoded, in a random order determined by the seed.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown sampling method {method}, expected one of {METHODS}")
+    if method == "reservoir" and not size:
+        raise ValueError("Reservoir sampling needs a sample size")
+    if stratify and method != "reservoir":
+        raise ValueError("Only reservoir samples can be stratified")
+
+    workers = workers or os.cpu_count() or 1
+    tasks = [(path, start, end, method, proportion, size, stratify, seed) for start, end in byte_ranges(path, workers)]
+    if len(tasks) > 1:
+        with Pool(min(workers, len(tasks))) as pool:
+            results = pool.map(_scan_range, tasks)
+    else:
+        results = [_scan_range(task) for task in tasks]
 
+    if method == "bernoulli":
+        selected = [candidate for result in results for candidate in result]
+    else:
+        # The sample of each stratum is made up of the smallest keys across every range
+        strata = defaultdict(list)
+        for result in results:
+            for stratum, candidates in result.items():
+                strata[stratum].extend(candidates)
+        selected = [c for candidates in strata.values() for c in heapq.nsmallest(size, candidates)]
+    selected.sort()
+    return [line.decode(PAF_ENCODING).strip() for _, line in selected]
 
-def _get_sample(file_path, sample_proportion=0.02):
-    records = []
-    chunks_processed = 0
-    with open(file_path, "r", encoding='windows-1252') as f:
-        for chunk in chunks_from_iter(f.readlines(), CHUNK_SIZE):
-            records.extend(random.sample(chunk, int(len(chunk) * sample_proportion)))
-            chunks_processed += 1
-            if chunks_processed % 100 == 0:
-                print(f"Processed {chunks_processed} chunks")
 
-    return csv_records_to_dicts(records)
+def write_sample(lines, output_path):
+    """
+    Writes sampled lines as a CSV file with a header of the PAF_SCHEMA fields
+    """
+    with open(output_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(PAF_SCHEMA)
+        for line in lines:
+            fields = line.split(",")[:len(PAF_SCHEMA)]
+            writer.writerow(fields + [""] * (len(PAF_SCHEMA) - len(fields)))
 
 
-def main(paf_input_path, output_path):
-    # Get a sample of the PAF records
-    print(f"Getting sample of PAF addresses.")
-    records = _get_sample(paf_input_path)
-    # Shuffle them to avoid any sensitivity around ordering, as the PAF data
-    # is sorted alphabetically.
-    random.shuffle(records)
-    # Write output to CSV to be pre-processed.
-    print(f"Writing sample of size {len(records)} to {output_path}")
-    pd.DataFrame(records).to_csv(output_path, index=False, encoding='utf-8')
+def main(paf_input_path, output_path, method="bernoulli", proportion=SAMPLE_PROPORTION, size=None, stratify=False,
+         workers=None, seed=0):
+    print(f"Getting {method} sample of PAF addresses{' stratified by postcode area' if stratify else ''}")
+    lines = sample_paf(paf_input_path, method, proportion, size, stratify, workers, seed)
+    print(f"Writing sample of size {len(lines)} to {output_path}")
+    write_sample(lines, output_path)
 
 
 if __name__ == "__main__":
@@ -39,5 +196,18 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--paf-input-path', required=True, help="Path to PAF CSV file")
     parser.add_argument('--sample-output-path', required=True, help="Output path to save PAF sample CSV file")
+    parser.add_argument('--method', default="bernoulli", choices=METHODS, help="Sampling method")
+    parser.add_argument('--proportion', type=float, default=SAMPLE_PROPORTION,
+                        help="Proportion of addresses to sample with bernoulli sampling")
+    parser.add_argument('--size', type=int,
+                        help="Number of addresses to sample with reservoir sampling, per postcode area if stratified")
+    parser.add_argument('--stratify', action="store_true", help="Sample --size addresses from every postcode area")
+    parser.add_argument('--workers', type=int, help="Number of processes to scan the file with, defaults to all cores")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the sample")
     args = parser.parse_args()
-    main(args.paf_input_path, args.sample_output_path)
+    if args.method == "reservoir" and not args.size:
+        parser.error("--size is required for reservoir sampling")
+    if args.stratify and args.method != "reservoir":
+        parser.error("--stratify is only supported with reservoir sampling")
+    main(args.paf_input_path, args.sample_output_path, args.method, args.proportion, args.size, args.stratify,
+         args.workers, args.seed)
@@ -1,8 +1,31 @@
 import random
+from collections import namedtuple
+
 import numpy as np
 
-from address_parser.paf import PAF_SCHEMA, AddressField, VOCAB_CHAR_TO_IDX, PADDING_CHAR, ADDRESS_FIELD_CLASSES, \
-    SEPARATORS, STREET_VARIANTS, AVENUE_VARIANTS, ROAD_VARIANTS
+from address_parser.paf import PAF_SCHEMA, AddressField, VOCAB, VOCAB_CHAR_TO_IDX, PADDING_CHAR, \
+    ADDRESS_FIELD_CLASSES, SEPARATORS, ADDRESS_LAYOUTS, COUNTRY_VARIANTS, FIELD_VARIANTS
+
+# Every vocabulary character is ASCII, so a 256 entry lookup table maps each byte straight to its vocabulary index.
+# Upper case letters map to the index of their lower case equivalent and bytes outside the vocabulary to _INVALID_IDX.
+_INVALID_IDX = 255
+_BYTE_TO_IDX = np.full(256, _INVALID_IDX, dtype=np.uint8)
+for _c, _idx in VOCAB_CHAR_TO_IDX.items():
+    _BYTE_TO_IDX[ord(_c)] = _idx
+    _BYTE_TO_IDX[ord(_c.upper())] = _idx
+# Reverse lookup from vocabulary index to the (lower case) byte
+_IDX_TO_BYTE = np.array([ord(c) for c in VOCAB], dtype=np.uint8)
+_PADDING_IDX = VOCAB_CHAR_TO_IDX[PADDING_CHAR]
+_PADDING_CLASS = ADDRESS_FIELD_CLASSES[AddressField.PADDING.value]
+_SEPARATOR_CLASS = ADDRESS_FIELD_CLASSES[AddressField.SEPARATOR.value]
+# Fields of a record that addresses are laid out from
+_LAYOUT_FIELDS = sorted(set(f for layout in ADDRESS_LAYOUTS for f in layout) - {AddressField.COUNTRY.value})
+
+# encoded: uint8 array of shape (n, seq_length) of vocabulary indexes, padded with the padding char index
+# text: All normalised addresses concatenated, address i is text[offsets[i]:offsets[i + 1]]
+# offsets: int64 array of length n + 1 of the start of each address in text. Position j of encoded row i is the
+#   character at text[offsets[i] + j].
+EncodedAddresses = namedtuple("EncodedAddresses", ["encoded", "text", "offsets"])
 
 
 def chunks_from_iter(it, n, full_chunks_only=False):
@@ -30,195 +53,94 @@ def csv_records_to_dicts(records):
     return dict_records
 
 
-def _map_street_variants(thoroughfare_desc):
-    for s in STREET_VARIANTS:
-        if s in thoroughfare_desc:
-            return thoroughfare_desc.replace(s, random.choice(STREET_VARIANTS))
+def _map_variants(value, variant_groups, rng=random):
+    # Values with no variant in any of the groups, e.g. streets that are lanes or closes, are kept as they are
+    for variants in variant_groups:
+        for v in variants:
+            if v in value:
+                return value.replace(v, rng.choice(variants))
+    return value
+
 
-    for s in AVENUE_VARIANTS:
-        if s in thoroughfare_desc:
-            return thoroughfare_desc.replace(s, random.choice(AVENUE_VARIANTS))
+def _draw_layout(address, rng):
+    """
+    Draws a layout, separator and variations of an address. Returns the list of (value, field) pairs of the populated
+    fields in the order of the layout, along with the separator.
+    """
+    layout = ADDRESS_LAYOUTS[rng.choice(range(len(ADDRESS_LAYOUTS)))]
+    values = dict(address)
+    values[AddressField.COUNTRY.value] = rng.choice(COUNTRY_VARIANTS)
+    sep = rng.choice(SEPARATORS)
+    for field, variant_groups in FIELD_VARIANTS.items():
+        values[field] = _map_variants(values[field], variant_groups, rng)
+    return [(values[field], field) for field in layout if values[field]], sep
 
-    for s in ROAD_VARIANTS:
-        if s in thoroughfare_desc:
-            return thoroughfare_desc.replace(s, random.choice(ROAD_VARIANTS))
 
+def shuffle_components(address, rng=None):
+    """
+    :param address: Dict of address fields to lower case values
+    :param rng: random.Random to draw the variation from, defaults to the global random state
 
-def shuffle_components(address):
+    Lays out an address in one of ADDRESS_LAYOUTS, with the variations of FIELD_VARIANTS, as a list of the form
+    [(<address_part_1>, <address_part_1_label>), (<separator>, "separator"), .... ]
+    """
     # TODO: Remove duplicate separators at random when a field is missing
-    choice = random.choice(range(10))
-    # TODO: Maybe more variations of country, also think about ways to include NI, Wales, England.
-    #  Also consider getting rid of country altogether.
-    country = random.choice(["uk", "u.k", "u.k.", "united kingdom", "united k", "united k."])
-    sep = random.choice(SEPARATORS)
-
-    # Randomly map street, avenue, road to equivalent representations to build robustness
-    thoroughfare_desc = address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value]
-    address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value] = _map_street_variants(thoroughfare_desc)
-
-    # Different variations of address, all equally likely
-    if choice == 0:
-        # Full address, typical ordering
-        address_parts = [
-            (address[AddressField.SUB_BUILDING_NAME.value], AddressField.SUB_BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NAME.value], AddressField.BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NUMBER.value], AddressField.BUILDING_NUMBER.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value], AddressField.THOROUGHFARE_AND_DESCRIPTOR.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.DEPENDENT_LOCALITY.value], AddressField.DEPENDENT_LOCALITY.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTTOWN.value], AddressField.POSTTOWN.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTCODE.value], AddressField.POSTCODE.value),
-            (sep, AddressField.SEPARATOR.value),
-            (country, AddressField.COUNTRY.value),
-        ]
-    elif choice == 1:
-        # No sub-building name
-        address_parts = [
-            (address[AddressField.BUILDING_NAME.value], AddressField.BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NUMBER.value], AddressField.BUILDING_NUMBER.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value], AddressField.THOROUGHFARE_AND_DESCRIPTOR.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.DEPENDENT_LOCALITY.value], AddressField.DEPENDENT_LOCALITY.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTTOWN.value], AddressField.POSTTOWN.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTCODE.value], AddressField.POSTCODE.value),
-            (sep, AddressField.SEPARATOR.value),
-            (country, AddressField.COUNTRY.value),
-        ]
-    elif choice == 2:
-        # No dependent locality
-        address_parts = [
-            (address[AddressField.SUB_BUILDING_NAME.value], AddressField.SUB_BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NAME.value], AddressField.BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NUMBER.value], AddressField.BUILDING_NUMBER.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value], AddressField.THOROUGHFARE_AND_DESCRIPTOR.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTTOWN.value], AddressField.POSTTOWN.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTCODE.value], AddressField.POSTCODE.value),
-            (sep, AddressField.SEPARATOR.value),
-            (country, AddressField.COUNTRY.value),
-        ]
-    elif choice == 3:
-        # No sub-building name or dependent locality
-        address_parts = [
-            (address[AddressField.BUILDING_NAME.value], AddressField.BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NUMBER.value], AddressField.BUILDING_NUMBER.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value], AddressField.THOROUGHFARE_AND_DESCRIPTOR.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTTOWN.value], AddressField.POSTTOWN.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTCODE.value], AddressField.POSTCODE.value),
-            (sep, AddressField.SEPARATOR.value),
-            (country, AddressField.COUNTRY.value),
-        ]
-    elif choice == 4:
-        # No post town
-        address_parts = [
-            (address[AddressField.SUB_BUILDING_NAME.value], AddressField.SUB_BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NAME.value], AddressField.BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NUMBER.value], AddressField.BUILDING_NUMBER.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value], AddressField.THOROUGHFARE_AND_DESCRIPTOR.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.DEPENDENT_LOCALITY.value], AddressField.DEPENDENT_LOCALITY.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTCODE.value], AddressField.POSTCODE.value),
-            (sep, AddressField.SEPARATOR.value),
-            (country, AddressField.COUNTRY.value),
-        ]
-    elif choice == 5:
-        # No post town or dependent locality
-        address_parts = [
-            (address[AddressField.SUB_BUILDING_NAME.value], AddressField.SUB_BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NAME.value], AddressField.BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NUMBER.value], AddressField.BUILDING_NUMBER.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value], AddressField.THOROUGHFARE_AND_DESCRIPTOR.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTCODE.value], AddressField.POSTCODE.value),
-            (sep, AddressField.SEPARATOR.value),
-            (country, AddressField.COUNTRY.value),
-        ]
-    elif choice == 6:
-        # No country
-        address_parts = [
-            (address[AddressField.SUB_BUILDING_NAME.value], AddressField.SUB_BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NAME.value], AddressField.BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NUMBER.value], AddressField.BUILDING_NUMBER.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value], AddressField.THOROUGHFARE_AND_DESCRIPTOR.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.DEPENDENT_LOCALITY.value], AddressField.DEPENDENT_LOCALITY.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTTOWN.value], AddressField.POSTTOWN.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTCODE.value], AddressField.POSTCODE.value),
-        ]
-    elif choice == 7:
-        # No country or sub-building name
-        address_parts = [
-            (address[AddressField.BUILDING_NAME.value], AddressField.BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NUMBER.value], AddressField.BUILDING_NUMBER.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value], AddressField.THOROUGHFARE_AND_DESCRIPTOR.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.DEPENDENT_LOCALITY.value], AddressField.DEPENDENT_LOCALITY.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTTOWN.value], AddressField.POSTTOWN.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTCODE.value], AddressField.POSTCODE.value),
-        ]
-    elif choice == 8:
-        # No country or sub-building name or dependent locality
-        address_parts = [
-            (address[AddressField.BUILDING_NAME.value], AddressField.BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NUMBER.value], AddressField.BUILDING_NUMBER.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value], AddressField.THOROUGHFARE_AND_DESCRIPTOR.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTTOWN.value], AddressField.POSTTOWN.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTCODE.value], AddressField.POSTCODE.value),
-        ]
-    else:
-        # No country or post town
-        address_parts = [
-            (address[AddressField.SUB_BUILDING_NAME.value], AddressField.SUB_BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NAME.value], AddressField.BUILDING_NAME.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.BUILDING_NUMBER.value], AddressField.BUILDING_NUMBER.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.THOROUGHFARE_AND_DESCRIPTOR.value], AddressField.THOROUGHFARE_AND_DESCRIPTOR.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.DEPENDENT_LOCALITY.value], AddressField.DEPENDENT_LOCALITY.value),
-            (sep, AddressField.SEPARATOR.value),
-            (address[AddressField.POSTCODE.value], AddressField.POSTCODE.value),
-        ]
-
-    return remove_empty_fields(address_parts)
+    parts, sep = _draw_layout(address, rng or random)
+    address_parts = []
+    for part in parts:
+        if address_parts:
+            address_parts.append((sep, AddressField.SEPARATOR.value))
+        address_parts.append(part)
+    return address_parts
+
+
+def augment_addresses(address_dicts, seq_length, rng=None):
+    """
+    :param address_dicts: Dicts of PAF fields to values, as returned by csv_records_to_dicts
+    :param seq_length: Width of the encoded matrices, longer addresses are truncated
+    :param rng: random.Random to draw the variations from, defaults to the global random state
+
+    Lays out a batch of addresses as shuffle_components does and encodes them, returning uint8 matrices of shape
+    (n, seq_length) of the encoded addresses and the class of each character, the same as encode_address_and_labels
+    gives for each address. Labels are repeated from the length of each field rather than built a character at a time.
+    """
+    rng = rng or random
+    texts = []
+    field_classes = []
+    field_lengths = []
+    for address in address_dicts:
+        # Get rid of unneeded address fields and make all fields lower case
+        address = dict((field, (address.get(field) or "").lower()) for field in _LAYOUT_FIELDS)
+        parts, sep = _draw_layout(address, rng)
+        texts.append(sep.join(value for value, _ in parts))
+        for i, (value, field) in enumerate(parts):
+            if i:
+                field_classes.append(_SEPARATOR_CLASS)
+                field_lengths.append(len(sep))
+            field_classes.append(ADDRESS_FIELD_CLASSES[field])
+            field_lengths.append(len(value))
+
+    n = len(texts)
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=n)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # UTF-32 gives a code point per character, anything past ASCII isn't in the vocabulary
+    code_points = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+    char_idxes = _BYTE_TO_IDX[np.minimum(code_points, _INVALID_IDX)]
+    char_classes = np.repeat(np.array(field_classes, dtype=np.uint8), field_lengths)
+
+    rows = np.repeat(np.arange(n), lengths)
+    cols = np.arange(len(char_idxes)) - offsets[rows]
+    in_seq = cols < seq_length
+    if (char_idxes[in_seq] == _INVALID_IDX).any():
+        row = rows[in_seq][char_idxes[in_seq] == _INVALID_IDX][0]
+        raise KeyError(f"Address contains characters outside the vocabulary: {texts[row][:seq_length]!r}")
+
+    features = np.full((n, seq_length), _PADDING_IDX, dtype=np.uint8)
+    labels = np.full((n, seq_length), _PADDING_CLASS, dtype=np.uint8)
+    features[rows[in_seq], cols[in_seq]] = char_idxes[in_seq]
+    labels[rows[in_seq], cols[in_seq]] = char_classes[in_seq]
+    return features, labels
 
 
 def remove_empty_fields(address_parts):
@@ -253,37 +175,82 @@ def split_component_chars(address_parts):
     return char_arr
 
 
+def normalise_address_str(address):
+    """
+    Lower case and remove any characters not in vocabulary. The characters of the normalised string line up with the
+    positions of the encoded address.
+    """
+    return "".join(c for c in address.lower() if c in VOCAB_CHAR_TO_IDX)
+
+
 def encode_address_str(address, seq_length):
     """
     encode a plain address string
     """
-    # Lower case and remove any characters not in vocabulary
-    address = "".join(c for c in address.lower() if c in VOCAB_CHAR_TO_IDX)
-    # The _encode_address expects tuples of (char, label), but in this case we don't care about labels.
-    with_dummy_labels = [(c, random.random()) for c in address]
-    return _encode_address(with_dummy_labels, seq_length)
+    return encode_addresses([address], seq_length).encoded[0]
+
+
+def encode_addresses(addresses, seq_length):
+    """
+    :param addresses: List of raw address strings
+    :param seq_length: Width of the encoded matrix, longer addresses are truncated
+
+    Encodes a batch of addresses in one go into an EncodedAddresses tuple. Characters outside the vocabulary are
+    dropped, the same as normalise_address_str.
+    """
+    # Nothing outside ASCII is in the vocabulary so those characters can be dropped by the codec before the lookup.
+    raw = [address.lower().encode("ascii", "ignore") for address in addresses]
+    raw_offsets = np.zeros(len(raw) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, raw), dtype=np.int64, count=len(raw)), out=raw_offsets[1:])
+    return encode_address_buffer(np.frombuffer(b"".join(raw), dtype=np.uint8), raw_offsets, seq_length)
+
+
+def encode_address_buffer(buffer, raw_offsets, seq_length):
+    """
+    :param buffer: uint8 array of the bytes of all addresses concatenated
+    :param raw_offsets: int64 array of length n + 1 with the start of each address in the buffer
+    :param seq_length: Width of the encoded matrix, longer addresses are truncated
+
+    Vectorised encoding of addresses that are already laid out in a single byte buffer, with every character mapped
+    through the lookup table in one operation and scattered into a preallocated padded matrix.
+    """
+    n = len(raw_offsets) - 1
+    char_idxes = _BYTE_TO_IDX[buffer]
+    in_vocab = char_idxes != _INVALID_IDX
+    rows = np.repeat(np.arange(n), np.diff(raw_offsets))[in_vocab]
+    char_idxes = char_idxes[in_vocab]
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+    # Position of each remaining character within its own address
+    cols = np.arange(len(char_idxes)) - offsets[rows]
+    in_seq = cols < seq_length
+
+    encoded = np.full((n, seq_length), _PADDING_IDX, dtype=np.uint8)
+    encoded[rows[in_seq], cols[in_seq]] = char_idxes[in_seq]
+    text = _IDX_TO_BYTE[char_idxes].tobytes().decode("ascii")
+    return EncodedAddresses(encoded, text, offsets)
 
 
 def _encode_address(address_char_parts, seq_length):
     """
     address_parts: list of the form [(<char_1>, <char_1_label>), .... ]
 
-    return numpy array of length seq_length with the mapped integer of each character, filling the rest of the array
-    with the dedicated padding index.
+    return uint8 numpy array of length seq_length with the mapped integer of each character, filling the rest of the
+    array with the dedicated padding index.
     """
     address = "".join(t[0] for t in address_char_parts)
     # Truncate past seq_length
     address = address[:seq_length]
     # Initialise array with all padding chars (encoded as integer index)
-    address_arr = [VOCAB_CHAR_TO_IDX[PADDING_CHAR]] * seq_length
-    char_idxes = [VOCAB_CHAR_TO_IDX[c] for c in address]
-    i = 0
+    address_arr = np.full(seq_length, _PADDING_IDX, dtype=np.uint8)
     # Replace padding char with address char for the length of the address.
-    for c_idx in char_idxes:
-        address_arr[i] = c_idx
-        i += 1
+    char_idxes = _BYTE_TO_IDX[np.frombuffer(address.encode("ascii"), dtype=np.uint8)]
+    if (char_idxes == _INVALID_IDX).any():
+        raise KeyError(f"Address contains characters outside the vocabulary: {address!r}")
+    address_arr[:len(address)] = char_idxes
 
-    return np.array(address_arr)
+    return address_arr
 
 
 def _encode_labels(address_char_parts, seq_length):
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import sqlite3
+from collections import OrderedDict, defaultdict
+
+# Number of parsed addresses kept in the in-memory LRU in front of the on-disk store
+MEMORY_CACHE_SIZE = 100000
+# Keep each lookup below SQLite's limit on the number of query parameters
+_SQLITE_MAX_PARAMS = 500
+
+
+def model_fingerprint(model):
+    """
+    Hash of the model weights and sequence length, which between them determine what a model predicts. Two loads of
+    the same .pt file produce the same fingerprint, while any retrained or quantized model gets a new one.
+    """
+    # Exported models carry the fingerprint of the checkpoint they were exported from
+    fingerprint = getattr(model, "fingerprint", None)
+    if fingerprint is not None:
+        return fingerprint
+    h = hashlib.sha1()
+    h.update(str(model.seq_length).encode())
+    for name, value in model.state_dict().items():
+        h.update(name.encode())
+        _hash_value(h, value)
+    return h.hexdigest()
+
+
+def _hash_value(h, value):
+    import torch
+    if torch.is_tensor(value):
+        value = value.dequantize() if value.is_quantized else value
+        h.update(value.detach().cpu().contiguous().numpy().tobytes())
+    elif isinstance(value, torch.ScriptObject):
+        # Quantized layers keep their weights packed in script objects, whose repr has a memory address in it, so
+        # the weights they unpack to are hashed instead
+        _hash_value(h, value.__getstate__())
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            _hash_value(h, item)
+    else:
+        h.update(repr(value).encode())
+
+
+class ParseCache:
+    """
+    Persistent cache of parsed address components keyed by the normalised address string (see
+    normalise_address_str) and the way it was parsed (padded, trimmed or packed, see parse_raw_addresses), backed by
+    an SQLite file and fronted by an in-memory LRU of up to memory_size entries.
+
+    The cache is tied to the fingerprint of the model it's opened with. Opening it with a different model throws away
+    everything parsed by the previous one, so stale parses are never returned. Hit and miss counts are kept in
+    stats().
+    """
+    def __init__(self, path, model, memory_size=MEMORY_CACHE_SIZE):
+        """
+        :param path: Path to the SQLite cache file, or ":memory:" for a cache that only lasts as long as this object
+        :param model: The model whose parses are cached
+        :param memory_size: Maximum number of entries in the in-memory LRU
+        """
+        self.fingerprint = model_fingerprint(model)
+        self._memory = OrderedDict()
+        self._memory_size = memory_size
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS parses (address TEXT PRIMARY KEY, components TEXT)")
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+            if row is None or row[0] != self.fingerprint:
+                self._db.execute("DELETE FROM parses")
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (self.fingerprint,))
+
+    def get_many(self, addresses):
+        """
+        :param addresses: Normalised address strings, which parse_raw_addresses prefixes with the way it parses them
+
+        Returns a dict of the addresses that are cached to a fresh copy of their parsed components.
+        """
+        found = {}
+        from_disk = set()
+        not_in_memory = []
+        for address in set(addresses):
+            components = self._memory.get(address)
+            if components is None:
+                not_in_memory.append(address)
+            else:
+                self._memory.move_to_end(address)
+                found[address] = components
+
+        for i in range(0, len(not_in_memory), _SQLITE_MAX_PARAMS):
+            chunk = not_in_memory[i:i + _SQLITE_MAX_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._db.execute(f"SELECT address, components FROM parses WHERE address IN ({placeholders})", chunk)
+            for address, components in rows:
+                components = json.loads(components)
+                self._remember(address, components)
+                found[address] = components
+                from_disk.add(address)
+
+        for address in addresses:
+            if address not in found:
+                self.misses += 1
+            elif address in from_disk:
+                self.disk_hits += 1
+            else:
+                self.memory_hits += 1
+
+        # Callers are free to modify the parsed components so never hand out the cached objects themselves
+        return dict((address, defaultdict(str, components)) for address, components in found.items())
+
+    def put_many(self, parsed):
+        """
+        :param parsed: Iterable of pairs of normalised address and parsed components
+        """
+        rows = []
+        for address, components in parsed:
+            components = dict(components)
+            self._remember(address, components)
+            rows.append((address, json.dumps(components)))
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO parses VALUES (?, ?)", rows)
+
+    def _remember(self, address, components):
+        self._memory[address] = components
+        self._memory.move_to_end(address)
+        while len(self._memory) > self._memory_size:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "hits": self.memory_hits + self.disk_hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+        }
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,141 @@
+"""
+Cascade of a small, fast model and a larger, more accurate one. The small model parses every address and only the
+addresses it isn't confident about are parsed again by the large model, so most addresses only pay for the small one.
+
+The confidence of a parse is that of its least confident component, and the confidence of a component is the lowest
+softmax probability the model gave any of its characters (see parse_raw_addresses with_confidence). Addresses below
+the threshold are escalated to the large model. Raising the threshold escalates more addresses, trading speed for
+accuracy, and the share of addresses escalated is kept as a running count.
+
+Run as a script to report the escalation rate, accuracy and speed of the cascade at a range of thresholds against each
+model alone, on a validation set laid out from a PAF sample (or synthetic records) where the true components are known.
+"""
+import argparse
+import time
+
+from address_parser.paf.util import csv_records_to_dicts
+from address_parser.rnn.rules import labelled_addresses
+from address_parser.rnn.util import PARSE_BATCH_SIZE, parse_raw_addresses, address_confidence
+
+# Parses with a confidence below this are escalated to the large model
+CONFIDENCE_THRESHOLD = 0.9
+EVALUATION_THRESHOLDS = [0.5, 0.7, 0.8, 0.9, 0.95, 0.99]
+NUM_EXAMPLES = 5000
+
+
+class Cascade:
+    """
+    Parses addresses with the small model and re-parses those below the confidence threshold with the large model,
+    keeping count of the share of addresses escalated. Both models should already be in eval mode.
+    """
+    def __init__(self, small_model, large_model, threshold=CONFIDENCE_THRESHOLD):
+        """
+        :param small_model: Fast model that parses every address
+        :param large_model: Accurate model that only parses the addresses the small model isn't confident about
+        :param threshold: Confidence between 0 and 1 below which an address is escalated. With 0 nothing is
+            escalated, with 1 almost everything is.
+        """
+        if not 0 <= threshold <= 1:
+            raise ValueError(f"Confidence threshold must be between 0 and 1, got {threshold}")
+        self.small_model = small_model
+        self.large_model = large_model
+        self.threshold = threshold
+        self.addresses = 0
+        self.escalated = 0
+
+    @property
+    def escalation_rate(self):
+        return self.escalated / self.addresses if self.addresses else 0.0
+
+    def stats(self):
+        return {
+            "addresses": self.addresses,
+            "escalated": self.escalated,
+            "escalation_rate": self.escalation_rate,
+            "threshold": self.threshold,
+        }
+
+    def parse(self, addresses, batch_size=PARSE_BATCH_SIZE, rules=None, with_confidence=False):
+        """
+        :param addresses: Iterable of raw address strings
+        :param batch_size: Number of addresses run through either model in one forward pass
+        :param rules: Optional RuleParser, addresses it parses skip both models
+        :param with_confidence: Return (components, confidences) pairs, as parse_raw_addresses does
+
+        Returns the parsed components of each address in the same order as the input, from the large model for the
+        escalated addresses and from the small model (or the rules) for the rest.
+        """
+        addresses = list(addresses)
+        parsed = parse_raw_addresses(addresses, self.small_model, batch_size, rules=rules, with_confidence=True)
+        escalate = [i for i, (_, confidences) in enumerate(parsed)
+                    if address_confidence(confidences) < self.threshold]
+        if escalate:
+            reparsed = parse_raw_addresses([addresses[i] for i in escalate], self.large_model, batch_size,
+                                           with_confidence=True)
+            for i, parse in zip(escalate, reparsed):
+                parsed[i] = parse
+        self.addresses += len(addresses)
+        self.escalated += len(escalate)
+        return parsed if with_confidence else [components for components, _ in parsed]
+
+
+def _timed_accuracy(parse, examples):
+    addresses = [address for address, _ in examples]
+    start = time.perf_counter()
+    parsed = parse(addresses)
+    elapsed = time.perf_counter() - start
+    correct = sum(p == expected for p, (_, expected) in zip(parsed, examples))
+    return correct / max(len(examples), 1), elapsed / max(len(examples), 1) * 10 ** 6
+
+
+def evaluate(small_model, large_model, examples, thresholds=EVALUATION_THRESHOLDS):
+    """
+    :param examples: Pairs of address strings and their true components, see labelled_addresses
+
+    Returns the share of addresses each model and the cascade at each threshold get every component right, how long
+    they take per address and the escalation rate of the cascade.
+    """
+    report = {}
+    for name, model in [("small", small_model), ("large", large_model)]:
+        accuracy, us_per_address = _timed_accuracy(lambda a: parse_raw_addresses(a, model), examples)
+        report[name] = {"accuracy": accuracy, "us_per_address": us_per_address}
+    report["cascade"] = []
+    for threshold in thresholds:
+        cascade = Cascade(small_model, large_model, threshold)
+        accuracy, us_per_address = _timed_accuracy(cascade.parse, examples)
+        report["cascade"].append({"accuracy": accuracy, "us_per_address": us_per_address, **cascade.stats()})
+    return report
+
+
+def main(small_model_path, large_model_path, paf_sample_path=None, num_examples=NUM_EXAMPLES, seed=0,
+         thresholds=EVALUATION_THRESHOLDS):
+    from address_parser.bench.synthetic import synthetic_records
+    from address_parser.rnn.checkpoint import load_model
+    small_model = load_model(small_model_path)
+    large_model = load_model(large_model_path)
+    if paf_sample_path:
+        with open(paf_sample_path, "r") as f:
+            records = csv_records_to_dicts(line for _, line in zip(range(num_examples), f))
+    else:
+        records = synthetic_records(num_examples, seed=seed)
+    report = evaluate(small_model, large_model, labelled_addresses(records, seed), thresholds)
+    for name in ["small", "large"]:
+        print(f"{name} model: accuracy {report[name]['accuracy']:.2%}, {report[name]['us_per_address']:.1f}us per "
+              f"address")
+    for result in report["cascade"]:
+        print(f"cascade at threshold {result['threshold']}: escalated {result['escalation_rate']:.1%}, accuracy "
+              f"{result['accuracy']:.2%}, {result['us_per_address']:.1f}us per address")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--small-model-path', required=True, help="Path to the fast model")
+    parser.add_argument('--large-model-path', required=True, help="Path to the accurate model")
+    parser.add_argument('--paf-sample-path', help="Validation PAF sample CSV, synthetic addresses are used if not given")
+    parser.add_argument('--num-examples', type=int, default=NUM_EXAMPLES, help="Number of validation addresses")
+    parser.add_argument('--thresholds', type=float, nargs="+", default=EVALUATION_THRESHOLDS,
+                        help="Confidence thresholds to evaluate the cascade at")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the layout of validation addresses")
+    args = parser.parse_args()
+    main(args.small_model_path, args.large_model_path, args.paf_sample_path, args.num_examples, args.seed,
+         args.thresholds)
@@ -0,0 +1,281 @@
+"""
+Versioned, weights-only model checkpoints and inference-only exports.
+
+A checkpoint is a dict of plain tensors and python values saved with torch.save:
+    format_version: CHECKPOINT_FORMAT_VERSION
+    config: Everything needed to rebuild the AddressRNN (see model_config), including the vocabulary and labels it
+        was trained with
+    fingerprint: model_fingerprint of the weights, used to match exports and parse caches to the checkpoint
+    state_dict: The model weights
+
+Unlike pickling the whole module, loading a checkpoint doesn't depend on the class path of the model or execute
+arbitrary pickled code, and on recent versions of torch the weights are memory-mapped rather than read up front. The
+exception is quantized models, whose packed weights can only be unpickled.
+
+Exports (see export.py) are TorchScript or ONNX artifacts for inference-only deployment. load_model picks the fastest
+backend available for a model: an ONNX export run with onnxruntime, then a TorchScript export, then the checkpoint
+itself in eager mode.
+
+torch is imported by the functions that need it rather than up front, so that scripts can import this module (e.g.
+for BACKENDS) without paying for torch until a model is actually loaded.
+"""
+import json
+import os
+import pickle
+import warnings
+import zipfile
+
+from address_parser.paf import VOCAB, ADDRESS_FIELD_IDX_TO_CLASS
+from address_parser.rnn.cache import model_fingerprint
+
+CHECKPOINT_FORMAT_VERSION = 1
+TORCHSCRIPT_SUFFIX = ".ts"
+ONNX_SUFFIX = ".onnx"
+BACKENDS = ["auto", "onnx", "torchscript", "eager"]
+# Name of the file holding the checkpoint config and fingerprint inside a TorchScript export
+_TORCHSCRIPT_CONFIG_FILE = "config.json"
+
+
+def model_config(model):
+    from torch import nn
+    return {
+        "vocab": list(VOCAB),
+        "labels": [ADDRESS_FIELD_IDX_TO_CLASS[i] for i in range(model.output_dim)],
+        "lstm_dim": model._lstm_dim,
+        "lstm_layers": model._lstm_layers,
+        "output_dim": model.output_dim,
+        "seq_length": model.seq_length,
+        "embedding_dim": model._embed.embedding_dim,
+        "drop_prob": model._dropout.p,
+        "batch_first": model._lstm.batch_first,
+        # Dynamic quantization swaps the linear layer for a quantized one, see quantize.py
+        "quantized": type(model._fc) is not nn.Linear,
+        # Models pickled before this was added were all trained padded
+        "sequence_layout": getattr(model, "sequence_layout", "padded"),
+    }
+
+
+def save_checkpoint(model, path):
+    import torch
+    checkpoint = {
+        "format_version": CHECKPOINT_FORMAT_VERSION,
+        "config": model_config(model),
+        "fingerprint": model_fingerprint(model),
+        "state_dict": model.state_dict(),
+    }
+    torch.save(checkpoint, path)
+
+
+def _torch_load(path, map_location, weights_only=True, mmap=True):
+    import torch
+    kwargs = {"weights_only": weights_only}
+    if mmap:
+        kwargs["mmap"] = True
+    try:
+        return torch.load(path, map_location=map_location, **kwargs)
+    except TypeError:
+        # Versions of torch before 1.13 (weights_only) and 2.1 (mmap) don't support these options
+        return torch.load(path, map_location=map_location)
+
+
+def model_from_checkpoint(checkpoint, map_location="cpu"):
+    """
+    :param checkpoint: Checkpoint dict, as saved by save_checkpoint
+    :param map_location: Device to run the model on. Quantized models only run on the CPU so are always left there.
+
+    Returns the model in eval mode
+    """
+    import torch
+    from address_parser.rnn.model import AddressRNN
+    if checkpoint["format_version"] > CHECKPOINT_FORMAT_VERSION:
+        raise ValueError(f"Checkpoint format version {checkpoint['format_version']} is newer than the supported "
+                         f"version {CHECKPOINT_FORMAT_VERSION}")
+    config = checkpoint["config"]
+    if config["vocab"] != list(VOCAB):
+        raise ValueError("Checkpoint was trained with a different vocabulary to the one used to encode addresses")
+    if config["labels"] != [ADDRESS_FIELD_IDX_TO_CLASS.get(i) for i in range(config["output_dim"])]:
+        raise ValueError("Checkpoint was trained with different labels to the address fields its outputs are read as")
+    model = AddressRNN(vocab=config["vocab"], lstm_dim=config["lstm_dim"], lstm_layers=config["lstm_layers"],
+                       output_dim=config["output_dim"], seq_length=config["seq_length"],
+                       embedding_dim=config["embedding_dim"], drop_prob=config["drop_prob"],
+                       batch_first=config["batch_first"])
+    if config["quantized"]:
+        from address_parser.rnn.quantize import quantize_model
+        model = quantize_model(model)
+    model.load_state_dict(checkpoint["state_dict"])
+    if not config["quantized"]:
+        # The model is built on the CPU, and loading the weights copies them into its parameters wherever they were
+        # loaded, so it has to be moved to the device itself
+        device = torch.device(map_location)
+        model.to(device)
+        model._train_on_gpu = device.type == "cuda"
+    model.sequence_layout = config.get("sequence_layout", "padded")
+    model.eval()
+    return model
+
+
+def _is_torchscript(path):
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as z:
+        return any(name.endswith("/constants.pkl") for name in z.namelist())
+
+
+class ExportedModel:
+    """
+    Wraps an inference-only export so it can be used in place of an AddressRNN with parse_raw_addresses. Exports take
+    batches of any width, so models trained on trimmed batches are parsed trimmed by default the same as their
+    checkpoints, but they can't run packed sequences, so packed=True isn't supported with them.
+    """
+    def __init__(self, config, fingerprint):
+        self.config = config
+        self.fingerprint = fingerprint
+        self.seq_length = config["seq_length"]
+        self.output_dim = config["output_dim"]
+        self._lstm_layers = config["lstm_layers"]
+        self._lstm_dim = config["lstm_dim"]
+        self._hidden_cache = {}
+        self.sequence_layout = config.get("sequence_layout", "padded")
+        if self.sequence_layout == "packed":
+            # Trimmed batches are the nearest to packed ones, with only a little padding after the shorter addresses
+            warnings.warn("Model was trained on packed sequences but exports can't run packed, so it's parsed trimmed "
+                          "and parses may be less accurate than with the checkpoint")
+            self.sequence_layout = "trimmed"
+
+    def cached_hidden(self, batch_size):
+        import torch
+        from address_parser.rnn.model import _normal_mode
+        if batch_size not in self._hidden_cache:
+            # Normal tensors, for the same reason as AddressRNN.cached_hidden
+            with _normal_mode():
+                self._hidden_cache[batch_size] = (
+                    torch.zeros((self._lstm_layers * 2, batch_size, self._lstm_dim)),
+                    torch.zeros((self._lstm_layers * 2, batch_size, self._lstm_dim))
+                )
+        return self._hidden_cache[batch_size]
+
+    def eval(self):
+        return self
+
+    def share_memory(self):
+        return self
+
+    def _run(self, x, h0, c0):
+        raise NotImplementedError
+
+    def forward(self, x, hidden, lengths=None):
+        if lengths is not None:
+            raise NotImplementedError("Exported models don't support packed sequences")
+        return self._run(x, *hidden), None
+
+    __call__ = forward
+
+
+class TorchScriptModel(ExportedModel):
+    def __init__(self, path, map_location="cpu"):
+        import torch
+        extra_files = {_TORCHSCRIPT_CONFIG_FILE: ""}
+        self._module = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+        meta = json.loads(extra_files[_TORCHSCRIPT_CONFIG_FILE])
+        super().__init__(meta["config"], meta["fingerprint"])
+
+    def _run(self, x, h0, c0):
+        return self._module(x, (h0, c0))[0]
+
+
+class OnnxModel(ExportedModel):
+    def __init__(self, path):
+        import onnxruntime
+        self._session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        meta = self._session.get_modelmeta().custom_metadata_map
+        super().__init__(json.loads(meta["config"]), meta["fingerprint"])
+
+    def _run(self, x, h0, c0):
+        import torch
+        out = self._session.run(None, {"x": x.cpu().numpy(), "h0": h0.numpy(), "c0": c0.numpy()})[0]
+        return torch.from_numpy(out)
+
+
+def _onnxruntime_available():
+    try:
+        import onnxruntime  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _is_checkpoint(checkpoint):
+    return isinstance(checkpoint, dict) and "format_version" in checkpoint
+
+
+def _read_checkpoint(path, map_location):
+    """
+    Returns the checkpoint dict saved at a path, or the model itself if it was pickled whole by older versions of
+    train.py
+    """
+    try:
+        return _torch_load(path, map_location)
+    except pickle.UnpicklingError:
+        # Pickled modules, and the packed weights of quantized models, can't be loaded weights-only
+        return _torch_load(path, map_location, weights_only=False, mmap=False)
+
+
+def _model_from_any(checkpoint, path, map_location):
+    if _is_checkpoint(checkpoint):
+        return model_from_checkpoint(checkpoint, map_location)
+    warnings.warn(f"{path} is a pickled model, convert it to a checkpoint with export.py for faster and safer loading")
+    checkpoint.eval()
+    return checkpoint
+
+
+def _load_any(path, map_location):
+    if path.endswith(ONNX_SUFFIX):
+        return OnnxModel(path)
+    if _is_torchscript(path):
+        return TorchScriptModel(path, map_location)
+    return _model_from_any(_read_checkpoint(path, map_location), path, map_location)
+
+
+def load_model(path, backend="auto", map_location="cpu"):
+    """
+    :param path: Path to a checkpoint, an export, or a pickled model saved by older versions of train.py
+    :param backend: One of BACKENDS. "auto" looks for exports saved next to a checkpoint by export.py (with the same
+    name and an ONNX_SUFFIX or TORCHSCRIPT_SUFFIX suffix) that were made from the same weights and uses the fastest
+    one available, falling back to the checkpoint. The other backends require the corresponding export to exist.
+    :param map_location: Device to load the model onto. Only eager and TorchScript models can run on GPU.
+
+    Returns a model in eval mode, ready to be used with parse_raw_addresses.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    if path.endswith(ONNX_SUFFIX) or path.endswith(TORCHSCRIPT_SUFFIX):
+        return _load_any(path, map_location)
+
+    stem = os.path.splitext(path)[0]
+    onnx_path = stem + ONNX_SUFFIX
+    torchscript_path = stem + TORCHSCRIPT_SUFFIX
+    if backend == "onnx":
+        return OnnxModel(onnx_path)
+    if backend == "torchscript":
+        return TorchScriptModel(torchscript_path, map_location)
+
+    from address_parser.rnn.model import AddressRNN
+    if _is_torchscript(path):
+        return TorchScriptModel(path, map_location)
+    checkpoint = _read_checkpoint(path, map_location)
+    model = _model_from_any(checkpoint, path, map_location)
+    if backend == "auto" and str(map_location) == "cpu" and isinstance(model, AddressRNN):
+        candidates = []
+        if os.path.exists(onnx_path) and _onnxruntime_available():
+            candidates.append(lambda: OnnxModel(onnx_path))
+        if os.path.exists(torchscript_path):
+            candidates.append(lambda: TorchScriptModel(torchscript_path, map_location))
+        if candidates:
+            # Checkpoints carry the fingerprint of their weights, only pickled models have to be hashed
+            fingerprint = checkpoint["fingerprint"] if _is_checkpoint(checkpoint) else model_fingerprint(model)
+        for load_export in candidates:
+            export = load_export()
+            # Ignore exports that are stale compared to the checkpoint
+            if export.fingerprint == fingerprint:
+                return export
+    return model
@@ -0,0 +1,104 @@
+"""
+Parsing of whole pandas or Arrow columns of addresses, returning a column per address component.
+
+The bytes of an Arrow string array are already laid out in a single buffer with an offset for the start of each
+address, which is exactly what encode_address_buffer takes, so the addresses are encoded straight from the array's
+buffers without a Python string per address. The components are cut out of the parsed text into the buffers of new
+Arrow string arrays in the same way (see component_columns), so there is no dict per address either.
+
+Null addresses give null components and empty addresses give empty components, and missing components of other
+addresses are empty strings, as in the other output formats. Non-ASCII characters are dropped from the UTF-8 bytes of
+each address, the same as encode_addresses drops them.
+"""
+import numpy as np
+
+from address_parser.paf.util import encode_address_buffer
+from address_parser.rnn.output import COMPONENT_FIELDS
+from address_parser.rnn.util import PARSE_BATCH_SIZE, parse_encoded_columns
+
+# Rows of an array encoded and parsed at a time, which bounds the memory used for the encoded addresses and
+# predictions however long the array is. Each window becomes a chunk of the output columns.
+COLUMN_WINDOW_SIZE = 65536
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("pyarrow is required to parse Arrow or pandas columns, install it with `pip install pyarrow`")
+    return pa
+
+
+def _array_buffers(array):
+    """
+    Returns the bytes and offsets of a string array as a uint8 buffer and int64 offsets of length n + 1 into it, with
+    null addresses empty and the array's own slice offset applied
+    """
+    _, offsets_buf, data_buf = array.buffers()
+    offsets_type = np.int64 if array.type.equals(_import_pyarrow().large_string()) else np.int32
+    offsets = np.frombuffer(offsets_buf, dtype=offsets_type)[array.offset:array.offset + len(array) + 1]
+    data = np.frombuffer(data_buf, dtype=np.uint8) if data_buf is not None else np.empty(0, dtype=np.uint8)
+    buffer = data[offsets[0]:offsets[-1]]
+    raw_offsets = offsets.astype(np.int64) - offsets[0]
+    if array.null_count:
+        # Null slots usually take no bytes, but nothing guarantees it, so whatever bytes they have are dropped
+        lengths = np.diff(raw_offsets)
+        valid = array.is_valid().to_numpy(zero_copy_only=False)
+        buffer = buffer[np.repeat(valid, lengths)]
+        raw_offsets = np.zeros(len(array) + 1, dtype=np.int64)
+        np.cumsum(np.where(valid, lengths, 0), out=raw_offsets[1:])
+    return buffer, raw_offsets
+
+
+def _parse_window(array, model, batch_size, dynamic_length, packed):
+    pa = _import_pyarrow()
+    buffer, raw_offsets = _array_buffers(array)
+    addresses_enc = encode_address_buffer(buffer, raw_offsets, model.seq_length)
+    columns = parse_encoded_columns(addresses_enc, model, COMPONENT_FIELDS, batch_size, dynamic_length, packed)
+    null_bitmap = None
+    if array.null_count:
+        null_bitmap = pa.py_buffer(np.packbits(array.is_valid().to_numpy(zero_copy_only=False), bitorder="little"))
+    return [
+        pa.StringArray.from_buffers(len(array), pa.py_buffer(value_offsets.astype(np.int32)), pa.py_buffer(data),
+                                    null_bitmap, array.null_count)
+        for value_offsets, data in (columns[field] for field in COMPONENT_FIELDS)
+    ]
+
+
+def parse_arrow(array, model, batch_size=PARSE_BATCH_SIZE, dynamic_length=None, packed=None):
+    """
+    :param array: Arrow array or chunked array of raw address strings. Other types are cast to strings.
+    :param model: Trained AddressRNN, which should already be in eval mode
+    :param batch_size, dynamic_length, packed: See parse_raw_addresses
+
+    Returns an Arrow table of the parsed components of each address, with a string column for each of
+    COMPONENT_FIELDS in the same order as the input.
+    """
+    pa = _import_pyarrow()
+    chunks = array.chunks if isinstance(array, pa.ChunkedArray) else [array]
+    columns = [[] for _ in COMPONENT_FIELDS]
+    for chunk in chunks:
+        if not (chunk.type.equals(pa.string()) or chunk.type.equals(pa.large_string())):
+            chunk = chunk.cast(pa.string())
+        for start in range(0, len(chunk), COLUMN_WINDOW_SIZE):
+            window = chunk.slice(start, COLUMN_WINDOW_SIZE)
+            for column, window_column in zip(columns, _parse_window(window, model, batch_size, dynamic_length,
+                                                                    packed)):
+                column.append(window_column)
+    return pa.table([pa.chunked_array(column, type=pa.string()) for column in columns], names=COMPONENT_FIELDS)
+
+
+def parse_series(series, model, batch_size=PARSE_BATCH_SIZE, dynamic_length=None, packed=None):
+    """
+    :param series: pandas Series of raw address strings, None and NaN are treated as nulls
+    :param model: Trained AddressRNN, which should already be in eval mode
+    :param batch_size, dynamic_length, packed: See parse_raw_addresses
+
+    Returns a DataFrame with the same index as the series and a column for each of COMPONENT_FIELDS, see parse_arrow.
+    """
+    pa = _import_pyarrow()
+    table = parse_arrow(pa.array(series, type=pa.string(), from_pandas=True), model, batch_size, dynamic_length,
+                        packed)
+    df = table.to_pandas()
+    df.index = series.index
+    return df
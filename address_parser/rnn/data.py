@@ -0,0 +1,122 @@
+"""
+Streaming training input, so a PAF sample of any size can be trained on without holding it in memory.
+
+AddressStream is an IterableDataset that reads the sample a chunk of lines at a time and lays out and encodes each chunk
+with augment_addresses as it's read, in DataLoader worker processes when there are any. Every worker reads its own
+byte range of the file. The variations of each address are drawn from a seed, the epoch and the position of the chunk,
+so every epoch trains on fresh variations of the addresses while a run with the same seed and number of workers can
+still be repeated exactly.
+
+Examples are shuffled within a window of shuffle_buffer examples rather than across the whole file, which is enough as
+samples written by sample.py are already in a random order. Memory use is bounded by the shuffle buffer and the
+batches prefetched by each worker, whatever the size of the sample.
+"""
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+from address_parser.paf import PAF_SCHEMA
+from address_parser.paf.sample import byte_ranges, read_line_chunks
+from address_parser.paf.util import augment_addresses, csv_records_to_dicts
+
+CHUNK_SIZE = 1000
+SHUFFLE_BUFFER = 20000
+# Batches each worker prepares ahead of the training loop
+PREFETCH_FACTOR = 4
+_HEADER = ",".join(PAF_SCHEMA)
+
+
+class AddressStream(IterableDataset):
+    """
+    Yields (features, labels) batches of uint8 tensors of shape (batch_size, seq_length). Only full batches are
+    yielded, so up to batch_size - 1 examples per worker are left out of each epoch.
+    """
+    def __init__(self, path, seq_length, batch_size, shuffle_buffer=SHUFFLE_BUFFER, chunk_size=CHUNK_SIZE, seed=0):
+        """
+        :param path: Path to a PAF sample CSV file, with or without a header
+        :param seq_length: Width of the encoded addresses
+        :param batch_size: Number of examples per batch
+        :param shuffle_buffer: Number of examples shuffled together
+        :param chunk_size: Number of lines read and preprocessed at a time
+        :param seed: Seed for the variations of each address and the shuffling
+        """
+        self.path = path
+        self.seq_length = seq_length
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """
+        Sets the epoch the next iteration draws variations for. DataLoader workers are started afresh for every
+        iteration, so they pick this up.
+        """
+        self.epoch = epoch
+
+    def _chunks(self, worker_id, num_workers):
+        """
+        Yields the encoded features and labels of each chunk of lines in this worker's byte range
+        """
+        ranges = byte_ranges(self.path, num_workers)
+        if worker_id >= len(ranges):
+            # The file is too small to give every worker a range
+            return
+        start, end = ranges[worker_id]
+        for i, chunk in enumerate(read_line_chunks(self.path, start, end, self.chunk_size)):
+            lines = [line.decode("utf-8") for _, line in chunk]
+            lines = [line for line in lines if line.strip() != _HEADER]
+            if not lines:
+                continue
+            rng = random.Random(f"{self.seed}:{self.epoch}:{worker_id}:{i}")
+            yield augment_addresses(csv_records_to_dicts(lines), self.seq_length, rng)
+
+    def _shuffled_batches(self, features, labels, rng):
+        """
+        Shuffles a window of examples, returning its full batches and the examples left over
+        """
+        order = rng.permutation(sum(len(f) for f in features))
+        features = np.concatenate(features)[order]
+        labels = np.concatenate(labels)[order]
+        end = len(order) - len(order) % self.batch_size
+        batches = [(torch.from_numpy(features[start:start + self.batch_size]),
+                    torch.from_numpy(labels[start:start + self.batch_size]))
+                   for start in range(0, end, self.batch_size)]
+        return batches, features[end:], labels[end:]
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        rng = np.random.default_rng([self.seed, self.epoch, worker_id])
+        features, labels = [], []
+        buffered = 0
+        for chunk_features, chunk_labels in self._chunks(worker_id, num_workers):
+            features.append(chunk_features)
+            labels.append(chunk_labels)
+            buffered += len(chunk_features)
+            if buffered >= max(self.shuffle_buffer, self.batch_size):
+                batches, rest_features, rest_labels = self._shuffled_batches(features, labels, rng)
+                yield from batches
+                features, labels, buffered = [rest_features], [rest_labels], len(rest_features)
+        if buffered >= self.batch_size:
+            yield from self._shuffled_batches(features, labels, rng)[0]
+
+
+def stream_loader(stream, workers=None, pin_memory=False):
+    """
+    :param stream: AddressStream
+    :param workers: Number of worker processes preprocessing batches, defaults to the number of cores less one for
+        the training loop. With 0 batches are preprocessed in the training process.
+    :param pin_memory: Copy batches to pinned memory, to speed up copying them to the GPU
+
+    DataLoader over the batches of the stream, with each worker prefetching PREFETCH_FACTOR batches so the training
+    loop doesn't have to wait for them.
+    """
+    workers = max((os.cpu_count() or 1) - 1, 0) if workers is None else workers
+    # The stream yields whole batches, so the DataLoader mustn't batch them again
+    return DataLoader(stream, batch_size=None, num_workers=workers, pin_memory=pin_memory,
+                      prefetch_factor=PREFETCH_FACTOR if workers else None)
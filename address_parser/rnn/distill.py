@@ -0,0 +1,292 @@
+"""
+Distils a trained AddressRNN (the teacher) into a much smaller one (the student) for low latency parsing on a CPU.
+
+The student has a single narrow LSTM layer and a smaller embedding, and trains on the teacher's per-character logits
+softened by a temperature, alongside the true labels. The soft targets carry how the teacher ranks the other classes
+too, e.g. that a character it labels as a locality could also be a post town, which a small model learns from much
+better than from the labels alone.
+
+Batches are streamed from a PAF sample (see AddressStream), from synthetic records drawn afresh every epoch (see
+bench/synthetic.py), or both interleaved. The student is laid out and parsed as train.py models are (see
+SEQUENCE_LAYOUTS), while the teacher is run the way it was trained, so a teacher trained on padded batches still sees
+its padding.
+
+Saves the student checkpoint and reports its accuracy and latency against the teacher on held out addresses.
+"""
+import argparse
+import json
+import random
+import time
+from itertools import zip_longest
+
+import numpy as np
+import torch
+from torch import nn, optim
+from torch.nn import functional as F
+
+from address_parser.bench.synthetic import synthetic_record, synthetic_records
+from address_parser.paf import VOCAB_CHAR_TO_IDX, PADDING_CHAR
+from address_parser.paf.util import augment_addresses, csv_records_to_dicts
+from address_parser.rnn import AddressRNN, train
+from address_parser.rnn.checkpoint import load_model, save_checkpoint
+from address_parser.rnn.data import AddressStream, stream_loader
+from address_parser.rnn.rules import labelled_addresses
+from address_parser.rnn.util import SEQUENCE_LAYOUTS, accuracy, parse_raw_address, parse_raw_addresses
+
+STUDENT_LSTM_DIM = 32
+STUDENT_LSTM_LAYERS = 1
+STUDENT_EMBEDDING_DIM = 8
+# A model this small learns far too slowly at the teacher's learning rate
+STUDENT_LR = 0.01
+# Softens the teacher's logits so the student sees how it ranks the classes other than the top one
+TEMPERATURE = 2.0
+# Weight of the loss against the teacher's soft targets, the rest goes to the loss against the true labels
+SOFT_LOSS_WEIGHT = 0.5
+EPOCHS = 3
+# Number of batches of fresh synthetic addresses per epoch
+SYNTHETIC_BATCHES = 200
+NUM_EVAL_EXAMPLES = 2000
+# Number of addresses parsed one at a time to measure the latency of a single request
+NUM_LATENCY_EXAMPLES = 200
+_PADDING_IDX = VOCAB_CHAR_TO_IDX[PADDING_CHAR]
+
+
+def student_model(seq_length, lstm_dim=STUDENT_LSTM_DIM, lstm_layers=STUDENT_LSTM_LAYERS,
+                  embedding_dim=STUDENT_EMBEDDING_DIM, train_on_gpu=False):
+    return AddressRNN(vocab=train.VOCAB, lstm_dim=lstm_dim, lstm_layers=lstm_layers, output_dim=train.OUTPUT_DIM,
+                      seq_length=seq_length, embedding_dim=embedding_dim, train_on_gpu=train_on_gpu,
+                      batch_first=True)
+
+
+def teacher_logits(teacher, X, lengths=None):
+    """
+    :param teacher: Trained AddressRNN in eval mode
+    :param X: Batch of encoded addresses, possibly trimmed to its longest address
+    :param lengths: Number of characters in each address of a trimmed batch
+
+    Returns the teacher's logits of shape (batch_size * width, output_dim), running the batch the way the teacher was
+    trained: padded back out to its seq_length, trimmed, or packed.
+    """
+    sequence_layout = getattr(teacher, "sequence_layout", "padded")
+    batch_size, width = X.shape
+    hidden = teacher.cached_hidden(batch_size)
+    with torch.no_grad():
+        if sequence_layout == "padded" and width < teacher.seq_length:
+            padded = torch.full((batch_size, teacher.seq_length), _PADDING_IDX, dtype=X.dtype, device=X.device)
+            padded[:, :width] = X
+            out, _ = teacher(padded, hidden)
+            return out.view(batch_size, teacher.seq_length, -1)[:, :width].reshape(-1, teacher.output_dim)
+        packed = sequence_layout == "packed" and lengths is not None
+        out, _ = teacher(X, hidden, torch.as_tensor(lengths).long() if packed else None)
+        return out
+
+
+def distill_step(student, teacher, optimizer, features, labels, lengths=None, packed=False,
+                 temperature=TEMPERATURE, soft_loss_weight=SOFT_LOSS_WEIGHT):
+    """
+    :param lengths: Number of characters in each address. When given padding is masked out of the loss and accuracy.
+    :param packed: Run the student on the batch as packed sequences, which needs the lengths
+    :param temperature: Temperature the logits of both models are softened by for the soft loss
+    :param soft_loss_weight: Weight of the loss against the teacher, between 0 and 1
+
+    Returns the loss and the accuracy of the student against the true labels, see train_step.
+    """
+    X = torch.as_tensor(features).long()
+    y = torch.as_tensor(labels).long()
+    if student._train_on_gpu:
+        X = X.cuda()
+        y = y.cuda()
+    soft_targets = teacher_logits(teacher, X, lengths)
+
+    hidden = student.init_hidden(len(X))
+    optimizer.zero_grad()
+    out, _ = student(X, hidden, torch.as_tensor(lengths).long() if packed else None)
+    y = y.reshape(-1)
+    if lengths is not None:
+        not_padding = y != train.PADDING_CLASS
+        out, y, soft_targets = out[not_padding], y[not_padding], soft_targets[not_padding]
+    # Scaled by the temperature squared so the gradients of the soft loss keep the same scale whatever the temperature
+    soft_loss = F.kl_div(F.log_softmax(out / temperature, dim=1), F.softmax(soft_targets / temperature, dim=1),
+                         reduction="batchmean") * temperature ** 2
+    hard_loss = F.cross_entropy(out, y)
+    loss = soft_loss_weight * soft_loss + (1 - soft_loss_weight) * hard_loss
+    loss.backward()
+
+    nn.utils.clip_grad_norm_(student.parameters(), train.CLIP)
+    optimizer.step()
+    return loss, accuracy(out, y)
+
+
+def synthetic_batches(num_batches, seq_length, batch_size, seed):
+    """
+    Yields (features, labels) batches of synthetic records laid out and encoded as in training
+    """
+    rng = random.Random(seed)
+    for _ in range(num_batches):
+        yield augment_addresses([synthetic_record(rng) for _ in range(batch_size)], seq_length, rng)
+
+
+def _interleave(*iterables):
+    for batches in zip_longest(*iterables):
+        yield from (batch for batch in batches if batch is not None)
+
+
+def distill(teacher, stream=None, synthetic_batches_per_epoch=SYNTHETIC_BATCHES, workers=None, seed=0,
+            sequence_layout=None, epochs=EPOCHS, temperature=TEMPERATURE, soft_loss_weight=SOFT_LOSS_WEIGHT):
+    """
+    :param teacher: Trained AddressRNN
+    :param stream: Optional AddressStream of a PAF sample to distil on
+    :param synthetic_batches_per_epoch: Number of batches of synthetic addresses to distil on every epoch, interleaved
+        with the stream
+    :param workers: Number of worker processes preprocessing the stream, see stream_loader
+    :param sequence_layout: How the student's batches are laid out, see train
+    :param temperature: Temperature the logits are softened by, see distill_step
+    :param soft_loss_weight: Weight of the loss against the teacher, see distill_step
+    """
+    if stream is None and not synthetic_batches_per_epoch:
+        raise ValueError("Nothing to distil on, pass a stream or some synthetic batches")
+    train_on_gpu = torch.cuda.is_available()
+    sequence_layout = sequence_layout or ("packed" if train_on_gpu else "trimmed")
+    if sequence_layout not in SEQUENCE_LAYOUTS:
+        raise ValueError(f"Unknown sequence layout {sequence_layout}, expected one of {SEQUENCE_LAYOUTS}")
+    teacher.eval()
+    student = student_model(teacher.seq_length, train_on_gpu=train_on_gpu)
+    student.sequence_layout = sequence_layout
+    print("Student architecture:")
+    print(student)
+
+    optimizer = optim.Adam(student.parameters(), lr=STUDENT_LR)
+    if train_on_gpu:
+        teacher.cuda()
+        student.cuda()
+
+    student.train()
+    loader = stream_loader(stream, workers, pin_memory=train_on_gpu) if stream is not None else None
+    print(f"Starting distillation on {sequence_layout} batches")
+    for e in range(epochs):
+        sources = []
+        if stream is not None:
+            stream.set_epoch(e)
+            sources.append(iter(loader))
+        if synthetic_batches_per_epoch:
+            sources.append(synthetic_batches(synthetic_batches_per_epoch, teacher.seq_length, train.BATCH_SIZE,
+                                             f"{seed}:{e}"))
+        batches_it = _interleave(*sources)
+        if sequence_layout != "padded":
+            batches_it = train.bucketed_batches(batches_it, np.random.default_rng(e))
+        batches = 0
+        examples = 0
+        loss = None
+        accs = []
+        epoch_start = time.perf_counter()
+        for batch in batches_it:
+            loss, acc = distill_step(student, teacher, optimizer, *batch, packed=sequence_layout == "packed",
+                                     temperature=temperature, soft_loss_weight=soft_loss_weight)
+            accs.append(acc)
+            batches += 1
+            examples += len(batch[0])
+            if batches % 10 == 0:
+                print(f"Finished distilling on {batches} batches in epoch {e}")
+                print(f"Loss so far is {loss.item()}")
+                print(f"Average accuracy is {round(np.average(accs) * 100)}%")
+        epoch_time = time.perf_counter() - epoch_start
+        print(f"Finished distillation for epoch {e}")
+        print(f"Loss at end of epoch {e} is {loss.item()}")
+        print(f"Distilled on {examples / epoch_time:.0f} samples/sec")
+
+    student.eval()
+    return student.cpu() if train_on_gpu else student
+
+
+def _latency(model, addresses):
+    # Each address parsed on its own, as a request to the parsing server would be
+    timings = []
+    for address in addresses:
+        start = time.perf_counter()
+        parse_raw_address(address, model)
+        timings.append(time.perf_counter() - start)
+    return [float(t) * 10 ** 6 for t in np.percentile(timings, [50, 95])]
+
+
+def compare(teacher, student, examples, num_latency_examples=NUM_LATENCY_EXAMPLES):
+    """
+    :param examples: Pairs of address strings and their true components, see labelled_addresses
+
+    Returns the share of addresses each model gets every component right, how often the student agrees with the
+    teacher, the latency of parsing a single address and the time per address when parsing in bulk.
+    """
+    addresses = [address for address, _ in examples]
+    report = {}
+    parsed = {}
+    for name, model in [("teacher", teacher), ("student", student)]:
+        start = time.perf_counter()
+        parsed[name] = parse_raw_addresses(addresses, model)
+        bulk_time = time.perf_counter() - start
+        p50, p95 = _latency(model, addresses[:num_latency_examples])
+        report[name] = {
+            "parameters": sum(p.numel() for p in model.parameters()),
+            "accuracy": sum(p == e for p, (_, e) in zip(parsed[name], examples)) / max(len(examples), 1),
+            "latency_p50_us": p50,
+            "latency_p95_us": p95,
+            "bulk_us_per_address": bulk_time / max(len(examples), 1) * 10 ** 6,
+        }
+    report["agreement"] = (sum(s == t for s, t in zip(parsed["student"], parsed["teacher"]))
+                           / max(len(examples), 1))
+    return report
+
+
+def main(teacher_path, student_output_path, paf_sample_file=None, synthetic_batches_per_epoch=SYNTHETIC_BATCHES,
+         eval_sample_file=None, workers=None, seed=0, sequence_layout=None, report_path=None, temperature=TEMPERATURE,
+         soft_loss_weight=SOFT_LOSS_WEIGHT):
+    teacher = load_model(teacher_path, backend="eager")
+    stream = None
+    if paf_sample_file:
+        stream = AddressStream(paf_sample_file, teacher.seq_length, train.BATCH_SIZE, chunk_size=train.CHUNK_SIZE,
+                               seed=seed)
+    student = distill(teacher, stream, synthetic_batches_per_epoch, workers, seed, sequence_layout,
+                      temperature=temperature, soft_loss_weight=soft_loss_weight)
+    print("Distillation complete")
+    print("Saving student..")
+    save_checkpoint(student, student_output_path)
+
+    if eval_sample_file:
+        with open(eval_sample_file, "r") as f:
+            records = csv_records_to_dicts(line for _, line in zip(range(NUM_EVAL_EXAMPLES), f))
+    else:
+        # A different seed to the synthetic batches distilled on
+        records = synthetic_records(NUM_EVAL_EXAMPLES, seed=f"{seed}:eval")
+    report = compare(teacher.cpu(), student, labelled_addresses(records, seed))
+    for name in ["teacher", "student"]:
+        r = report[name]
+        print(f"{name}: {r['parameters']} parameters, accuracy {r['accuracy']:.2%}, latency p50 "
+              f"{r['latency_p50_us']:.0f}us p95 {r['latency_p95_us']:.0f}us, bulk {r['bulk_us_per_address']:.0f}us "
+              f"per address")
+    print(f"Student agrees with the teacher on {report['agreement']:.2%} of addresses")
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    print("Done!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--teacher-path', required=True, help="Path to the trained model checkpoint to distil")
+    parser.add_argument('--student-output-path', required=True, help="Output path to save student checkpoint")
+    parser.add_argument('--paf-sample-path', help="Path to sample PAF addresses CSV file to distil on")
+    parser.add_argument('--synthetic-batches', type=int, default=SYNTHETIC_BATCHES,
+                        help="Number of batches of synthetic addresses to distil on per epoch")
+    parser.add_argument('--eval-sample-path',
+                        help="Held out PAF sample CSV to compare the models on, synthetic addresses if not given")
+    parser.add_argument('--report-path', help="Optional path to write the comparison report as JSON")
+    parser.add_argument('--workers', type=int,
+                        help="Number of processes preprocessing the sample, defaults to all cores but one")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the variations of each address")
+    parser.add_argument('--sequence-layout', choices=SEQUENCE_LAYOUTS,
+                        help="How the student's batches are laid out, defaults to packed on a GPU and trimmed otherwise")
+    parser.add_argument('--temperature', type=float, default=TEMPERATURE, help="Temperature of the soft targets")
+    parser.add_argument('--soft-loss-weight', type=float, default=SOFT_LOSS_WEIGHT,
+                        help="Weight of the loss against the teacher, the rest goes to the true labels")
+    args = parser.parse_args()
+    main(args.teacher_path, args.student_output_path, args.paf_sample_path, args.synthetic_batches,
+         args.eval_sample_path, args.workers, args.seed, args.sequence_layout, args.report_path, args.temperature,
+         args.soft_loss_weight)
@@ -0,0 +1,89 @@
+"""
+Converts a trained model into a weights-only checkpoint and optionally exports it for inference-only deployment as
+TorchScript and/or ONNX. Exports are written next to the checkpoint so that load_model can pick them up.
+"""
+import argparse
+import inspect
+import json
+import os
+
+import torch
+from torch import nn
+
+from address_parser.rnn.checkpoint import (
+    ONNX_SUFFIX, TORCHSCRIPT_SUFFIX, _TORCHSCRIPT_CONFIG_FILE, load_model, model_config, save_checkpoint
+)
+from address_parser.rnn.cache import model_fingerprint
+
+EXPORT_FORMATS = ["torchscript", "onnx"]
+ONNX_OPSET = 14
+
+
+class _OnnxWrapper(nn.Module):
+    # ONNX inputs have to be flat tensors rather than a tuple for the hidden state
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, h0, c0):
+        return self.model(x, (h0, c0))[0]
+
+
+def _example_inputs(model, batch_size=2):
+    x = torch.zeros((batch_size, model.seq_length), dtype=torch.long)
+    return x, model.init_hidden(batch_size)
+
+
+def export_torchscript(model, path):
+    x, hidden = _example_inputs(model)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, (x, hidden))
+    meta = {"config": model_config(model), "fingerprint": model_fingerprint(model)}
+    torch.jit.save(traced, path, _extra_files={_TORCHSCRIPT_CONFIG_FILE: json.dumps(meta)})
+
+
+def export_onnx(model, path):
+    if model_config(model)["quantized"]:
+        raise ValueError("Quantized models can't be exported to ONNX")
+    import onnx
+    x, (h0, c0) = _example_inputs(model)
+    wrapper = _OnnxWrapper(model).eval()
+    # The dynamo exporter, which takes dynamic_shapes rather than dynamic_axes, is the default on recent versions of
+    # torch, so the TorchScript one is asked for where there's a choice. Versions before 2.5 don't take the option.
+    kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(wrapper, (x, h0, c0), path, input_names=["x", "h0", "c0"], output_names=["out"],
+                      dynamic_axes={"x": {0: "batch", 1: "seq"}, "h0": {1: "batch"}, "c0": {1: "batch"},
+                                    "out": {0: "rows"}},
+                      opset_version=ONNX_OPSET, **kwargs)
+    # Keep the config and fingerprint with the export so it can be used without the checkpoint
+    onnx_model = onnx.load(path)
+    for key, value in [("config", json.dumps(model_config(model))), ("fingerprint", model_fingerprint(model))]:
+        entry = onnx_model.metadata_props.add()
+        entry.key = key
+        entry.value = value
+    onnx.save(onnx_model, path)
+
+
+def main(model_path, checkpoint_path, export_formats):
+    print(f"Loading model from {model_path}")
+    model = load_model(model_path, backend="eager")
+    model.eval()
+    print(f"Saving checkpoint to {checkpoint_path}")
+    save_checkpoint(model, checkpoint_path)
+    stem = os.path.splitext(checkpoint_path)[0]
+    if "torchscript" in export_formats:
+        print(f"Exporting TorchScript model to {stem + TORCHSCRIPT_SUFFIX}")
+        export_torchscript(model, stem + TORCHSCRIPT_SUFFIX)
+    if "onnx" in export_formats:
+        print(f"Exporting ONNX model to {stem + ONNX_SUFFIX}")
+        export_onnx(model, stem + ONNX_SUFFIX)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', required=True, help="Path to a trained model or checkpoint")
+    parser.add_argument('--checkpoint-path', required=True, help="Output path to save the checkpoint")
+    parser.add_argument('--export', nargs="*", default=[], choices=EXPORT_FORMATS,
+                        help="Inference-only formats to export alongside the checkpoint")
+    args = parser.parse_args()
+    main(args.model_path, args.checkpoint_path, args.export)
@@ -0,0 +1,354 @@
+"""
+Resumable bulk parsing job, for runs over large address files that may be killed part way, e.g. on preemptible
+machines.
+
+The input file is split into byte-range shards on line boundaries (see byte_ranges) when the job is planned, and the
+job directory holds:
+    manifest.json: format_version, the input file with its size and modification time, the output format and the byte
+        range and output file of each shard
+    shard-<i>.<format>: Parsed output of each finished shard
+    shard-<i>.done: Completion record of each finished shard, with the number of records parsed
+    shard-<i>.lock: Claim on a shard that is being parsed, holding the host and process that claimed it
+
+Each shard is parsed to a temporary file that is only renamed to its output once it's complete, and the completion
+record is written after it, so a shard is either finished or not and a restarted job only parses the shards that
+aren't. Several processes, on one machine or several sharing a filesystem, can run the same job directory at once:
+each claims shards by creating their lock files exclusively and skips shards claimed by others. Claims are released
+once the shard is finished. The claims of processes that were killed are taken over, straight away if the process
+was on the same host, otherwise once the lock hasn't been touched for the lease time (it's touched as the shard is
+read). Claims only avoid duplicated work though: every process parses to its own temporary file, named after its
+host and process, so a shard parsed twice is written atomically both times with the same output. A process taking a
+claim over only clears away the temporary file of the claim it took over, and only ever releases its own claims.
+Machines may mount the shared filesystem at different paths, so the input is matched to the job by its size and
+modification time, and each process reads it from the path it was given.
+
+Run as a script to report the progress of a job, see predict.py --job-path to run one.
+"""
+import argparse
+import io
+import json
+import locale
+import os
+import socket
+import sys
+import time
+
+from address_parser.paf.sample import byte_ranges
+
+JOB_FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+# Bytes of input per shard, small enough that little work is lost when a process is killed
+SHARD_SIZE = 64 * 2 ** 20
+# Seconds after which the claim of a process on another host is taken over if it hasn't touched its lock
+LEASE_SECONDS = 600
+# Lines of input read at a time, the lock of a shard is touched after each
+READ_CHUNK_SIZE = 10000
+
+
+def _log(message):
+    # Progress goes to stderr, the same as predict.py
+    print(message, file=sys.stderr)
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{socket.gethostname()}-{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to someone else
+        return True
+    return True
+
+
+def _read_lines(path, start, end, chunk_size):
+    """
+    Yields chunks of up to chunk_size lines of bytes for the lines that start in [start, end), blank lines included
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        offset = start
+        chunk = []
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+            offset += len(line)
+        if chunk:
+            yield chunk
+
+
+def plan_job(input_path, job_path, shard_size=SHARD_SIZE, output_format="csv"):
+    """
+    :param input_path: File with an address per line
+    :param job_path: Directory of the job, created if it doesn't exist
+    :param shard_size: Approximate number of bytes of input in each shard
+    :param output_format: Format of the shard outputs, one of OUTPUT_FORMATS
+
+    Plans the shards of a job, or checks that an existing job in the directory was planned with the same input and
+    settings, so that every process running the job agrees on its shards. The input is matched on its size and
+    modification time rather than its path, as machines sharing a filesystem may mount it at different paths. Returns
+    the BulkJob, which reads the input from input_path.
+    """
+    stat = os.stat(input_path)
+    num_shards = max(-(-stat.st_size // shard_size), 1)
+    ranges = byte_ranges(input_path, num_shards) if stat.st_size else [(0, 0)]
+    manifest = {
+        "format_version": JOB_FORMAT_VERSION,
+        "input_path": os.path.abspath(input_path),
+        "input_size": stat.st_size,
+        "input_mtime_ns": stat.st_mtime_ns,
+        "shard_size": shard_size,
+        "output_format": output_format,
+        "shards": [{"start": start, "end": end, "output": f"shard-{i:05d}.{output_format}"}
+                   for i, (start, end) in enumerate(ranges)],
+    }
+    os.makedirs(job_path, exist_ok=True)
+    manifest_path = os.path.join(job_path, MANIFEST_FILE)
+    tmp_path = f"{manifest_path}.{socket.gethostname()}-{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    try:
+        # Linking fails if another process got there first, unlike a rename, so the first plan always wins
+        os.link(tmp_path, manifest_path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    job = BulkJob(job_path, input_path)
+    for key in ["input_size", "input_mtime_ns", "shard_size", "output_format"]:
+        if job.manifest[key] != manifest[key]:
+            raise ValueError(f"{job_path} is a job with {key} {job.manifest[key]} rather than {manifest[key]}, the "
+                             f"input or settings have changed since it was planned so start a new job directory")
+    return job
+
+
+class BulkJob:
+    """
+    Shards of a job planned by plan_job, and their claims and completion records
+    """
+    def __init__(self, path, input_path=None, lease_seconds=LEASE_SECONDS):
+        """
+        :param input_path: Path of the input file on this machine, defaults to its path on the machine that planned
+            the job
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        with open(os.path.join(path, MANIFEST_FILE), "r") as f:
+            self.manifest = json.load(f)
+        self.input_path = input_path or self.manifest["input_path"]
+        if self.manifest["format_version"] > JOB_FORMAT_VERSION:
+            raise ValueError(f"Job format version {self.manifest['format_version']} is newer than the supported "
+                             f"version {JOB_FORMAT_VERSION}")
+        self.shards = self.manifest["shards"]
+        self._owner = {"host": socket.gethostname(), "pid": os.getpid()}
+
+    def __len__(self):
+        return len(self.shards)
+
+    def _shard_file(self, i, suffix):
+        return os.path.join(self.path, f"shard-{i:05d}.{suffix}")
+
+    def output_path(self, i):
+        return os.path.join(self.path, self.shards[i]["output"])
+
+    def finished(self, i):
+        return os.path.exists(self._shard_file(i, "done"))
+
+    def _lock_owner(self, lock_path):
+        """
+        Host and process holding a lock, None if there's no lock and empty if it's caught between being created and
+        written
+        """
+        try:
+            with open(lock_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return {}
+
+    def _lock_is_stale(self, lock_path, owner):
+        try:
+            age = time.time() - os.path.getmtime(lock_path)
+        except FileNotFoundError:
+            return True
+        if owner.get("host") == self._owner["host"] and "pid" in owner and not _pid_alive(owner["pid"]):
+            return True
+        return age > self.lease_seconds
+
+    def _tmp_output_path(self, i, owner):
+        return f"{self.output_path(i)}.{owner['host']}-{owner['pid']}.tmp"
+
+    def claim(self, i):
+        """
+        Claims an unfinished shard for this process. Returns whether it was claimed, False if another live process
+        has claimed it or it's finished.
+        """
+        lock_path = self._shard_file(i, "lock")
+        stale_owner = None
+        for _ in range(2):
+            if self.finished(i):
+                return False
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                owner = self._lock_owner(lock_path)
+                if owner is not None and not self._lock_is_stale(lock_path, owner):
+                    return False
+                _log(f"Taking over the stale claim on shard {i}")
+                stale_owner = owner
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._owner, f)
+            # Partial output of the process whose claim was taken over is of no use. Only its own temporary file is
+            # removed, as it may still be running and will finish to its own file if so.
+            if stale_owner and "pid" in stale_owner:
+                try:
+                    os.remove(self._tmp_output_path(i, stale_owner))
+                except FileNotFoundError:
+                    pass
+            # The shard may have been finished between the check and the claim
+            if self.finished(i):
+                self.release(i)
+                return False
+            return True
+        return False
+
+    def heartbeat(self, i):
+        """
+        Touches the lock of a claimed shard, so that other hosts don't take the claim over
+        """
+        try:
+            os.utime(self._shard_file(i, "lock"))
+        except FileNotFoundError:
+            # Taken over by another process, which parses to its own output so this one can carry on
+            pass
+
+    def release(self, i):
+        """
+        Releases the claim of this process on a shard, leaving it alone if another process has taken it over
+        """
+        lock_path = self._shard_file(i, "lock")
+        if self._lock_owner(lock_path) == self._owner:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+
+    def tmp_output_path(self, i):
+        return self._tmp_output_path(i, self._owner)
+
+    def finish(self, i, records, elapsed):
+        """
+        Moves the complete output of a claimed shard into place, records it as finished and releases the claim.
+        Returns whether it was finished by this process, False if its output had gone.
+        """
+        try:
+            os.replace(self.tmp_output_path(i), self.output_path(i))
+        except FileNotFoundError:
+            # The output went missing with the claim taken over, so the shard is left to the process that took it
+            _log(f"Lost shard {i} to another process, leaving it to that process to finish")
+            self.release(i)
+            return False
+        _write_json_atomic(self._shard_file(i, "done"), dict(self._owner, records=records, seconds=elapsed,
+                                                              finished_at=time.time()))
+        self.release(i)
+        return True
+
+    def addresses(self, i):
+        """
+        Yields the addresses of a claimed shard, one stripped address per line of its byte range, touching the lock as
+        they're read. Blank lines are kept, so that every line of the input has a row of output the same as without
+        a job.
+        """
+        shard = self.shards[i]
+        # Decoded the same way as predict.py reads the input without a job, in the locale's encoding with universal
+        # newlines. Chunks end at the end of a line, so they can be decoded separately.
+        encoding = locale.getpreferredencoding(False)
+        for lines in _read_lines(self.input_path, shard["start"], shard["end"], READ_CHUNK_SIZE):
+            self.heartbeat(i)
+            for line in io.StringIO(b"".join(lines).decode(encoding), newline=None):
+                yield line.strip()
+
+    def status(self):
+        """
+        Number of shards finished, claimed by a process and pending, and the number of records parsed so far
+        """
+        finished = [i for i in range(len(self)) if self.finished(i)]
+        records = 0
+        for i in finished:
+            with open(self._shard_file(i, "done"), "r") as f:
+                records += json.load(f)["records"]
+        claimed = sum(1 for i in range(len(self)) if i not in finished and os.path.exists(self._shard_file(i, "lock")))
+        return {
+            "shards": len(self),
+            "finished": len(finished),
+            "claimed": claimed,
+            "pending": len(self) - len(finished) - claimed,
+            "records": records,
+        }
+
+    def outputs(self):
+        """
+        Output files of the finished shards, in input order
+        """
+        return [self.output_path(i) for i in range(len(self)) if self.finished(i)]
+
+
+def run_job(job, parse_shard):
+    """
+    :param job: BulkJob
+    :param parse_shard: Function taking the addresses of a shard and a path to write their parsed output to, returning
+        the number of records written
+
+    Parses every unfinished shard that this process can claim in turn. Returns the number of shards parsed by this
+    process, which is less than the number of shards when the job is resumed or shared with other processes.
+    """
+    parsed = 0
+    for i in range(len(job)):
+        if not job.claim(i):
+            continue
+        _log(f"Parsing shard {i + 1} of {len(job)}")
+        start = time.perf_counter()
+        try:
+            records = parse_shard(job.addresses(i), job.tmp_output_path(i))
+        except BaseException:
+            if os.path.exists(job.tmp_output_path(i)):
+                os.remove(job.tmp_output_path(i))
+            job.release(i)
+            raise
+        if job.finish(i, records, time.perf_counter() - start):
+            parsed += 1
+    status = job.status()
+    _log(f"Parsed {parsed} shards, {status['finished']} of {status['shards']} shards of the job are finished")
+    return parsed
+
+
+def main(job_path):
+    job = BulkJob(job_path)
+    print(f"Job of {job.manifest['input_path']} in {len(job)} shards")
+    for key, value in job.status().items():
+        print(f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--job-path', required=True, help="Directory of a job run with predict.py --job-path")
+    args = parser.parse_args()
+    main(args.job_path)
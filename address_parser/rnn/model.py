@@ -0,0 +1,104 @@
+from contextlib import nullcontext
+
+import torch
+from torch import nn, zeros
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+
+def _normal_mode():
+    # inference_mode is only available from torch 1.9, before which every tensor is a normal one
+    return torch.inference_mode(False) if hasattr(torch, "inference_mode") else nullcontext()
+
+
+class AddressRNN(nn.Module):
+    def __init__(self, vocab, lstm_dim, lstm_layers, output_dim,
+                 seq_length, embedding_dim=10, drop_prob=0.3, train_on_gpu=False,
+                 batch_first=False):
+        super().__init__()
+
+        self._lstm_dim = lstm_dim
+        self._lstm_layers = lstm_layers
+        self._train_on_gpu = train_on_gpu
+        self.output_dim = output_dim
+        self.seq_length = seq_length
+        # How the batches the model was trained on were laid out, one of SEQUENCE_LAYOUTS. Set by train.py and used
+        # by parse_raw_addresses to parse the same way.
+        self.sequence_layout = "padded"
+
+        self._embed = nn.Embedding(len(vocab), embedding_dim)
+        self._lstm = nn.LSTM(input_size=embedding_dim,
+                             hidden_size=lstm_dim,
+                             num_layers=lstm_layers,
+                             dropout=drop_prob,
+                             bidirectional=True,
+                             batch_first=batch_first)
+
+        self._dropout = nn.Dropout(drop_prob)
+        # * 2 here because it's a bidirectional LSTM
+        self._fc = nn.Linear(lstm_dim * 2, output_dim)
+
+    def forward(self, x, hidden, lengths=None):
+        """
+        :param x: Batch of encoded addresses
+        :param hidden: Initial hidden and cell state
+        :param lengths: Optional CPU tensor of the number of real (non padding) characters of each address. When
+        given the sequences are packed so the LSTM only runs over real characters and the padded steps are never
+        computed. Outputs at padded positions are then meaningless and should be ignored.
+        """
+        embed_out = self._embed(x)
+        if lengths is not None:
+            batch_first = self._lstm.batch_first
+            embed_out = pack_padded_sequence(embed_out, lengths, batch_first=batch_first, enforce_sorted=False)
+            lstm_out, hidden = self._lstm(embed_out, hidden)
+            lstm_out, _ = pad_packed_sequence(lstm_out, batch_first=batch_first,
+                                              total_length=x.size(1 if batch_first else 0))
+        else:
+            lstm_out, hidden = self._lstm(embed_out, hidden)
+        # We want to flatten all the batches and sequences within the batch.
+        # Thus, this operation will produce a tensor of dim (batch_size * seq_length, self._lstm_dim * 2)
+        lstm_out = lstm_out.contiguous().view(-1, self._lstm_dim * 2)
+        lstm_out = self._dropout(lstm_out)
+        # Producing a final output of (batch_size * seq_length, self._output_dim), i.e. a logit score for each
+        # address class per each character in the batch.
+        out = self._fc(lstm_out)
+
+        return out, hidden
+
+    def init_hidden(self, batch_size):
+        # Create two new tensors with sizes lstm_layers x batch_size x lstm_dim,
+        # initialized to zero, for hidden state and cell state of LSTM
+        # We multiply by 2 here because we're using a bidirectional LSTM
+        if self._train_on_gpu:
+            hidden = (
+                zeros((self._lstm_layers * 2, batch_size, self._lstm_dim)).cuda(),
+                zeros((self._lstm_layers * 2, batch_size, self._lstm_dim)).cuda()
+            )
+        else:
+            hidden = (
+                zeros((self._lstm_layers * 2, batch_size, self._lstm_dim)),
+                zeros((self._lstm_layers * 2, batch_size, self._lstm_dim))
+            )
+
+        return hidden
+
+    def cached_hidden(self, batch_size):
+        """
+        Zero initial hidden and cell state for inference, reused across calls with the same batch size.
+
+        The LSTM never writes to its initial state in place so it's safe to share these tensors between forward
+        passes, which saves reallocating them for every batch. The cache is keyed on the device of the model weights
+        so that moving the model between devices doesn't hand back tensors on the wrong one.
+        """
+        device = self._embed.weight.device
+        # Models unpickled from older checkpoints never ran __init__ with the cache attribute, so create it lazily.
+        cache = self.__dict__.setdefault("_hidden_cache", {})
+        key = (batch_size, device)
+        if key not in cache:
+            # Made as normal tensors even when first asked for under inference_mode (as by parse_raw_addresses), as
+            # inference tensors can't be used by later calls that autograd tracks, e.g. predict outside no_grad
+            with _normal_mode():
+                cache[key] = (
+                    zeros((self._lstm_layers * 2, batch_size, self._lstm_dim), device=device),
+                    zeros((self._lstm_layers * 2, batch_size, self._lstm_dim), device=device)
+                )
+        return cache[key]
@@ -0,0 +1,103 @@
+import csv
+import json
+import sys
+
+from address_parser.paf import AddressField
+
+# Separators and padding are predicted by the model but aren't address components worth writing out.
+COMPONENT_FIELDS = [f.value for f in AddressField if f not in (AddressField.SEPARATOR, AddressField.PADDING)]
+OUTPUT_FIELDS = ["input_address"] + COMPONENT_FIELDS
+OUTPUT_FORMATS = ["csv", "jsonl", "parquet"]
+# Parquet row groups are buffered up to this many rows before being flushed to the file.
+PARQUET_ROW_GROUP_SIZE = 100000
+
+
+class _OutputWriter:
+    """
+    Writes parsed address records incrementally to a file, or to stdout if the path is "-". Each record is a mapping
+    of OUTPUT_FIELDS to values, missing fields are written as empty strings.
+    """
+    def __init__(self, path, binary=False):
+        if path == "-":
+            self._f = sys.stdout.buffer if binary else sys.stdout
+            self._owns_file = False
+        else:
+            self._f = open(path, "wb") if binary else open(path, "w", newline="", encoding="utf-8")
+            self._owns_file = True
+
+    def write(self, records):
+        raise NotImplementedError
+
+    def close(self):
+        if self._owns_file:
+            self._f.close()
+        else:
+            self._f.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvOutputWriter(_OutputWriter):
+    def __init__(self, path):
+        super().__init__(path)
+        self._writer = csv.writer(self._f)
+        self._writer.writerow(OUTPUT_FIELDS)
+
+    def write(self, records):
+        self._writer.writerows([r.get(field, "") for field in OUTPUT_FIELDS] for r in records)
+
+
+class JsonlOutputWriter(_OutputWriter):
+    def write(self, records):
+        self._f.writelines(
+            json.dumps({field: r.get(field, "") for field in OUTPUT_FIELDS}) + "\n" for r in records
+        )
+
+
+class ParquetOutputWriter(_OutputWriter):
+    def __init__(self, path, row_group_size=PARQUET_ROW_GROUP_SIZE):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is required to write parquet output, install it with `pip install pyarrow`")
+        super().__init__(path, binary=True)
+        self._pa = pa
+        self._schema = pa.schema([(field, pa.string()) for field in OUTPUT_FIELDS])
+        self._writer = pq.ParquetWriter(self._f, self._schema)
+        self._row_group_size = row_group_size
+        self._buffer = []
+
+    def write(self, records):
+        self._buffer.extend(records)
+        if len(self._buffer) >= self._row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            columns = [[r.get(field, "") for r in self._buffer] for field in OUTPUT_FIELDS]
+            self._writer.write_table(self._pa.Table.from_arrays(columns, schema=self._schema))
+            self._buffer = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+        super().close()
+
+
+def open_output_writer(path, output_format):
+    """
+    :param path: Output file path, or "-" to write to stdout
+    :param output_format: One of OUTPUT_FORMATS
+    """
+    if output_format == "csv":
+        return CsvOutputWriter(path)
+    elif output_format == "jsonl":
+        return JsonlOutputWriter(path)
+    elif output_format == "parquet":
+        return ParquetOutputWriter(path)
+    raise ValueError(f"Unsupported output format {output_format}, expected one of {OUTPUT_FORMATS}")
@@ -0,0 +1,99 @@
+import os
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from address_parser.rnn.util import parse_raw_addresses
+
+# Maximum number of batches queued, being parsed or waiting to be handed back in order per worker. This bounds the
+# memory used by the pool regardless of how big the input is.
+BATCHES_IN_FLIGHT_PER_WORKER = 4
+# How often to check that workers are still alive while waiting on results, in seconds
+_WORKER_CHECK_INTERVAL = 1.0
+
+
+def default_threads_per_worker(workers):
+    # Split the cores evenly between workers so they don't oversubscribe the CPU with intra-op threads
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def _worker(model, num_threads, tasks, results, parse_kwargs):
+    torch.set_num_threads(num_threads)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch_idx, addresses = task
+        try:
+            results.put((batch_idx, parse_raw_addresses(addresses, model, **parse_kwargs), None))
+        except Exception:
+            results.put((batch_idx, None, traceback.format_exc()))
+
+
+def parse_in_pool(batches, model, workers, threads_per_worker=None, **parse_kwargs):
+    """
+    :param batches: Iterable of lists of address strings, consumed lazily
+    :param model: Trained AddressRNN in eval mode
+    :param workers: Number of worker processes
+    :param threads_per_worker: Number of torch threads for each worker, defaults to an even split of the cores
+    :param parse_kwargs: Passed on to parse_raw_addresses in the workers
+
+    Parses batches of addresses across a pool of forked worker processes and yields pairs of (batch, parsed batch) in
+    the same order as the input. The model weights are moved to shared memory once so that every worker reads the
+    same copy instead of holding its own.
+    """
+    threads_per_worker = threads_per_worker or default_threads_per_worker(workers)
+    model.share_memory()
+    ctx = mp.get_context("fork")
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    processes = [ctx.Process(target=_worker, args=(model, threads_per_worker, tasks, results, parse_kwargs),
+                             daemon=True)
+                 for _ in range(workers)]
+    for p in processes:
+        p.start()
+
+    max_in_flight = workers * BATCHES_IN_FLIGHT_PER_WORKER
+    batches = iter(batches)
+    exhausted = False
+    # Batches submitted but not yet yielded, and the parsed batches that came back ahead of their turn
+    submitted = {}
+    finished = {}
+    next_submit = 0
+    next_yield = 0
+    try:
+        while True:
+            while not exhausted and next_submit - next_yield < max_in_flight:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                else:
+                    submitted[next_submit] = batch
+                    tasks.put((next_submit, batch))
+                    next_submit += 1
+            if next_yield == next_submit:
+                break
+
+            try:
+                batch_idx, parsed, error = results.get(timeout=_WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                if not all(p.is_alive() for p in processes):
+                    raise RuntimeError("A parsing worker process died unexpectedly")
+                continue
+            if error is not None:
+                raise RuntimeError(f"Parsing batch {batch_idx} failed in worker:\n{error}")
+            finished[batch_idx] = parsed
+            while next_yield in finished:
+                yield submitted.pop(next_yield), finished.pop(next_yield)
+                next_yield += 1
+    finally:
+        for _ in processes:
+            tasks.put(None)
+        for p in processes:
+            # Workers still busy with batches that are no longer needed, e.g. after an error, are stopped outright
+            p.join(timeout=_WORKER_CHECK_INTERVAL)
+            if p.is_alive():
+                p.terminate()
+                p.join()
@@ -1,48 +1,178 @@
 import argparse
-import torch
+import sys
+import time
 
+from address_parser.paf.index import PafIndex, correct_parsed
 from address_parser.paf.util import chunks_from_iter
-from address_parser.rnn.util import parse_raw_address
+from address_parser.rnn.cache import ParseCache
+from address_parser.rnn.cascade import CONFIDENCE_THRESHOLD, Cascade
+from address_parser.rnn.checkpoint import BACKENDS, load_model
+from address_parser.rnn.job import SHARD_SIZE, plan_job, run_job
+from address_parser.rnn.output import OUTPUT_FORMATS, open_output_writer
+from address_parser.rnn.util import parse_raw_addresses
 
 CHUNK_SIZE = 1000
+# Print progress every this many chunks
+LOG_EVERY = 10
 
 
-def _load_model(model_path):
-    print(f"Loading trained model from {model_path}")
+def _log(message):
+    # Progress goes to stderr so that results can be streamed to stdout
+    print(message, file=sys.stderr)
+
+
+def _load_model(model_path, backend="auto"):
+    import torch
+    _log(f"Loading trained model from {model_path}")
     if torch.cuda.is_available():
-        print("GPU available")
-        map_location = lambda loc: loc[0].cuda()
+        _log("GPU available")
+        map_location = "cuda"
     else:
-        print("GPU unavailable, loading model on CPU")
-        map_location = 'cpu'
-    model = torch.load(model_path, map_location=map_location)
+        _log("GPU unavailable, loading model on CPU")
+        map_location = "cpu"
+    model = load_model(model_path, backend=backend, map_location=map_location)
+    _log(f"Loaded {type(model).__name__}")
     return model
 
 
-def main(test_file, model_path):
-    model = _load_model(model_path)
-    model.eval()
-    print(f"Running model on address file in batches of size {CHUNK_SIZE}")
-    results = []
+def _read_addresses(input_path):
+    """
+    Lazily yield one stripped address per line from a file, or from stdin if the path is "-"
+    """
+    if input_path == "-":
+        for line in sys.stdin:
+            yield line.strip()
+    else:
+        with open(input_path, "r") as f:
+            for line in f:
+                yield line.strip()
+
+
+def _parse_chunks(chunks, model, chunk_size, cache, cascade=None):
+    for chunk in chunks:
+        if cascade is not None:
+            yield chunk, cascade.parse(chunk, batch_size=chunk_size)
+        else:
+            yield chunk, parse_raw_addresses(chunk, model, batch_size=chunk_size, cache=cache)
+
+
+def parse_stream(addresses, model, writer, chunk_size=CHUNK_SIZE, cache=None, workers=1, threads_per_worker=None,
+                 cascade=None, paf_index=None):
+    """
+    :param addresses: Iterable of address strings, consumed lazily
+    :param model: Trained AddressRNN in eval mode
+    :param writer: Output writer that each chunk of parsed records is written to as soon as it's parsed
+    :param cache: Optional ParseCache for the model, only supported with a single worker
+    :param workers: Number of processes to parse with. With more than one, chunks are parsed in a pool of worker
+    processes sharing the model weights (see parse_in_pool) and written out in input order.
+    :param threads_per_worker: Number of torch threads per worker process
+    :param cascade: Optional Cascade with model as its small model, escalating the addresses the model isn't
+    confident about to its large model. Only supported with a single worker and without a cache.
+    :param paf_index: Optional PafIndex that parsed addresses are checked against and corrected with, see
+    correct_parsed
+
+    Only a bounded number of chunks of addresses are held in memory at a time so memory use doesn't grow with the
+    input size. Returns the number of records parsed.
+    """
+    chunks_it = chunks_from_iter(addresses, chunk_size)
+    if cascade is not None and (workers > 1 or cache is not None):
+        raise ValueError("A cascade can't be combined with a parse cache or worker processes")
+    if workers > 1:
+        if cache is not None:
+            raise ValueError("A parse cache can't be shared between worker processes")
+        from address_parser.rnn.pool import parse_in_pool
+        parsed_chunks = parse_in_pool(chunks_it, model, workers, threads_per_worker, batch_size=chunk_size)
+    else:
+        parsed_chunks = _parse_chunks(chunks_it, model, chunk_size, cache, cascade)
+
+    records = 0
     chunks = 0
-    with open(test_file, "r") as f:
-        for chunk in chunks_from_iter(f.readlines(), CHUNK_SIZE):
-            chunk_res = []
-            for add in chunk:
-                add = add.strip()
-                parsed_add = parse_raw_address(add, model)
-                parsed_add["input_address"] = add
-                chunk_res.append(parsed_add)
-            results.extend(chunk_res)
-            chunks += 1
-            if chunks % 10 == 0:
-                print(f"Processed {chunks} chunks ({len(results)} records)")
+    start = time.perf_counter()
+    for chunk, parsed in parsed_chunks:
+        if paf_index is not None:
+            parsed, _ = correct_parsed(parsed, paf_index)
+        for address, components in zip(chunk, parsed):
+            components["input_address"] = address
+        writer.write(parsed)
+        records += len(parsed)
+        chunks += 1
+        if chunks % LOG_EVERY == 0:
+            elapsed = time.perf_counter() - start
+            _log(f"Processed {chunks} chunks ({records} records, {records / elapsed:.0f} records/sec)")
+
+    elapsed = time.perf_counter() - start
+    _log(f"Finished parsing {records} records in {elapsed:.1f}s ({records / max(elapsed, 1e-9):.0f} records/sec)")
+    if cache is not None:
+        _log(f"Parse cache stats: {cache.stats()}")
+    if cascade is not None:
+        _log(f"Cascade stats: {cascade.stats()}")
+    return records
+
+
+def main(input_path, model_path, output_path="-", output_format="csv", chunk_size=CHUNK_SIZE, cache_path=None,
+         workers=1, threads_per_worker=None, backend="auto", large_model_path=None,
+         confidence_threshold=CONFIDENCE_THRESHOLD, paf_index_path=None, job_path=None, shard_size=SHARD_SIZE):
+    model = _load_model(model_path, backend)
+    model.eval()
+    cache = ParseCache(cache_path, model) if cache_path else None
+    cascade = None
+    if large_model_path:
+        large_model = _load_model(large_model_path, backend)
+        large_model.eval()
+        cascade = Cascade(model, large_model, confidence_threshold)
+    paf_index = PafIndex(paf_index_path) if paf_index_path else None
+    _log(f"Running model on address file in batches of size {chunk_size} with {workers} worker(s)")
+    if job_path:
+        job = plan_job(input_path, job_path, shard_size, output_format)
+
+        def parse_shard(addresses, shard_output_path):
+            with open_output_writer(shard_output_path, output_format) as writer:
+                return parse_stream(addresses, model, writer, chunk_size=chunk_size, workers=workers,
+                                    threads_per_worker=threads_per_worker, cascade=cascade, paf_index=paf_index)
+
+        run_job(job, parse_shard)
+        return
+    try:
+        with open_output_writer(output_path, output_format) as writer:
+            parse_stream(_read_addresses(input_path), model, writer, chunk_size=chunk_size, cache=cache,
+                         workers=workers, threads_per_worker=threads_per_worker, cascade=cascade,
+                         paf_index=paf_index)
+    finally:
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     # This file should have an address per line
-    parser.add_argument('--test-path', required=True, help="Path to test address file")
-    parser.add_argument('--model-path', required=True, help="Path to trained model")
+    parser.add_argument('--test-path', default="-", help="Path to address file, reads from stdin if not given")
+    parser.add_argument('--model-path', required=True, help="Path to trained model checkpoint or export")
+    parser.add_argument('--backend', default="auto", choices=BACKENDS,
+                        help="Inference backend, auto picks the fastest export available next to the checkpoint")
+    parser.add_argument('--output-path', default="-", help="Path to write parsed addresses, stdout if not given")
+    parser.add_argument('--output-format', default="csv", choices=OUTPUT_FORMATS, help="Format of parsed output")
+    parser.add_argument('--batch-size', type=int, default=CHUNK_SIZE, help="Number of addresses parsed per batch")
+    parser.add_argument('--cache-path', help="Optional path to a persistent parse cache file, reused across runs")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes to parse with")
+    parser.add_argument('--threads-per-worker', type=int,
+                        help="Number of torch threads per worker, defaults to splitting the cores between workers")
+    parser.add_argument('--large-model-path',
+                        help="Optional larger model that addresses the model isn't confident about are re-parsed with")
+    parser.add_argument('--confidence-threshold', type=float, default=CONFIDENCE_THRESHOLD,
+                        help="Confidence below which addresses are re-parsed with the large model")
+    parser.add_argument('--paf-index-path',
+                        help="Optional PAF index built by address_parser.paf.index to check and correct parses with")
+    parser.add_argument('--job-path',
+                        help="Directory of a resumable job to parse the address file into shard by shard, see job.py")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE,
+                        help="Approximate number of bytes of the address file in each shard of a job")
     args = parser.parse_args()
-    main(args.test_path, args.model_path)
+    if args.job_path and (args.test_path == "-" or args.output_path != "-" or args.cache_path):
+        parser.error("--job-path needs --test-path and can't be combined with --output-path or --cache-path")
+    if args.workers > 1 and args.cache_path:
+        parser.error("--cache-path can't be combined with --workers")
+    if args.large_model_path and (args.workers > 1 or args.cache_path):
+        parser.error("--large-model-path can't be combined with --workers or --cache-path")
+    main(args.test_path, args.model_path, args.output_path, args.output_format, args.batch_size, args.cache_path,
+         args.workers, args.threads_per_worker, args.backend, args.large_model_path, args.confidence_threshold,
+         args.paf_index_path, args.job_path, args.shard_size)
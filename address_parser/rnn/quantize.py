@@ -0,0 +1,129 @@
+"""
+Produces a dynamic int8 quantized variant of a trained model for CPU inference, along with a report of how its accuracy
+and speed compare with the float model.
+
+The LSTM and final linear layer weights are quantized to int8 ahead of time and activations are quantized on the fly,
+while the embedding layer stays in float. The quantized model is saved as a checkpoint like a trained model, so it can
+be loaded with load_model and used with parse_raw_addresses as usual.
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+from address_parser.bench.synthetic import synthetic_records
+from address_parser.paf import ADDRESS_FIELD_CLASSES, AddressField, VOCAB, VOCAB_CHAR_TO_IDX, PADDING_CHAR
+from address_parser.paf.dataset import ShardedDataset
+from address_parser.paf.preprocess import preprocess_addresses
+from address_parser.paf.util import csv_records_to_dicts
+from address_parser.rnn.checkpoint import load_model, save_checkpoint
+from address_parser.rnn.util import parse_raw_addresses, predict, predict_by_length
+
+BATCH_SIZES = [1, 32, 256, 1024]
+# Number of batches timed at each batch size
+TIMED_BATCHES = 20
+NUM_EXAMPLES = 5000
+_quantize_dynamic = getattr(torch, "ao", torch).quantization.quantize_dynamic
+
+
+def quantize_model(model):
+    """
+    Returns a dynamic int8 quantized copy of the model, the original model is left untouched.
+    """
+    model.eval()
+    return _quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def _held_out_examples(paf_path, num_examples, seq_length, seed, dataset_path=None):
+    if dataset_path:
+        return ShardedDataset(dataset_path)[:num_examples]
+    if paf_path:
+        with open(paf_path, "r") as f:
+            records = csv_records_to_dicts(line for _, line in zip(range(num_examples), f))
+    else:
+        records = synthetic_records(num_examples, seed=seed)
+    # The layouts of the examples are picked from the global random state
+    random.seed(seed)
+    examples = list(preprocess_addresses(records, seq_length=seq_length))
+    return np.stack([t[0] for t in examples]), np.stack([t[1] for t in examples])
+
+
+def per_field_accuracy(model, features, labels, batch_size=1024):
+    """
+    Fraction of the characters of each field that the model labels correctly, padding excluded. Models are run the
+    way parse_raw_addresses runs them by default, so models trained on trimmed or packed sequences are run on batches
+    trimmed to their longest address, and packed for packed models.
+    """
+    not_padding = labels != ADDRESS_FIELD_CLASSES[AddressField.PADDING.value]
+    sequence_layout = getattr(model, "sequence_layout", "padded")
+    with torch.no_grad():
+        if sequence_layout == "padded":
+            preds = np.concatenate([predict(torch.from_numpy(features[i:i + batch_size]), model).numpy()
+                                    for i in range(0, len(features), batch_size)])
+        else:
+            preds = predict_by_length(features, not_padding.sum(axis=1), model, batch_size,
+                                      packed=sequence_layout == "packed")
+    accuracies = {}
+    for field, field_class in ADDRESS_FIELD_CLASSES.items():
+        is_field = labels == field_class
+        if field != AddressField.PADDING.value and is_field.any():
+            accuracies[field] = (preds[is_field] == field_class).mean()
+    accuracies["all"] = (preds[not_padding] == labels[not_padding]).mean()
+    return accuracies
+
+
+def timings(model, addresses, batch_size):
+    """
+    Returns the median and 99th percentile latency per batch in ms and the throughput in addresses per second
+    """
+    batches = [addresses[i:i + batch_size] for i in range(0, min(len(addresses), batch_size * TIMED_BATCHES),
+                                                           batch_size)]
+    parse_raw_addresses(batches[0], model, batch_size=batch_size)
+    latencies = []
+    for batch in batches:
+        start = time.perf_counter()
+        parse_raw_addresses(batch, model, batch_size=batch_size)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies)
+    return np.median(latencies) * 1000, np.percentile(latencies, 99) * 1000, sum(map(len, batches)) / latencies.sum()
+
+
+def main(model_path, output_path, paf_path=None, num_examples=NUM_EXAMPLES, seed=0, dataset_path=None):
+    model = load_model(model_path, backend="eager")
+    quantized = quantize_model(model)
+    print(f"Saving quantized model checkpoint to {output_path}")
+    save_checkpoint(quantized, output_path)
+
+    print(f"Evaluating on {num_examples} held-out {'PAF' if paf_path or dataset_path else 'synthetic'} examples")
+    features, labels = _held_out_examples(paf_path, num_examples, model.seq_length, seed, dataset_path)
+    float_acc = per_field_accuracy(model, features, labels)
+    int8_acc = per_field_accuracy(quantized, features, labels)
+    print(f"{'field':<40}{'float':>8}{'int8':>8}{'delta':>8}")
+    for field in float_acc:
+        delta = int8_acc[field] - float_acc[field]
+        print(f"{field:<40}{float_acc[field]:>8.2%}{int8_acc[field]:>8.2%}{delta * 100:>+7.2f}%")
+
+    padding_idx = VOCAB_CHAR_TO_IDX[PADDING_CHAR]
+    addresses = ["".join(VOCAB[i] for i in row if i != padding_idx) for row in features]
+    print(f"\n{'batch size':<12}{'float p50 ms':>14}{'int8 p50 ms':>14}{'float p99 ms':>14}{'int8 p99 ms':>14}"
+          f"{'float addr/s':>14}{'int8 addr/s':>14}{'speedup':>9}")
+    for batch_size in BATCH_SIZES:
+        float_p50, float_p99, float_tput = timings(model, addresses, batch_size)
+        int8_p50, int8_p99, int8_tput = timings(quantized, addresses, batch_size)
+        print(f"{batch_size:<12}{float_p50:>14.1f}{int8_p50:>14.1f}{float_p99:>14.1f}{int8_p99:>14.1f}"
+              f"{float_tput:>14.0f}{int8_tput:>14.0f}{int8_tput / float_tput:>8.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', required=True, help="Path to trained model")
+    parser.add_argument('--output-path', required=True, help="Output path to save the quantized model")
+    parser.add_argument('--paf-sample-path', help="Held-out PAF sample CSV, synthetic addresses are used if not given")
+    parser.add_argument('--dataset-path', help="Held-out dataset preprocessed by preprocess.py, instead of a sample")
+    parser.add_argument('--num-examples', type=int, default=NUM_EXAMPLES, help="Number of held-out examples")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the layout of held-out examples")
+    args = parser.parse_args()
+    main(args.model_path, args.output_path, args.paf_sample_path, args.num_examples, args.seed, args.dataset_path)
@@ -0,0 +1,173 @@
+"""
+Rule-based fast path ahead of the model for trivially structured addresses, such as
+    <building number> <street>, <post town>, <postcode>
+which a single precompiled pattern labels reliably without running the LSTM.
+
+The pattern only matches addresses whose every component is unambiguous: a building number, then a street that ends
+in a known descriptor (street, road, lane etc.) and a comma, then optionally a single post town, then a full UK
+postcode, then optionally a country from COUNTRY_VARIANTS. A post town can't be told apart from a dependent locality by
+its form, so it has to be one of a set of known post towns, e.g. those in the PAF data. Anything else, e.g. a building
+name, a sub-building, a dependent locality or components separated by spaces alone, falls through to the model. That
+includes numbers with a letter suffix such as 12a, which are building names in the PAF data rather than numbers.
+
+Components are sliced out of the normalised address (see normalise_address_str), the same as the model's parses, so
+the two can be used interchangeably. Unlike the model the rules aren't limited to the model seq_length.
+
+Run as a script to report the share of addresses the rules absorb and how they compare with the model on a validation
+set laid out from a PAF sample (or synthetic records), where the true components are known.
+"""
+import argparse
+import random
+import re
+import time
+from collections import defaultdict
+
+from address_parser.paf import (
+    AddressField, ADDRESS_FIELD_CLASSES, COUNTRY_VARIANTS, STREET_VARIANTS, AVENUE_VARIANTS, ROAD_VARIANTS
+)
+from address_parser.paf.util import normalise_address_str, shuffle_components, csv_records_to_dicts
+
+# Last words of a street that mark it out as one. Building names rarely end in these.
+THOROUGHFARE_DESCRIPTORS = STREET_VARIANTS + AVENUE_VARIANTS + ROAD_VARIANTS + [
+    "lane", "close", "drive", "way", "place", "gardens", "crescent", "court", "terrace", "grove", "hill", "row",
+    "square", "walk", "mews", "parade", "rise", "park", "green",
+]
+# Outward code of an area, a district and an optional sub-district letter, then the inward code. Spaces are optional
+# as they often go missing.
+POSTCODE_PATTERN = r"[a-z]{1,2}[0-9][a-z0-9]? ?[0-9][a-z]{2}"
+NUM_EXAMPLES = 5000
+
+
+def _alternatives(words):
+    # Longest first, so that e.g. "st." isn't cut short to "st"
+    return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+
+_WORD = r"[a-z][a-z'-]*"
+_ADDRESS_RE = re.compile(
+    rf"\s*(?P<{AddressField.BUILDING_NUMBER.value}>[0-9]+)"
+    rf"(?:\s*,\s*|\s+)(?P<{AddressField.THOROUGHFARE_AND_DESCRIPTOR.value}>{_WORD}(?:\s+{_WORD})*?"
+    rf"\s+(?:{_alternatives(THOROUGHFARE_DESCRIPTORS)}))"
+    rf"\s*,\s*(?:(?P<{AddressField.POSTTOWN.value}>{_WORD}(?:\s+{_WORD})*?)(?:\s*,\s*|\s+))?"
+    rf"(?P<{AddressField.POSTCODE.value}>{POSTCODE_PATTERN})"
+    rf"(?:\s*,\s*(?P<{AddressField.COUNTRY.value}>{_alternatives(COUNTRY_VARIANTS)}))?\s*"
+)
+
+
+class RuleParser:
+    """
+    Parses the addresses that the rules are confident about, keeping count of the share of addresses it absorbs.
+    Pass one to parse_raw_addresses to only run the model on the rest.
+    """
+    def __init__(self, posttowns=()):
+        """
+        :param posttowns: Known post towns, addresses with any other town between the street and the postcode fall
+            through to the model
+        """
+        self.posttowns = set(town.lower() for town in posttowns)
+        self.addresses = 0
+        self.absorbed = 0
+
+    @property
+    def absorption_rate(self):
+        return self.absorbed / self.addresses if self.addresses else 0.0
+
+    def parse(self, address):
+        """
+        Returns the parsed components of an address in the same form as parse_raw_address, or None if the rules
+        aren't confident about it
+        """
+        normalised = normalise_address_str(address)
+        match = _ADDRESS_RE.fullmatch(normalised)
+        self.addresses += 1
+        if match is None:
+            return None
+        posttown = match.group(AddressField.POSTTOWN.value)
+        if posttown is not None and posttown not in self.posttowns:
+            return None
+        self.absorbed += 1
+        components = defaultdict(str)
+        for field, value in match.groupdict().items():
+            if value:
+                components[field] = value
+        return components
+
+    def parse_many(self, addresses):
+        return [self.parse(address) for address in addresses]
+
+
+def labelled_addresses(records, seed=0):
+    """
+    Lays out each record as in training, returning pairs of the address string and its true components
+    """
+    rng = random.Random(seed)
+    examples = []
+    for record in records:
+        address = dict((t[0], (t[1] or "").lower()) for t in record.items() if t[0] in ADDRESS_FIELD_CLASSES)
+        parts = shuffle_components(address, rng)
+        components = defaultdict(str)
+        for value, field in parts:
+            if field != AddressField.SEPARATOR.value:
+                components[field] += normalise_address_str(value)
+        examples.append(("".join(value for value, _ in parts), components))
+    return examples
+
+
+def evaluate(rule_parser, model, examples):
+    """
+    :param examples: Pairs of address strings and their true components, see labelled_addresses
+
+    Returns the share of addresses the rules absorb, and for those addresses how often the rules and the model agree,
+    how often each of them gets every component right and how long each of them takes per address.
+    """
+    from address_parser.rnn.util import parse_raw_addresses
+    addresses = [address for address, _ in examples]
+    start = time.perf_counter()
+    ruled = rule_parser.parse_many(addresses)
+    rule_time = time.perf_counter() - start
+    absorbed = [i for i, components in enumerate(ruled) if components is not None]
+    start = time.perf_counter()
+    parsed = parse_raw_addresses([addresses[i] for i in absorbed], model)
+    model_time = time.perf_counter() - start
+    expected = [examples[i][1] for i in absorbed]
+    ruled = [ruled[i] for i in absorbed]
+    n = max(len(absorbed), 1)
+    return {
+        "addresses": len(examples),
+        "absorbed": len(absorbed),
+        "absorption_rate": len(absorbed) / len(examples) if examples else 0.0,
+        "model_agreement": sum(r == p for r, p in zip(ruled, parsed)) / n,
+        "rule_accuracy": sum(r == e for r, e in zip(ruled, expected)) / n,
+        "model_accuracy": sum(p == e for p, e in zip(parsed, expected)) / n,
+        "rule_us_per_address": rule_time / max(len(examples), 1) * 10 ** 6,
+        "model_us_per_address": model_time / n * 10 ** 6,
+    }
+
+
+def main(model_path, paf_sample_path=None, num_examples=NUM_EXAMPLES, seed=0):
+    from address_parser.bench.synthetic import synthetic_records
+    from address_parser.rnn.checkpoint import load_model
+    model = load_model(model_path)
+    if paf_sample_path:
+        with open(paf_sample_path, "r") as f:
+            records = csv_records_to_dicts(line for _, line in zip(range(num_examples), f))
+    else:
+        records = synthetic_records(num_examples, seed=seed)
+    posttowns = set(record[AddressField.POSTTOWN.value] for record in records)
+    report = evaluate(RuleParser(posttowns), model, labelled_addresses(records, seed))
+    print(f"Rules absorbed {report['absorbed']} of {report['addresses']} addresses "
+          f"({report['absorption_rate']:.1%})")
+    print(f"On those addresses the rules agree with the model on {report['model_agreement']:.1%}, the rules parse "
+          f"{report['rule_accuracy']:.1%} correctly and the model {report['model_accuracy']:.1%}")
+    print(f"The rules take {report['rule_us_per_address']:.1f}us per address, the model "
+          f"{report['model_us_per_address']:.1f}us per address")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', default="pretrained/address_char_rnn.pt", help="Path to trained model")
+    parser.add_argument('--paf-sample-path', help="Validation PAF sample CSV, synthetic addresses are used if not given")
+    parser.add_argument('--num-examples', type=int, default=NUM_EXAMPLES, help="Number of validation addresses")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the layout of validation addresses")
+    args = parser.parse_args()
+    main(args.model_path, args.paf_sample_path, args.num_examples, args.seed)
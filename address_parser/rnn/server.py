@@ -0,0 +1,334 @@
+"""
+Local parsing server that holds a single loaded model and serves it over HTTP on a TCP port or a Unix socket.
+
+Concurrent requests are coalesced into micro-batches: a batch is run as soon as it's max_batch_size addresses or once
+the first address in it has waited max_wait_ms, and while a batch is running on the model thread the next one builds
+up. Under light load addresses go through almost on their own with at most max_wait_ms of added latency, under heavy
+load batches fill up and throughput approaches that of bulk parsing.
+
+Endpoints:
+    POST /parse    {"address": "..."} returns {"components": {...}}, or {"addresses": [...]} returns
+                   {"components": [{...}, ...]} in the same order
+    GET /metrics   Request and batch counts, current queue depth and histograms of queue depth, batch size and
+                   latency
+    GET /health    {"status": "ok"}
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from address_parser.rnn.checkpoint import BACKENDS, load_model
+from address_parser.rnn.util import parse_raw_addresses
+
+MAX_BATCH_SIZE = 64
+MAX_WAIT_MS = 5.0
+# Requests with bigger bodies are rejected
+MAX_BODY_BYTES = 1024 * 1024
+# Upper bounds of the histogram buckets, every histogram also has a final unbounded bucket
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+QUEUE_DEPTH_BUCKETS = [0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+LATENCY_MS_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def to_dict(self):
+        return {
+            "buckets": [f"<={b}" for b in self.buckets] + [f">{self.buckets[-1]}"],
+            "counts": self.counts,
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0
+        }
+
+
+class MicroBatcher:
+    """
+    Coalesces addresses submitted concurrently from the event loop into batches and parses each batch on a single
+    model thread, so the model is only ever used by one batch at a time.
+    """
+    def __init__(self, model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, **parse_kwargs):
+        """
+        :param model: Trained model in eval mode
+        :param max_batch_size: Maximum number of addresses run through the model together
+        :param max_wait_ms: Longest an address waits for others to join its batch before the batch is run
+        :param parse_kwargs: Passed on to parse_raw_addresses
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.parse_kwargs = parse_kwargs
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_depths = Histogram(QUEUE_DEPTH_BUCKETS)
+        self.latencies_ms = Histogram(LATENCY_MS_BUCKETS)
+        self._queue = None
+        self._task = None
+        self._executor = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="address-parser-model")
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown(wait=True)
+
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def parse(self, addresses):
+        """
+        Returns the parsed components of each address once the batches they were put in have run.
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for address in addresses:
+            future = loop.create_future()
+            self._queue.put_nowait((address, future, time.perf_counter()))
+            futures.append(future)
+        self.requests += 1
+        return await asyncio.gather(*futures)
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Take whatever is already waiting before checking the deadline, so a backlog that built up while the
+            # last batch ran goes straight into this one
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            getter = asyncio.ensure_future(self._queue.get())
+            done, _ = await asyncio.wait([getter], timeout=timeout)
+            if not done:
+                getter.cancel()
+                try:
+                    # An address can still arrive between the timeout and the cancellation, keep it if so
+                    batch.append(await getter)
+                except asyncio.CancelledError:
+                    pass
+                break
+            batch.append(getter.result())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            # Callers that gave up, e.g. disconnected, don't need their addresses parsed
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+            self.queue_depths.observe(self.queue_depth())
+            self.batch_sizes.observe(len(batch))
+            self.batches += 1
+            addresses = [address for address, _, _ in batch]
+            try:
+                parsed = await loop.run_in_executor(self._executor, self._parse_batch, addresses)
+            except Exception as e:
+                self.errors += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            for (_, future, enqueued), components in zip(batch, parsed):
+                self.latencies_ms.observe((now - enqueued) * 1000)
+                if not future.done():
+                    future.set_result(dict(components))
+
+    def _parse_batch(self, addresses):
+        return parse_raw_addresses(addresses, self.model, batch_size=len(addresses), **self.parse_kwargs)
+
+    def metrics(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "errors": self.errors,
+            "queue_depth": self.queue_depth(),
+            "queue_depth_histogram": self.queue_depths.to_dict(),
+            "batch_size_histogram": self.batch_sizes.to_dict(),
+            "latency_ms_histogram": self.latencies_ms.to_dict(),
+        }
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def _read_request(reader):
+    """
+    Reads one HTTP/1.1 request and returns the method, path, headers and body, or None if the connection was closed
+    before a new request started.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    content_length = int(headers.get("content-length", 0) or 0)
+    if content_length > MAX_BODY_BYTES:
+        raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Request body is over {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(content_length) if content_length else b""
+    return method, path.split("?", 1)[0], headers, body
+
+
+def _write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode("utf-8")
+    head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+
+
+async def _parse_request(batcher, body):
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Request body isn't valid JSON")
+    if isinstance(request, dict) and isinstance(request.get("address"), str):
+        return {"components": (await batcher.parse([request["address"]]))[0]}
+    if (isinstance(request, dict) and isinstance(request.get("addresses"), list)
+            and all(isinstance(a, str) for a in request["addresses"])):
+        return {"components": await batcher.parse(request["addresses"])}
+    raise HttpError(HTTPStatus.BAD_REQUEST, 'Expected {"address": "..."} or {"addresses": ["...", ...]}')
+
+
+_ROUTE_METHODS = {"/parse": "POST", "/metrics": "GET", "/health": "GET"}
+
+
+async def _route(batcher, method, path, body):
+    if path not in _ROUTE_METHODS:
+        raise HttpError(HTTPStatus.NOT_FOUND, f"Unknown path {path}")
+    if method != _ROUTE_METHODS[path]:
+        raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED, f"{path} only supports {_ROUTE_METHODS[path]}")
+    if path == "/parse":
+        return await _parse_request(batcher, body)
+    if path == "/metrics":
+        return batcher.metrics()
+    return {"status": "ok"}
+
+
+async def handle_connection(batcher, reader, writer):
+    """
+    Serves requests on a connection until the client closes it or asks for it to be closed
+    """
+    try:
+        while True:
+            keep_alive = True
+            try:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                status, payload = HTTPStatus.OK, await _route(batcher, method, path, body)
+            except HttpError as e:
+                status, payload = e.status, {"error": str(e)}
+            except (asyncio.IncompleteReadError, ValueError):
+                status, payload, keep_alive = HTTPStatus.BAD_REQUEST, {"error": "Malformed request"}, False
+            except Exception as e:
+                status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+            _write_response(writer, status, payload, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(batcher, host="127.0.0.1", port=8080, unix_socket=None):
+    """
+    Starts serving on a Unix socket if one is given, otherwise on host and port. The batcher must already be started.
+    """
+    def handler(reader, writer):
+        return handle_connection(batcher, reader, writer)
+
+    if unix_socket:
+        return await asyncio.start_unix_server(handler, path=unix_socket)
+    return await asyncio.start_server(handler, host=host, port=port)
+
+
+async def serve(model, host="127.0.0.1", port=8080, unix_socket=None, max_batch_size=MAX_BATCH_SIZE,
+                max_wait_ms=MAX_WAIT_MS):
+    batcher = MicroBatcher(model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    await batcher.start()
+    server = await start_server(batcher, host, port, unix_socket)
+    print(f"Serving on {unix_socket or f'http://{host}:{port}'} with batches of up to {max_batch_size} addresses "
+          f"waiting at most {max_wait_ms}ms")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+def main(model_path, host, port, unix_socket, max_batch_size, max_wait_ms, backend="auto", threads=None):
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    print(f"Loading trained model from {model_path}")
+    model = load_model(model_path, backend=backend)
+    model.eval()
+    try:
+        asyncio.run(serve(model, host, port, unix_socket, max_batch_size, max_wait_ms))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', required=True, help="Path to trained model checkpoint or export")
+    parser.add_argument('--backend', default="auto", choices=BACKENDS, help="Inference backend")
+    parser.add_argument('--host', default="127.0.0.1", help="Host to listen on")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on")
+    parser.add_argument('--unix-socket', help="Path of a Unix socket to listen on instead of a TCP port")
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE,
+                        help="Maximum number of addresses parsed together")
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS,
+                        help="Longest an address waits for others to join its batch")
+    parser.add_argument('--threads', type=int, help="Number of torch threads used to run the model")
+    args = parser.parse_args()
+    main(args.model_path, args.host, args.port, args.unix_socket, args.max_batch_size, args.max_wait_ms,
+         args.backend, args.threads)
@@ -1,14 +1,17 @@
 import argparse
+import time
 
 import numpy as np
 import torch
 
 from torch import optim, nn
-from address_parser.paf import ADDRESS_FIELD_CLASSES, VOCAB_IDX_TO_CHAR
-from address_parser.paf.preprocess import preprocess_addresses
-from address_parser.paf.util import chunks_from_iter, csv_records_to_dicts
+from address_parser.paf import ADDRESS_FIELD_CLASSES, VOCAB_IDX_TO_CHAR, AddressField
+from address_parser.paf.dataset import ShardedDataset
+from address_parser.paf.util import chunks_from_iter
 from address_parser.rnn import AddressRNN
-from address_parser.rnn.util import accuracy
+from address_parser.rnn.checkpoint import save_checkpoint
+from address_parser.rnn.data import AddressStream, stream_loader
+from address_parser.rnn.util import accuracy, SEQUENCE_LAYOUTS
 
 CHUNK_SIZE = 1000
 BATCH_SIZE = 512
@@ -20,21 +23,133 @@ LR = 0.001
 VOCAB = VOCAB_IDX_TO_CHAR.keys()
 CLIP = 5
 EPOCHS = 3
+PADDING_CLASS = ADDRESS_FIELD_CLASSES[AddressField.PADDING.value]
+# Number of batches sorted by length together into new batches, see bucketed_batches
+BUCKET_WINDOW_BATCHES = 32
 
 
-def train(preprocessed_records):
+def _record_batches(preprocessed_records):
+    for batch in chunks_from_iter(preprocessed_records, n=BATCH_SIZE, full_chunks_only=True):
+        yield np.array([t[0] for t in batch]), np.array([t[1] for t in batch])
+
+
+def bucketed_batches(batches, rng, window_batches=BUCKET_WINDOW_BATCHES):
+    """
+    :param batches: Iterable of (features, labels) batches of shape (batch_size, seq_length)
+    :param rng: numpy Generator that the order of the new batches is shuffled with
+    :param window_batches: Number of batches regrouped together
+
+    Regroups each window of batches into batches of examples of similar length, each trimmed to its longest example,
+    so little time is spent on padding. Yields (features, labels, lengths) batches, in a random order within each
+    window so training doesn't see short and long addresses in turn.
+    """
+    for window in chunks_from_iter(batches, window_batches):
+        features = np.concatenate([np.asarray(f) for f, _ in window])
+        labels = np.concatenate([np.asarray(l) for _, l in window])
+        # Addresses are at the start of each row, followed by padding. Empty addresses can't be packed so they get a
+        # single (padding) step, which is masked out of the loss anyway.
+        lengths = np.maximum((labels != PADDING_CLASS).sum(axis=1), 1)
+        order = np.argsort(lengths, kind="stable")
+        batch_size = len(window[0][0])
+        for start in rng.permutation(np.arange(0, len(order), batch_size)):
+            batch_idx = order[start:start + batch_size]
+            max_length = lengths[batch_idx].max()
+            yield features[batch_idx, :max_length], labels[batch_idx, :max_length], lengths[batch_idx]
+
+
+def train_step(model, optimizer, criterion, features, labels, lengths=None, packed=False):
+    """
+    :param features: Batch of encoded addresses
+    :param labels: Class of each character of the addresses
+    :param lengths: Number of characters in each address. When given padding is masked out of the loss and accuracy,
+        otherwise the model is trained to predict the padding too.
+    :param packed: Run the batch as packed sequences, which needs the lengths
+
+    Returns the loss and accuracy of the batch.
+    """
+    # Features (and labels read from a dataset or stream) are encoded as uint8, the embedding layer and the loss need
+    # int64 indexes
+    X = torch.as_tensor(features).long()
+    y = torch.as_tensor(labels).long()
+    if model._train_on_gpu:
+        X = X.cuda()
+        y = y.cuda()
+
+    # Every batch is made of unrelated addresses, so each one starts from a zero state
+    hidden = model.init_hidden(len(X))
+    optimizer.zero_grad()
+
+    # Packing needs the lengths on the CPU
+    out, _ = model(X, hidden, torch.as_tensor(lengths).long() if packed else None)
+    """
+    Align y for computing CrossEntropyLoss. We know that the shape of `out` is
+        (batch_size * seq_length, OUTPUT_DIM), i.e. a logit score per output class per character in a batch
+    so we shape `y` to be
+        a vector tensor of dim batch_size * seq_length -> True class label per character in the batch.
+
+    This is similar to the below example
+    >>> target = torch.empty(3, dtype=torch.long).random_(5)
+    >>> target
+    tensor([2, 4, 4])
+    >>> output = torch.Tensor([[0, 0 , 20, 0, 0], [0, 0, 0, 0, 14], [0, 0, 0, 0, 25]])
+    >>> output
+    tensor([[ 0.,  0., 20.,  0.,  0.],
+            [ 0.,  0.,  0.,  0., 14.],
+            [ 0.,  0.,  0.,  0., 25.]])
+    >>> loss = nn.CrossEntropyLoss()
+    >>> loss(output, target).item()
+    1.1126181789222755e-06
+
+    where target is a vector tensor of dim 3 and the values being some class label between 0 and 4
+    and output is a tensor of dim (3, 5) where each element of row i is the scores for each of the 5 classes.
+    The small loss value shows that the cross entropy loss is behaving as expected for the example provided,
+    since the output has high scores for the correct class labels at the corresponding indexes and zero
+    elsewhere.
+    """
+    y_reshaped = y.reshape(-1)
+    if lengths is not None:
+        # Padding only makes up the end of each row so there's no point in learning to predict it, and outputs at
+        # padded positions are meaningless with packed sequences
+        not_padding = y_reshaped != PADDING_CLASS
+        out, y_reshaped = out[not_padding], y_reshaped[not_padding]
+    loss = criterion(out, y_reshaped)
+    loss.backward()
+
+    # To avoid exploding gradients
+    nn.utils.clip_grad_norm_(model.parameters(), CLIP)
+    optimizer.step()
+    return loss, accuracy(out, y_reshaped)
+
+
+def train(preprocessed_records=None, dataset=None, stream=None, workers=None, sequence_layout=None, seed=0):
     """
     :param preprocessed_records: List of pairs of encoded_address, address_char_classes
+    :param dataset: ShardedDataset to train on instead of preprocessed_records, read a shuffled batch at a time
+    :param stream: AddressStream to train on instead, with fresh variations of the addresses every epoch
+    :param workers: Number of worker processes preprocessing the stream, see stream_loader
+    :param sequence_layout: How batches are laid out, one of SEQUENCE_LAYOUTS. Defaults to packed on a GPU and trimmed
+        otherwise, as packing is slower than running the few padded steps left in bucketed batches on a CPU. Models
+        are parsed with the same layout as they were trained with by default, see parse_raw_addresses.
+    :param seed: Seed for the order of the batches of each epoch, together with the epoch
     """
+    if dataset is not None:
+        seq_length = dataset.seq_length
+    elif stream is not None:
+        seq_length = stream.seq_length
+    else:
+        seq_length = SEQ_LENGTH
     train_on_gpu = torch.cuda.is_available()
+    sequence_layout = sequence_layout or ("packed" if train_on_gpu else "trimmed")
+    if sequence_layout not in SEQUENCE_LAYOUTS:
+        raise ValueError(f"Unknown sequence layout {sequence_layout}, expected one of {SEQUENCE_LAYOUTS}")
     model = AddressRNN(vocab=VOCAB, lstm_dim=LSTM_DIM, lstm_layers=LSTM_LAYERS,
-                       output_dim=OUTPUT_DIM, seq_length=SEQ_LENGTH, train_on_gpu=train_on_gpu,
+                       output_dim=OUTPUT_DIM, seq_length=seq_length, train_on_gpu=train_on_gpu,
                        batch_first=True)
+    model.sequence_layout = sequence_layout
 
     print("Model architecture:")
     print(model)
 
-    hidden = model.init_hidden(BATCH_SIZE)
     criterion = nn.CrossEntropyLoss()
 
     optimizer = optim.Adam(model.parameters(), lr=LR)
@@ -42,94 +157,83 @@ def train(preprocessed_records):
         model.cuda()
 
     model.train()
-    print(f"Starting training")
+    loader = stream_loader(stream, workers, pin_memory=train_on_gpu) if stream is not None else None
+    print(f"Starting training on {sequence_layout} batches")
     for e in range(EPOCHS):
         batches = 0
+        examples = 0
         loss = None
         accs = []
-        for batch in chunks_from_iter(preprocessed_records, n=BATCH_SIZE, full_chunks_only=True):
-            X = torch.from_numpy(np.array([t[0] for t in batch]))
-            y = torch.from_numpy(np.array([t[1] for t in batch]))
-            if train_on_gpu:
-                X = X.cuda()
-                y = y.cuda()
-
-            # Avoid backpropagating through the entire training history
-            hidden = tuple([h.data for h in hidden])
-            optimizer.zero_grad()
-
-            out, hidden = model(X, hidden)
-            """
-            Align y for computing CrossEntropyLoss. We know that the shape of `out` is
-                (BATCH_SIZE * SEQ_LENGTH, OUTPUT_DIM), i.e. a logit score per output class per character in a batch
-            so we shape `y` to be
-                a vector tensor of dim BATCH_SIZE * SEQ_LENGTH -> True class label per character in the batch.
-
-            This is similar to the below example
-            >>> target = torch.empty(3, dtype=torch.long).random_(5)
-            >>> target
-            tensor([2, 4, 4])
-            >>> output = torch.Tensor([[0, 0 , 20, 0, 0], [0, 0, 0, 0, 14], [0, 0, 0, 0, 25]])
-            >>> output
-            tensor([[ 0.,  0., 20.,  0.,  0.],
-                    [ 0.,  0.,  0.,  0., 14.],
-                    [ 0.,  0.,  0.,  0., 25.]])
-            >>> loss = nn.CrossEntropyLoss()
-            >>> loss(output, target).item()
-            1.1126181789222755e-06
-
-            where target is a vector tensor of dim 3 and the values being some class label between 0 and 4
-            and output is a tensor of dim (3, 5) where each element of row i is the scores for each of the 5 classes.
-            The small loss value shows that the cross entropy loss is behaving as expected for the example provided,
-            since the output has high scores for the correct class labels at the corresponding indexes and zero
-            elsewhere.
-            """
-            y_reshaped = y.reshape(BATCH_SIZE * SEQ_LENGTH)
-            loss = criterion(out, y_reshaped)
-            loss.backward()
-
-            acc = accuracy(out, y_reshaped)
+        if dataset is not None:
+            batches_it = dataset.batches(BATCH_SIZE, shuffle=True, seed=[seed, e], drop_last=True)
+        elif stream is not None:
+            stream.set_epoch(e)
+            batches_it = iter(loader)
+        else:
+            batches_it = _record_batches(preprocessed_records)
+        if sequence_layout != "padded":
+            batches_it = bucketed_batches(batches_it, np.random.default_rng([seed, e]))
+        # Time spent waiting for the next batch, which should be close to nothing if the input keeps up
+        data_wait = 0
+        epoch_start = time.perf_counter()
+        while True:
+            wait_start = time.perf_counter()
+            batch = next(batches_it, None)
+            data_wait += time.perf_counter() - wait_start
+            if batch is None:
+                break
+            loss, acc = train_step(model, optimizer, criterion, *batch, packed=sequence_layout == "packed")
             accs.append(acc)
 
-            # To avoid exploding gradients
-            nn.utils.clip_grad_norm_(model.parameters(), CLIP)
-            optimizer.step()
-
             batches += 1
+            examples += len(batch[0])
             if batches % 10 == 0:
                 print(f"Finished training on {batches} batches in epoch {e}")
                 print(f"Loss so far is {loss.item()}")
                 print(f"Average accuracy is {round(np.average(accs) * 100)}%")
+        epoch_time = time.perf_counter() - epoch_start
         print(f"Finished training for epoch {e}")
         print(f"Loss at end of epoch {e} is {loss.item()}")
+        print(f"Trained on {examples / epoch_time:.0f} samples/sec")
+        print(f"Waited {data_wait:.1f}s of the {epoch_time:.1f}s epoch for input batches")
 
     return model
 
 
-def main(paf_sample_file, model_output_path):
+def main(paf_sample_file, model_output_path, dataset_path=None, workers=None, seed=0, sequence_layout=None):
     """
     We have a structured address dataset that we can use to automatically construct a training set
     for address parsing.
+
+    The sample is streamed and preprocessed by worker processes as it's trained on, with new variations of the
+    addresses every epoch. Trains on a dataset written by preprocess.py instead of the sample if dataset_path is given.
     """
-    records = []
-    print("Loading address data")
-    with open(paf_sample_file, "r") as f:
-        for chunk in chunks_from_iter(f.readlines(), CHUNK_SIZE):
-            records += csv_records_to_dicts(chunk)
-    # List (encoded address, address char labels) pairs. Has to be a materialised list as this
-    # collection will be iterated over multiple times.
-    preprocessed_adds = list(preprocess_addresses(records, seq_length=SEQ_LENGTH))
-    print(f"Starting training with {len(records)} address records and a batch size of {BATCH_SIZE}")
-    model = train(preprocessed_adds)
+    if dataset_path:
+        dataset = ShardedDataset(dataset_path)
+        print(f"Starting training with {len(dataset)} preprocessed examples and a batch size of {BATCH_SIZE}")
+        model = train(dataset=dataset, sequence_layout=sequence_layout, seed=seed)
+    else:
+        stream = AddressStream(paf_sample_file, SEQ_LENGTH, BATCH_SIZE, chunk_size=CHUNK_SIZE, seed=seed)
+        print(f"Starting training on a stream of {paf_sample_file} with a batch size of {BATCH_SIZE}")
+        model = train(stream=stream, workers=workers, sequence_layout=sequence_layout, seed=seed)
     print("Training complete")
     print("Saving model..")
-    torch.save(model, model_output_path)
+    save_checkpoint(model, model_output_path)
     print("Done!")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--paf-sample-path', required=True, help="Path to sample PAF addresses CSV file")
-    parser.add_argument('--model-output-path', required=True, help="Output path to save model object")
+    data = parser.add_mutually_exclusive_group(required=True)
+    data.add_argument('--paf-sample-path', help="Path to sample PAF addresses CSV file")
+    data.add_argument('--dataset-path', help="Path to a dataset of addresses preprocessed by preprocess.py")
+    parser.add_argument('--model-output-path', required=True, help="Output path to save model checkpoint")
+    parser.add_argument('--workers', type=int,
+                        help="Number of processes preprocessing the sample, defaults to all cores but one")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed for the variations of each address and the order of the batches")
+    parser.add_argument('--sequence-layout', choices=SEQUENCE_LAYOUTS,
+                        help="How training batches are laid out, defaults to packed on a GPU and trimmed otherwise")
     args = parser.parse_args()
-    main(args.paf_sample_path, args.model_output_path)
+    main(args.paf_sample_path, args.model_output_path, args.dataset_path, args.workers, args.seed,
+         args.sequence_layout)
@@ -1,68 +1,378 @@
-from collections import defaultdict
+import sys
+from collections import defaultdict, namedtuple
 
-import torch
+import numpy as np
 
-from address_parser.paf import VOCAB_IDX_TO_CHAR, ADDRESS_FIELD_IDX_TO_CLASS
-from address_parser.paf.util import encode_address_str
+from address_parser.paf import (
+    VOCAB, VOCAB_CHAR_TO_IDX, PADDING_CHAR, ADDRESS_FIELD_CLASSES, ADDRESS_FIELD_IDX_TO_CLASS, AddressField
+)
+from address_parser.paf.util import EncodedAddresses, encode_addresses, chunks_from_iter
 
+PARSE_BATCH_SIZE = 512
+# Ways the batches a model is trained on can be laid out, see train.py:
+#   padded: Every example padded to the model seq_length, with the model trained to predict the padding too
+#   trimmed: Examples of similar length batched together and each batch trimmed to its longest example
+#   packed: As trimmed, with each batch run as packed sequences so no padding is computed at all
+SEQUENCE_LAYOUTS = ["padded", "trimmed", "packed"]
+# Number of batches encoded together and sorted by length when parsing with dynamic lengths. A bigger window groups
+# addresses of more similar length into each batch.
+SORT_WINDOW_BATCHES = 8
 
-def address_components_from_pred(encoded_addresses, pred_addresses):
+_VOCAB_ARR = np.array(VOCAB)
+_PADDING_IDX = VOCAB_CHAR_TO_IDX[PADDING_CHAR]
+_PADDING_CLASS = ADDRESS_FIELD_CLASSES[AddressField.PADDING.value]
+_SKIPPED_CLASSES = [ADDRESS_FIELD_CLASSES[AddressField.SEPARATOR.value], _PADDING_CLASS]
+
+
+# Runs of characters predicted as the same class, see components_from_pred:
+#   labels: Predictions of shape (batch_size, seq_length), with everything past the end of each address as padding
+#   run_starts: Boolean matrix of the same shape, true where a run starts
+#   keep: Which of the runs are components rather than separators or padding
+#   rows, starts, ends, classes: Address, start and end in the text and class of each of the kept runs
+_ComponentRuns = namedtuple("_ComponentRuns", ["labels", "run_starts", "keep", "rows", "starts", "ends", "classes"])
+
+
+# torch is only imported once a model is actually run, so that encoding and decoding addresses doesn't pay for it.
+def _inference_mode():
+    import torch
+    # inference_mode is only available from torch 1.9, fall back to no_grad on older versions.
+    return getattr(torch, "inference_mode", torch.no_grad)()
+
+
+def _is_tensor(x):
+    # Nothing can be a tensor unless torch has been imported already, so there's no need to import it to check
+    torch = sys.modules.get("torch")
+    return torch is not None and torch.is_tensor(x)
+
+
+def _as_array(batch):
+    # Accept a 2D tensor/array or a sequence of 1D tensors/arrays, one per address
+    if _is_tensor(batch):
+        return batch.cpu().numpy()
+    return np.stack([r.cpu().numpy() if _is_tensor(r) else np.asarray(r) for r in batch])
+
+
+def address_components_from_pred(encoded_addresses, pred_addresses, addresses=None):
     """
-    :param encoded_addresses: Address batch where each address is represented as a tensor the characters mapped to their
-    integer index
-    :param pred_addresses: Address component predictions from the model where each row is a tensor of the predicted class
-    per character in the address (also encoded as the integer index)
+    :param encoded_addresses: Address batch of shape (batch_size, seq_length) where each address is represented as
+    the characters mapped to their integer index
+    :param pred_addresses: Address component predictions from the model of shape (batch_size, seq_length) where each
+    row is the predicted class per character in the address (also encoded as the integer index)
+    :param addresses: Optional normalised address strings (see normalise_address_str) that were encoded. When not
+    given the text is reconstructed from the encoded addresses.
 
     This method reconstructs the address components in text from the original integer encoded address, and the model
-    class predictions per character.
+    class predictions per character. See components_from_pred.
+    """
+    encoded = _as_array(encoded_addresses)
+    if addresses is None:
+        not_padding = encoded != _PADDING_IDX
+        # Address length is up to and including the last non padding character
+        lengths = np.where(not_padding.any(axis=1), encoded.shape[1] - np.argmax(not_padding[:, ::-1], axis=1), 0)
+        addresses = ["".join(_VOCAB_ARR[row[:length]]) for row, length in zip(encoded, lengths)]
+    offsets = np.zeros(len(addresses) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, addresses), dtype=np.int64, count=len(addresses)), out=offsets[1:])
+    return components_from_pred(pred_addresses, "".join(addresses), offsets)
+
+
+def components_from_pred(pred_addresses, text, offsets, confidence=None):
+    """
+    :param pred_addresses: Address component predictions from the model of shape (batch_size, seq_length)
+    :param text: Normalised addresses concatenated together, as produced by encode_addresses
+    :param offsets: Start of each address in text, of length batch_size + 1
+    :param confidence: Optional probability of each predicted class of shape (batch_size, seq_length), see predict.
+    When given the confidence of each component is returned alongside the components, as a list of dicts.
+
+    Rather than walking every character, the boundaries of each run of characters predicted as the same class are
+    found on the whole batch at once and each component is sliced straight out of the text. Separators, padding and
+    any predictions past the end of the address are skipped.
+    """
+    runs = _component_runs(_as_array(pred_addresses), offsets)
+    final_structured_addresses = [defaultdict(str) for _ in range(len(runs.labels))]
+    for row, start, end, label in zip(runs.rows.tolist(), runs.starts.tolist(), runs.ends.tolist(),
+                                      runs.classes.tolist()):
+        final_structured_addresses[row][ADDRESS_FIELD_IDX_TO_CLASS[label]] += text[start:end]
+
+    if confidence is None:
+        return final_structured_addresses
+    return final_structured_addresses, _component_confidences(runs, _as_array(confidence))
+
+
+def _component_runs(preds, offsets):
+    """
+    Finds the runs of characters predicted as the same class on the whole batch at once, see _ComponentRuns
+    """
+    batch_size, seq_length = preds.shape
+    lengths = np.minimum(np.diff(offsets), seq_length)
+
+    # Treat everything past the end of each address as padding regardless of what was predicted
+    labels = np.where(np.arange(seq_length) < lengths[:, None], preds, _PADDING_CLASS)
+    # A run of characters of the same class starts at the first character or wherever the class changes
+    run_starts = np.ones((batch_size, seq_length), dtype=bool)
+    run_starts[:, 1:] = labels[:, 1:] != labels[:, :-1]
+    rows, starts = np.nonzero(run_starts)
+    run_labels = labels[rows, starts]
+    # Each run ends where the next one in the same row starts, or at the end of the row
+    ends = np.full_like(starts, seq_length)
+    same_row = rows[1:] == rows[:-1]
+    ends[:-1][same_row] = starts[1:][same_row]
+    keep = ~np.isin(run_labels, _SKIPPED_CLASSES)
+    rows = rows[keep]
+    # Absolute positions of each run in the text
+    return _ComponentRuns(labels, run_starts, keep, rows, offsets[rows] + starts[keep], offsets[rows] + ends[keep],
+                         run_labels[keep])
+
+
+def component_columns(pred_addresses, text, offsets, fields):
+    """
+    :param pred_addresses: Address component predictions from the model of shape (batch_size, seq_length)
+    :param text: Normalised addresses concatenated together, as produced by encode_addresses
+    :param offsets: Start of each address in text, of length batch_size + 1
+    :param fields: Address fields to return columns of
+
+    Columnar counterpart of components_from_pred, without a dict per address. Returns a (value_offsets, data) pair
+    for each field, where data is a uint8 array of the bytes of the field's component of every address concatenated
+    and the component of address i is data[value_offsets[i]:value_offsets[i + 1]], empty if the address has none.
+    This is the layout of an Arrow string array.
+    """
+    runs = _component_runs(_as_array(pred_addresses), offsets)
+    batch_size = len(runs.labels)
+    text_bytes = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    columns = {}
+    for field in fields:
+        in_field = runs.classes == ADDRESS_FIELD_CLASSES[field]
+        rows, starts, ends = runs.rows[in_field], runs.starts[in_field], runs.ends[in_field]
+        run_lengths = ends - starts
+        value_offsets = np.zeros(batch_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, weights=run_lengths, minlength=batch_size).astype(np.int64),
+                  out=value_offsets[1:])
+        # Runs are in row order, so gathering the bytes of every run in turn lays out each component in order. Runs
+        # of the same class in one address are joined, as they are by components_from_pred.
+        positions = np.repeat(starts - (np.cumsum(run_lengths) - run_lengths), run_lengths)
+        columns[field] = (value_offsets, text_bytes[positions + np.arange(len(positions))])
+    return columns
+
+
+def _component_confidences(runs, confidence):
+    """
+    Confidence of each component, as the lowest probability the model gave any of its characters. A single shaky
+    character is enough to make the boundary of a component doubtful, which an average over the component would hide.
+    """
+    # Runs partition every row, so the runs of the flattened batch start at the same positions
+    flat_starts = np.flatnonzero(runs.run_starts)
+    run_confidences = np.minimum.reduceat(confidence.reshape(-1), flat_starts)[runs.keep]
+    confidences = [{} for _ in range(len(runs.labels))]
+    for row, label, run_confidence in zip(runs.rows.tolist(), runs.classes.tolist(), run_confidences.tolist()):
+        field = ADDRESS_FIELD_IDX_TO_CLASS[label]
+        # Components split over more than one run are as confident as their least confident run
+        confidences[row][field] = min(confidences[row].get(field, 1.0), run_confidence)
+    return confidences
+
+
+def address_confidence(confidences):
+    """
+    Confidence of a whole parse as that of its least confident component, 1.0 for addresses without any components
+    """
+    return min(confidences.values(), default=1.0)
+
+
+def parse_raw_address(address, model, rules=None, with_confidence=False):
+    return parse_raw_addresses([address], model, batch_size=1, rules=rules, with_confidence=with_confidence)[0]
+
+
+def parse_raw_addresses(addresses, model, batch_size=PARSE_BATCH_SIZE, dynamic_length=None, packed=None,
+                        cache=None, rules=None, with_confidence=False):
+    """
+    :param addresses: Iterable of raw address strings
+    :param model: Trained AddressRNN, which should already be in eval mode
+    :param batch_size: Number of addresses encoded and run through the model in one forward pass
+    :param dynamic_length: Group addresses of similar length into batches and trim each batch to its longest address.
+    Otherwise every address is run padded to the model seq_length. Trimming is faster, but for models trained on
+    padded sequences the backward LSTM direction relies on the padding that follows an address, so addresses that
+    end in a postcode can be mislabelled when there's little or no padding after them (e.g. with a batch size of 1).
+    Accuracy over a whole dataset is close to padded parsing, so it's worth turning on for bulk parsing. Defaults to
+    whether the model was trained on trimmed or packed batches (see SEQUENCE_LAYOUTS), which parse best this way.
+    :param packed: With dynamic_length, also run each batch as packed sequences so that no padding is computed at all.
+    On CPU the packing overhead tends to outweigh the few padded steps left after sorting, and for models trained on
+    padded sequences the predictions of the backward LSTM direction can differ slightly. Models trained on packed
+    sequences parse best packed though, so it defaults to whether the model was.
+    :param cache: Optional ParseCache opened with the same model. Addresses found in the cache skip the model
+    altogether and newly parsed addresses are added to it.
+    :param rules: Optional RuleParser (see rules.py). Addresses that it parses confidently skip the model altogether.
+    :param with_confidence: Return (components, confidences) pairs, where confidences maps each component to the
+    lowest probability the model gave any of its characters. Components parsed by the rules have a confidence of 1.0.
+    Confidences aren't cached, so this can't be combined with a cache.
+
+    Parses addresses in batches without building autograd graphs and returns the parsed components of each address
+    in the same order as the input.
+    """
+    if with_confidence and cache is not None:
+        raise ValueError("Confidences aren't cached, parse with either a cache or with_confidence")
+    dynamic_length, packed = _parse_options(model, dynamic_length, packed)
+    window_size = batch_size * SORT_WINDOW_BATCHES if dynamic_length else batch_size
+    parsed = []
+    with _inference_mode():
+        for window in chunks_from_iter(addresses, window_size):
+            ruled = rules.parse_many(window) if rules is not None else [None] * len(window)
+            if with_confidence:
+                ruled = [(c, dict.fromkeys(c, 1.0)) if c is not None else None for c in ruled]
+            window = [address for address, components in zip(window, ruled) if components is None]
+            window_parsed = []
+            if window:
+                addresses_enc = encode_addresses(window, model.seq_length)
+                if cache is None:
+                    window_parsed = _parse_encoded(addresses_enc, model, batch_size, dynamic_length, packed,
+                                                   with_confidence)
+                    if with_confidence:
+                        window_parsed = zip(*window_parsed)
+                else:
+                    window_parsed = _parse_encoded_cached(addresses_enc, model, batch_size, dynamic_length, packed,
+                                                          cache)
+            # Fill in the addresses the rules couldn't parse, in order
+            window_parsed = iter(window_parsed)
+            parsed.extend(components if components is not None else next(window_parsed) for components in ruled)
+
+    return parsed
+
+
+def _parse_options(model, dynamic_length, packed):
+    # Parse the way the model was trained unless told otherwise, see parse_raw_addresses
+    sequence_layout = getattr(model, "sequence_layout", "padded")
+    dynamic_length = sequence_layout != "padded" if dynamic_length is None else dynamic_length
+    packed = sequence_layout == "packed" if packed is None else packed
+    return dynamic_length, packed
+
+
+def parse_encoded_columns(addresses_enc, model, fields, batch_size=PARSE_BATCH_SIZE, dynamic_length=None,
+                          packed=None):
+    """
+    :param addresses_enc: EncodedAddresses, e.g. from encode_address_buffer
+    :param model: Trained AddressRNN, which should already be in eval mode
+    :param fields: Address fields to return columns of
+    :param batch_size, dynamic_length, packed: See parse_raw_addresses
+
+    Parses addresses that are already encoded into columns of components, see component_columns.
+    """
+    dynamic_length, packed = _parse_options(model, dynamic_length, packed)
+    window_size = batch_size * SORT_WINDOW_BATCHES if dynamic_length else batch_size
+    encoded, text, offsets = addresses_enc
+    preds = np.empty(encoded.shape, dtype=np.uint8)
+    with _inference_mode():
+        for start in range(0, len(encoded), window_size):
+            # Offsets are into the whole text, so a window's offsets are just a slice of them
+            window = EncodedAddresses(encoded[start:start + window_size], text, offsets[start:start + window_size + 1])
+            preds[start:start + window_size] = _as_array(_predict_encoded(window, model, batch_size, dynamic_length,
+                                                                          packed))
+    return component_columns(preds, text, offsets, fields)
+
+
+def _predict_encoded(addresses_enc, model, batch_size, dynamic_length, packed, with_confidence=False):
+    import torch
+    if dynamic_length:
+        return predict_by_length(addresses_enc.encoded, np.diff(addresses_enc.offsets), model, batch_size, packed,
+                                  with_confidence)
+    return predict(torch.from_numpy(addresses_enc.encoded), model, with_confidence=with_confidence)
+
+
+def _parse_encoded(addresses_enc, model, batch_size, dynamic_length, packed, with_confidence=False):
+    preds = _predict_encoded(addresses_enc, model, batch_size, dynamic_length, packed, with_confidence)
+    confidence = None
+    if with_confidence:
+        preds, confidence = preds
+    return components_from_pred(preds, addresses_enc.text, addresses_enc.offsets, confidence)
+
+
+def _parse_encoded_cached(addresses_enc, model, batch_size, dynamic_length, packed, cache):
+    text, offsets = addresses_enc.text, addresses_enc.offsets
+    normalised = [text[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+    # Trimmed and packed parses can differ from padded ones, so each way of parsing has its own entries. Normalised
+    # addresses can contain tabs, but the prefix is always one of three words without one, so a key still splits at
+    # its first tab into a single way of parsing and address.
+    prefix = ("packed" if packed else "trimmed") if dynamic_length else "padded"
+    keys = [f"{prefix}\t{address}" for address in normalised]
+    cached = cache.get_many(keys)
+    # Each distinct address missing from the cache only goes through the model once. Normalised addresses encode to
+    # the same thing as the raw ones.
+    missing = [(key, i) for key, i in dict((key, i) for i, key in enumerate(keys)).items() if key not in cached]
+    if missing:
+        missing_parsed = _parse_encoded(encode_addresses([normalised[i] for _, i in missing], model.seq_length), model,
+                                        batch_size, dynamic_length, packed)
+        missing_keys = [key for key, _ in missing]
+        cache.put_many(zip(missing_keys, missing_parsed))
+        cached.update(zip(missing_keys, missing_parsed))
+    # Give every input its own copy, addresses that only differ in case or unknown characters share a normalised form
+    return [defaultdict(str, cached[key]) for key in keys]
+
+
+def predict_by_length(encoded, lengths, model, batch_size, packed=False, with_confidence=False):
+    """
+    :param encoded: Encoded addresses of shape (n, seq_length)
+    :param lengths: Number of characters in each address
+    :param packed: Run each batch as packed sequences
+    :param with_confidence: Also return the probability of each predicted class, see predict
+
+    Sorts addresses by length so that each batch only needs to be as wide as its longest address and returns the
+    predictions of shape (n, seq_length) back in input order.
     """
-    with_preds = list(zip(encoded_addresses, pred_addresses))
-    final_structured_addresses = []
-    for enc_address, address_preds in with_preds:
-        idxes = range(enc_address.shape[0])
-        # Map the address chars as well as the class prediction for each character back to the text representation
-        mapped_to_text = [(VOCAB_IDX_TO_CHAR[enc_address[i].item()],
-                           ADDRESS_FIELD_IDX_TO_CLASS[address_preds[i].item()])
-                          for i in idxes]
-        predicted_structured_address = defaultdict(str)
-        for char_class_pair in mapped_to_text:
-            # Build up the address components by reconstructing the string of each component from the characters
-            predicted_structured_address[char_class_pair[1]] += char_class_pair[0]
-        final_structured_addresses.append(predicted_structured_address)
+    import torch
+    n, seq_length = encoded.shape
+    # Empty addresses can't be packed so they get a single (padding) step
+    lengths = np.clip(lengths, 1, seq_length)
+    order = np.argsort(lengths, kind="stable")
+    preds = np.full((n, seq_length), _PADDING_CLASS, dtype=np.int64)
+    # Predictions past the end of an address are ignored, so they don't make an address any less confident
+    confidence = np.ones((n, seq_length), dtype=np.float32) if with_confidence else None
+    for start in range(0, n, batch_size):
+        batch_idx = order[start:start + batch_size]
+        batch_lengths = lengths[batch_idx]
+        # Sorted in ascending order so the last address is the longest one in the batch
+        max_length = batch_lengths[-1]
+        batch = torch.from_numpy(encoded[batch_idx, :max_length])
+        batch_lengths = torch.from_numpy(batch_lengths) if packed else None
+        batch_preds = predict(batch, model, lengths=batch_lengths, with_confidence=with_confidence)
+        if with_confidence:
+            batch_preds, batch_confidence = batch_preds
+            confidence[batch_idx, :max_length] = batch_confidence.cpu().numpy()
+        preds[batch_idx, :max_length] = batch_preds.cpu().numpy()
 
-    return final_structured_addresses
+    return (preds, confidence) if with_confidence else preds
 
 
-def parse_raw_address(address, model):
-    address_enc = encode_address_str(address, model.seq_length)
-    pred = predict_one(address_enc, model)
-    parsed_components = address_components_from_pred([address_enc], [pred])
-    return parsed_components[0]
+def _classes(scores, dim, with_confidence):
+    import torch
+    if with_confidence:
+        # Probability of the highest scoring class alongside the class itself
+        confidence, classes = torch.softmax(scores.float(), dim=dim).max(dim=dim)
+        return classes, confidence
+    return scores.argmax(dim=dim)
 
 
-def predict_one(address_encoded, model):
+def predict_one(address_encoded, model, with_confidence=False):
+    import torch
     # Batch size of 1
-    hidden = model.init_hidden(1)
-    address_encoded_tensor = torch.from_numpy(address_encoded)
+    hidden = model.cached_hidden(1)
+    address_encoded_tensor = torch.from_numpy(address_encoded).long()
     address_encoded_tensor = address_encoded_tensor.view(1, *address_encoded_tensor.shape)
-    pred, _ = model.forward(address_encoded_tensor, hidden)
+    pred, _ = model.forward(address_encoded_tensor.to(hidden[0].device), hidden)
     # Highest scoring class per character
-    return pred.argmax(dim=1)
+    return _classes(pred, 1, with_confidence)
 
 
-def predict(addresses_encoded, model):
-    # Predicts on a batch in one go, much faster than using predict_one
+def predict(addresses_encoded, model, lengths=None, with_confidence=False):
+    # Predicts on a batch in one go, much faster than using predict_one. If the lengths of each address are given the
+    # padding is skipped with packed sequences, see AddressRNN.forward. With with_confidence the softmax probability
+    # of each predicted class is returned too, as a (classes, confidence) pair.
     batch_size = len(addresses_encoded)
-    hidden = model.init_hidden(batch_size)
-    preds, _ = model.forward(addresses_encoded, hidden)
+    hidden = model.cached_hidden(batch_size)
+    preds, _ = model.forward(addresses_encoded.to(hidden[0].device).long(), hidden, lengths)
     # Model returns the predictions flattened so we need to reshape to maintain the original
     # batch rows, which represent the input addresses.
     preds = preds.view(batch_size, -1, model.output_dim)
     # Highest scoring class per character (first dim is the batch size)
-    return preds.argmax(dim=2)
+    return _classes(preds, 2, with_confidence)
 
 
 def accuracy(out, target):
     # Accuracy calculated based on the correct classification of each element in each row in a batch.
     class_preds = out.argmax(dim=1)
-    return (torch.sum(class_preds == target) / len(target)).item()
+    return ((class_preds == target).sum() / len(target)).item()
@@ -0,0 +1,14 @@
+from address_parser.paf import VOCAB, ADDRESS_FIELD_CLASSES
+
+
+def tiny_model(seed=0, lstm_dim=8, lstm_layers=2, seq_length=30):
+    """
+    Small untrained AddressRNN in eval mode for tests, seeded so that it makes the same parses every run
+    """
+    import torch
+    from address_parser.rnn import AddressRNN
+    torch.manual_seed(seed)
+    model = AddressRNN(vocab=VOCAB, lstm_dim=lstm_dim, lstm_layers=lstm_layers, output_dim=len(ADDRESS_FIELD_CLASSES),
+                       embedding_dim=3, seq_length=seq_length, batch_first=True)
+    model.eval()
+    return model
@@ -0,0 +1,44 @@
+import copy
+from unittest import TestCase
+
+from address_parser.bench.suite import STAGES, compare_results, median_results, run_suite
+from address_parser.tests import tiny_model
+
+
+class TestBenchSuite(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.results = run_suite(tiny_model(), batch_sizes=[128], thread_counts=[1], num_addresses=50)
+
+    def test_every_stage_measured(self):
+        self.assertEqual([r["stage"] for r in self.results["results"]], STAGES)
+        for r in self.results["results"]:
+            self.assertGreater(r["throughput"], 0)
+            self.assertLessEqual(r["p50_ms"], r["p99_ms"])
+
+    def test_compare_flags_regressions_only(self):
+        self.assertEqual(compare_results(self.results, self.results), [])
+        slower = copy.deepcopy(self.results)
+        slower["results"][0]["throughput"] /= 2
+        # Improvements aren't regressions
+        slower["results"][1]["throughput"] *= 2
+        regressions = compare_results(slower, self.results)
+        self.assertEqual([(r["stage"], r["metric"]) for r in regressions], [(STAGES[0], "throughput")])
+
+    def test_tolerance_per_metric(self):
+        baseline = copy.deepcopy(self.results)
+        baseline["results"][0]["p99_ms"] = 10.0
+        slower = copy.deepcopy(baseline)
+        slower["results"][0]["p99_ms"] = 15.0
+        # p99 latency is too noisy to flag a 50% change by default, unless a tolerance is given for every metric
+        self.assertEqual(compare_results(slower, baseline), [])
+        self.assertEqual([r["metric"] for r in compare_results(slower, baseline, tolerance=0.25)], ["p99_ms"])
+
+    def test_median_results(self):
+        runs = [copy.deepcopy(self.results) for _ in range(3)]
+        for run, throughput in zip(runs, [100.0, 300.0, 200.0]):
+            run["results"][0]["throughput"] = throughput
+        median = median_results(runs)
+        self.assertEqual(median["results"][0]["throughput"], 200.0)
+        self.assertEqual(median["results"][1], self.results["results"][1])
+        self.assertEqual(median["config"]["runs"], 3)
@@ -0,0 +1,77 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from address_parser.rnn.cache import ParseCache, model_fingerprint
+from address_parser.rnn.quantize import quantize_model
+from address_parser.rnn.util import parse_raw_addresses
+from address_parser.tests import tiny_model
+
+
+class TestParseCache(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "cache.db")
+        self.model = tiny_model(0)
+        self.addresses = ["165 Fleet Street, London EC4A 2DY", "165 FLEET STREET, LONDON EC4A 2DY", "1 a road"]
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_fingerprint_depends_on_weights(self):
+        self.assertEqual(model_fingerprint(self.model), model_fingerprint(tiny_model(0)))
+        self.assertNotEqual(model_fingerprint(self.model), model_fingerprint(tiny_model(1)))
+
+    def test_fingerprint_of_quantized_model_is_stable(self):
+        # Quantizing the same model twice packs the same weights, so the cache survives reopening with an int8 model
+        fingerprint = model_fingerprint(quantize_model(self.model))
+        self.assertEqual(model_fingerprint(quantize_model(tiny_model(0))), fingerprint)
+        self.assertNotEqual(model_fingerprint(quantize_model(tiny_model(1))), fingerprint)
+        self.assertNotEqual(model_fingerprint(self.model), fingerprint)
+
+    def test_cached_parses_match_model(self):
+        expected = parse_raw_addresses(self.addresses, self.model)
+        with ParseCache(self.path, self.model) as cache:
+            self.assertEqual(parse_raw_addresses(self.addresses, self.model, cache=cache), expected)
+            self.assertEqual(cache.stats()["misses"], 3)
+            self.assertEqual(parse_raw_addresses(self.addresses, self.model, cache=cache), expected)
+            self.assertEqual(cache.stats()["memory_hits"], 3)
+
+        # Reopened with an empty in-memory LRU the parses come back from disk
+        with ParseCache(self.path, self.model) as cache:
+            self.assertEqual(parse_raw_addresses(self.addresses, self.model, cache=cache), expected)
+            self.assertEqual(cache.stats(), {"hits": 3, "memory_hits": 0, "disk_hits": 3, "misses": 0,
+                                             "hit_rate": 1.0})
+
+    def test_keyed_by_parse_options(self):
+        with ParseCache(self.path, self.model) as cache:
+            parse_raw_addresses(self.addresses, self.model, cache=cache)
+            for dynamic_length, packed in [(True, False), (True, True)]:
+                expected = parse_raw_addresses(self.addresses, self.model, batch_size=1, dynamic_length=dynamic_length,
+                                               packed=packed)
+                parsed = parse_raw_addresses(self.addresses, self.model, batch_size=1, dynamic_length=dynamic_length,
+                                             packed=packed, cache=cache)
+                self.assertEqual(parsed, expected)
+            # Every way of parsing missed the padded parses already in the cache
+            self.assertEqual(cache.stats()["misses"], 9)
+
+    def test_parses_are_copies(self):
+        with ParseCache(self.path, self.model) as cache:
+            parsed = parse_raw_addresses(self.addresses, self.model, cache=cache)
+            # The first two addresses share the same normalised form
+            parsed[0]["input_address"] = self.addresses[0]
+            self.assertNotIn("input_address", parsed[1])
+            self.assertNotIn("input_address", parse_raw_addresses(self.addresses, self.model, cache=cache)[0])
+
+    def test_invalidated_by_different_model(self):
+        with ParseCache(self.path, self.model) as cache:
+            parse_raw_addresses(self.addresses, self.model, cache=cache)
+        other_model = tiny_model(1)
+        with ParseCache(self.path, other_model) as cache:
+            parse_raw_addresses(self.addresses, other_model, cache=cache)
+            self.assertEqual(cache.stats()["hits"], 0)
+
+    def test_memory_lru_bounded(self):
+        with ParseCache(self.path, self.model, memory_size=2) as cache:
+            parse_raw_addresses([str(i) for i in range(5)], self.model, cache=cache)
+            self.assertEqual(len(cache._memory), 2)
@@ -0,0 +1,54 @@
+from unittest import TestCase
+
+from address_parser.rnn.cascade import Cascade
+from address_parser.rnn.rules import RuleParser
+from address_parser.rnn.util import parse_raw_addresses
+from address_parser.tests import tiny_model
+
+
+class TestCascade(TestCase):
+    def setUp(self) -> None:
+        self.small = tiny_model(lstm_dim=4, lstm_layers=1)
+        self.large = tiny_model(seed=1, lstm_layers=1)
+        self.addresses = [
+            "25 Christopher street, moorgate, london, eC2a 2bs, uk",
+            "165 Fleet Street, London EC4A 2DY",
+            "The Gherkin, London EC3A 8BF",
+            "",
+            "1 a road, somewhere, ab1 2cd",
+        ]
+
+    def test_nothing_escalated_below_zero(self):
+        cascade = Cascade(self.small, self.large, threshold=0)
+        self.assertEqual(cascade.parse(self.addresses), parse_raw_addresses(self.addresses, self.small))
+        self.assertEqual((cascade.addresses, cascade.escalated), (5, 0))
+
+    def test_shaky_parses_escalated(self):
+        # An untrained model is never fully confident, so everything with a component is escalated
+        cascade = Cascade(self.small, self.large, threshold=1)
+        self.assertEqual(cascade.parse(self.addresses, batch_size=2), parse_raw_addresses(self.addresses, self.large))
+        self.assertEqual(cascade.stats(), {"addresses": 5, "escalated": 4, "escalation_rate": 0.8, "threshold": 1})
+
+    def test_escalates_by_confidence(self):
+        small_parsed = parse_raw_addresses(self.addresses, self.small, with_confidence=True)
+        threshold = sorted(min(c.values()) for _, c in small_parsed if c)[2]
+        cascade = Cascade(self.small, self.large, threshold=threshold)
+        parsed = cascade.parse(self.addresses, with_confidence=True)
+        large_parsed = parse_raw_addresses(self.addresses, self.large, with_confidence=True)
+        for i, (_, confidences) in enumerate(small_parsed):
+            escalated = min(confidences.values(), default=1.0) < threshold
+            self.assertEqual(parsed[i], large_parsed[i] if escalated else small_parsed[i])
+        self.assertEqual(cascade.escalated, 2)
+
+    def test_rules_skip_both_models(self):
+        cascade = Cascade(self.small, self.large, threshold=1)
+        parsed = cascade.parse(self.addresses, rules=RuleParser(posttowns=["london"]), with_confidence=True)
+        self.assertEqual(parsed[1], ({
+            "building_number": "165", "thoroughfare_and_descriptor": "fleet street", "posttown": "london",
+            "postcode": "ec4a 2dy"
+        }, {"building_number": 1.0, "thoroughfare_and_descriptor": 1.0, "posttown": 1.0, "postcode": 1.0}))
+        self.assertEqual(cascade.escalated, 3)
+
+    def test_threshold_out_of_range(self):
+        with self.assertRaises(ValueError):
+            Cascade(self.small, self.large, threshold=1.5)
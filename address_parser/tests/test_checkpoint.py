@@ -0,0 +1,144 @@
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+import torch
+
+from address_parser.rnn import AddressRNN
+from address_parser.rnn.checkpoint import (
+    load_model, model_from_checkpoint, save_checkpoint, TorchScriptModel, OnnxModel
+)
+from address_parser.rnn.export import export_torchscript, export_onnx
+from address_parser.rnn.util import parse_raw_addresses
+from address_parser.tests import tiny_model
+
+try:
+    import onnx  # noqa: F401
+    import onnxruntime  # noqa: F401
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
+
+class TestCheckpoint(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "model.pt")
+        self.model = tiny_model()
+        self.addresses = ["165 Fleet Street, London EC4A 2DY", "The Gherkin, London EC3A 8BF", ""]
+        self.expected = parse_raw_addresses(self.addresses, self.model, dynamic_length=False)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_checkpoint_round_trip(self):
+        save_checkpoint(self.model, self.path)
+        loaded = load_model(self.path)
+        self.assertIsInstance(loaded, AddressRNN)
+        self.assertFalse(loaded.training)
+        self.assertEqual(loaded.seq_length, 30)
+        self.assertEqual(parse_raw_addresses(self.addresses, loaded, dynamic_length=False), self.expected)
+
+    def test_sequence_layout_round_trip(self):
+        self.model.sequence_layout = "trimmed"
+        save_checkpoint(self.model, self.path)
+        loaded = load_model(self.path)
+        self.assertEqual(loaded.sequence_layout, "trimmed")
+        # Models trained on trimmed batches are parsed trimmed by default
+        self.assertEqual(parse_raw_addresses(self.addresses, loaded),
+                         parse_raw_addresses(self.addresses, self.model, dynamic_length=True, packed=False))
+
+    def test_newer_format_rejected(self):
+        save_checkpoint(self.model, self.path)
+        checkpoint = torch.load(self.path)
+        checkpoint["format_version"] += 1
+        torch.save(checkpoint, self.path)
+        with self.assertRaises(ValueError):
+            load_model(self.path)
+
+    def test_model_moved_to_map_location(self):
+        save_checkpoint(self.model, self.path)
+        # The meta device stands in for a GPU, as the weights have to be moved there rather than only loaded there
+        loaded = model_from_checkpoint(torch.load(self.path), map_location="meta")
+        self.assertEqual({p.device.type for p in loaded.parameters()}, {"meta"})
+        self.assertEqual(loaded.cached_hidden(2)[0].device.type, "meta")
+        self.assertFalse(loaded._train_on_gpu)
+
+    def test_different_labels_rejected(self):
+        save_checkpoint(self.model, self.path)
+        checkpoint = torch.load(self.path)
+        labels = checkpoint["config"]["labels"]
+        labels[0], labels[1] = labels[1], labels[0]
+        torch.save(checkpoint, self.path)
+        with self.assertRaises(ValueError):
+            load_model(self.path)
+
+    def test_pickled_model_still_loads(self):
+        torch.save(self.model, self.path)
+        with self.assertWarns(UserWarning):
+            loaded = load_model(self.path)
+        self.assertEqual(parse_raw_addresses(self.addresses, loaded, dynamic_length=False), self.expected)
+
+    def test_auto_backend_uses_matching_export(self):
+        save_checkpoint(self.model, self.path)
+        export_torchscript(self.model, os.path.join(self.tmp_dir.name, "model.ts"))
+        loaded = load_model(self.path, backend="torchscript" if not ONNX_AVAILABLE else "auto")
+        self.assertIsInstance(loaded, TorchScriptModel)
+        self.assertEqual(parse_raw_addresses(self.addresses, loaded, dynamic_length=False), self.expected)
+        self.assertEqual(parse_raw_addresses(self.addresses, loaded), parse_raw_addresses(self.addresses, self.model))
+
+        # Exports of different weights are ignored
+        save_checkpoint(tiny_model(seed=1), self.path)
+        self.assertIsInstance(load_model(self.path), AddressRNN)
+
+        # Exports are matched by the fingerprint stored in the checkpoint rather than by hashing its weights again
+        save_checkpoint(self.model, self.path)
+        checkpoint = torch.load(self.path)
+        checkpoint["fingerprint"] = "stale"
+        torch.save(checkpoint, self.path)
+        self.assertIsInstance(load_model(self.path), AddressRNN)
+
+    @skipUnless(ONNX_AVAILABLE, "onnx and onnxruntime are needed for ONNX exports")
+    def test_onnx_export(self):
+        save_checkpoint(self.model, self.path)
+        export_onnx(self.model, os.path.join(self.tmp_dir.name, "model.onnx"))
+        loaded = load_model(self.path)
+        self.assertIsInstance(loaded, OnnxModel)
+        self.assertEqual(parse_raw_addresses(self.addresses, loaded, dynamic_length=False), self.expected)
+
+    @skipUnless(ONNX_AVAILABLE, "onnx and onnxruntime are needed for ONNX exports")
+    def test_onnx_export_without_dynamo_option(self):
+        export = torch.onnx.export
+
+        def export_before_dynamo(model, args, f, input_names=None, output_names=None, dynamic_axes=None,
+                                 opset_version=None):
+            # torch.onnx.export of versions before 2.5, which don't take dynamo
+            return export(model, args, f, input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, dynamo=False)
+
+        with patch.object(torch.onnx, "export", export_before_dynamo):
+            export_onnx(self.model, os.path.join(self.tmp_dir.name, "model.onnx"))
+        loaded = OnnxModel(os.path.join(self.tmp_dir.name, "model.onnx"))
+        self.assertEqual(parse_raw_addresses(self.addresses, loaded, dynamic_length=False), self.expected)
+
+    def test_trimmed_exports_parse_trimmed(self):
+        self.model.sequence_layout = "trimmed"
+        expected = parse_raw_addresses(self.addresses, self.model, batch_size=2)
+        export_torchscript(self.model, os.path.join(self.tmp_dir.name, "model.ts"))
+        exports = [TorchScriptModel(os.path.join(self.tmp_dir.name, "model.ts"))]
+        if ONNX_AVAILABLE:
+            export_onnx(self.model, os.path.join(self.tmp_dir.name, "model.onnx"))
+            exports.append(OnnxModel(os.path.join(self.tmp_dir.name, "model.onnx")))
+        for export in exports:
+            self.assertEqual(export.sequence_layout, "trimmed")
+            self.assertEqual(parse_raw_addresses(self.addresses, export, batch_size=2), expected)
+
+    def test_packed_exports_parse_trimmed(self):
+        self.model.sequence_layout = "packed"
+        export_torchscript(self.model, os.path.join(self.tmp_dir.name, "model.ts"))
+        with self.assertWarns(UserWarning):
+            export = TorchScriptModel(os.path.join(self.tmp_dir.name, "model.ts"))
+        self.assertEqual(export.sequence_layout, "trimmed")
+        self.assertEqual(parse_raw_addresses(self.addresses, export),
+                         parse_raw_addresses(self.addresses, self.model, dynamic_length=True, packed=False))
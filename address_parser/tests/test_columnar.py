@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+import pandas as pd
+import pyarrow as pa
+
+from address_parser.rnn.columnar import parse_arrow, parse_series
+from address_parser.rnn.output import COMPONENT_FIELDS
+from address_parser.rnn.util import parse_raw_addresses
+from address_parser.tests import tiny_model
+
+
+class TestColumnar(TestCase):
+    def setUp(self) -> None:
+        self.model = tiny_model(lstm_layers=1)
+        self.addresses = [
+            "25 Christopher street, moorgate, london, eC2a 2bs, uk",
+            "165 Fleet Street, London EC4A 2DY",
+            "",
+            "The Gherkin, London EC3A 8BF",
+            "Flat 1, Cafe Noir, 1 a road, somewhere, ab1 2cd",
+        ]
+
+    def _assert_parsed(self, table, addresses, **kwargs):
+        self.assertEqual(table.column_names, COMPONENT_FIELDS)
+        rows = table.to_pylist()
+        expected = parse_raw_addresses([a for a in addresses if a is not None], self.model, **kwargs)
+        for row, address in zip(rows, addresses):
+            if address is None:
+                self.assertEqual(row, dict.fromkeys(COMPONENT_FIELDS))
+            else:
+                self.assertEqual({k: v for k, v in row.items() if v}, expected.pop(0))
+
+    def test_matches_parse_raw_addresses(self):
+        self._assert_parsed(parse_arrow(pa.array(self.addresses), self.model), self.addresses)
+        self._assert_parsed(parse_arrow(pa.array(self.addresses), self.model, batch_size=2, dynamic_length=True),
+                            self.addresses, batch_size=2, dynamic_length=True)
+
+    def test_nulls(self):
+        addresses = [None] + self.addresses[:2] + [None, None] + self.addresses[2:]
+        table = parse_arrow(pa.array(addresses), self.model)
+        self._assert_parsed(table, addresses)
+        self.assertEqual(table.column("postcode").null_count, 3)
+        # Empty addresses have empty rather than null components
+        self.assertEqual(table.column("postcode")[5].as_py(), "")
+
+    def test_null_slots_with_bytes(self):
+        # Arrow doesn't require null slots to be empty, so give one the bytes of another address
+        offsets = pa.py_buffer(pa.array([0, 5, 10], type=pa.int32()).buffers()[1])
+        validity = pa.array([True, False]).buffers()[1]
+        array = pa.StringArray.from_buffers(2, offsets, pa.py_buffer(b"ab1 2cd1 2"), validity, 1)
+        self._assert_parsed(parse_arrow(array, self.model), ["ab1 2", None])
+
+    def test_sliced_chunked_and_large(self):
+        addresses = self.addresses + [None] + self.addresses
+        array = pa.array(addresses).slice(2, 7)
+        self._assert_parsed(parse_arrow(array, self.model), addresses[2:9])
+        chunked = pa.chunked_array([pa.array(addresses[:3]), pa.array(addresses[3:])])
+        table = parse_arrow(chunked, self.model)
+        self.assertEqual(table.num_rows, len(addresses))
+        self._assert_parsed(table, addresses)
+        self._assert_parsed(parse_arrow(pa.array(addresses, type=pa.large_string()).slice(1), self.model),
+                            addresses[1:])
+
+    def test_empty(self):
+        table = parse_arrow(pa.array([], type=pa.string()), self.model)
+        self.assertEqual((table.num_rows, table.column_names), (0, COMPONENT_FIELDS))
+
+    def test_parse_series(self):
+        series = pd.Series(self.addresses + [None, float("nan")], index=list("abcdefg"))
+        df = parse_series(series, self.model)
+        self.assertEqual(list(df.columns), COMPONENT_FIELDS)
+        self.assertEqual(list(df.index), list("abcdefg"))
+        expected = parse_raw_addresses(self.addresses, self.model)
+        for label, components in zip("abcde", expected):
+            row = df.loc[label]
+            self.assertEqual({k: v for k, v in row.items() if v}, components)
+        self.assertTrue(df.loc[["f", "g"]].isna().all().all())
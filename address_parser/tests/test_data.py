@@ -0,0 +1,45 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from address_parser.bench.synthetic import synthetic_paf_lines
+from address_parser.paf import PAF_SCHEMA
+from address_parser.rnn.data import AddressStream, stream_loader
+
+
+def _epoch(stream, epoch, workers):
+    stream.set_epoch(epoch)
+    batches = list(stream_loader(stream, workers))
+    return torch.cat([f for f, _ in batches]).numpy(), torch.cat([l for _, l in batches]).numpy()
+
+
+class TestAddressStream(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "sample.csv")
+        with open(self.path, "w") as f:
+            f.write(",".join(PAF_SCHEMA) + "\n")
+            f.writelines(synthetic_paf_lines(120))
+        self.stream = AddressStream(self.path, seq_length=40, batch_size=1, shuffle_buffer=16, chunk_size=10, seed=1)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_every_record_once_per_epoch(self):
+        features, labels = _epoch(self.stream, 0, workers=2)
+        # Every record but not the header
+        self.assertEqual(features.shape, (120, 40))
+        self.assertEqual((features.dtype, labels.dtype), (np.uint8, np.uint8))
+
+    def test_fresh_variations_every_epoch(self):
+        first, _ = _epoch(self.stream, 0, workers=2)
+        np.testing.assert_array_equal(_epoch(self.stream, 0, workers=2)[0], first)
+        self.assertFalse(np.array_equal(_epoch(self.stream, 1, workers=2)[0], first))
+
+    def test_full_batches_only(self):
+        stream = AddressStream(self.path, seq_length=40, batch_size=32, shuffle_buffer=50, chunk_size=10)
+        batches = list(stream_loader(stream, workers=0))
+        self.assertEqual([len(f) for f, _ in batches], [32] * 3)
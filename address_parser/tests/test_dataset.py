@@ -0,0 +1,98 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from address_parser.bench.synthetic import synthetic_paf_lines
+from address_parser.paf import preprocess
+from address_parser.paf.dataset import ShardedDataset, ShardedDatasetWriter
+
+
+class TestShardedDataset(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "dataset")
+        rng = np.random.default_rng(0)
+        self.features = rng.integers(0, 75, size=(25, 10), dtype=np.uint8)
+        self.labels = rng.integers(0, 12, size=(25, 10), dtype=np.uint8)
+        with ShardedDatasetWriter(self.path, seq_length=10, shard_size=7) as writer:
+            # Writes that straddle shards
+            writer.write(self.features[:5], self.labels[:5])
+            writer.write(self.features[5:], self.labels[5:])
+        self.dataset = ShardedDataset(self.path)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_shards_and_manifest(self):
+        self.assertEqual(len(self.dataset), 25)
+        self.assertEqual([s["num_examples"] for s in self.dataset.shards], [7, 7, 7, 4])
+        features, labels = self.dataset.shard(1)
+        self.assertIsInstance(features, np.memmap)
+        self.assertEqual(features.dtype, np.uint8)
+        np.testing.assert_array_equal(labels, self.labels[7:14])
+
+    def test_random_access(self):
+        idx = np.array([24, 0, 8, 7, 13, -1])
+        features, labels = self.dataset[idx]
+        np.testing.assert_array_equal(features, self.features[idx])
+        np.testing.assert_array_equal(labels, self.labels[idx])
+        np.testing.assert_array_equal(self.dataset[5:16][0], self.features[5:16])
+        np.testing.assert_array_equal(self.dataset[9][1], self.labels[9])
+        with self.assertRaises(IndexError):
+            self.dataset[[25]]
+
+    def test_shuffled_batches(self):
+        batches = list(self.dataset.batches(4, shuffle=True, seed=1, drop_last=True))
+        self.assertEqual(len(batches), 6)
+        rows = np.concatenate([features for features, _ in batches])
+        # Every example at most once, with labels kept alongside their features
+        self.assertEqual(len({r.tobytes() for r in rows}), 24)
+        for features, labels in batches:
+            for f, l in zip(features, labels):
+                i = np.flatnonzero((self.features == f).all(axis=1))[0]
+                np.testing.assert_array_equal(l, self.labels[i])
+        self.assertEqual([b[0].tobytes() for b in self.dataset.batches(4, shuffle=True, seed=1, drop_last=True)],
+                         [b[0].tobytes() for b in batches])
+
+    def test_batches_seeded_by_run_and_epoch(self):
+        # As train seeds the order of each epoch, so that runs with different seeds train on different orders
+        def order(seed):
+            return [b[0].tobytes() for b in self.dataset.batches(4, shuffle=True, seed=seed)]
+
+        self.assertEqual(order([0, 1]), order([0, 1]))
+        self.assertNotEqual(order([0, 1]), order([1, 1]))
+        self.assertNotEqual(order([0, 1]), order([0, 2]))
+
+    def test_existing_dataset_not_overwritten(self):
+        with self.assertRaises(FileExistsError):
+            ShardedDatasetWriter(self.path, seq_length=10)
+
+    def test_preprocess_writes_dataset(self):
+        sample_path = os.path.join(self.tmp_dir.name, "sample.csv")
+        with open(sample_path, "w") as f:
+            f.writelines(synthetic_paf_lines(30))
+        output_path = os.path.join(self.tmp_dir.name, "preprocessed")
+        preprocess.main(sample_path, output_path, seq_length=40, shard_size=16)
+        dataset = ShardedDataset(output_path)
+        self.assertEqual((len(dataset), dataset.seq_length, len(dataset.shards)), (30, 40, 2))
+
+    def test_preprocess_deterministic_across_workers(self):
+        sample_path = os.path.join(self.tmp_dir.name, "sample.csv")
+        with open(sample_path, "w") as f:
+            f.writelines(synthetic_paf_lines(50))
+
+        def preprocessed(name, workers, seed):
+            output_path = os.path.join(self.tmp_dir.name, name)
+            preprocess.main(sample_path, output_path, seq_length=40, shard_size=16, workers=workers, seed=seed)
+            return ShardedDataset(output_path)[:]
+
+        with patch.object(preprocess, "CHUNK_SIZE", 8):
+            features, labels = preprocessed("serial", workers=1, seed=3)
+            parallel_features, parallel_labels = preprocessed("parallel", workers=3, seed=3)
+            other_seed_features, _ = preprocessed("other_seed", workers=1, seed=4)
+        np.testing.assert_array_equal(parallel_features, features)
+        np.testing.assert_array_equal(parallel_labels, labels)
+        self.assertFalse(np.array_equal(other_seed_features, features))
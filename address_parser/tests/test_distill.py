@@ -0,0 +1,45 @@
+from unittest import TestCase
+
+import torch
+
+from address_parser.bench.synthetic import synthetic_records
+from address_parser.paf import VOCAB, VOCAB_CHAR_TO_IDX, PADDING_CHAR, ADDRESS_FIELD_CLASSES
+from address_parser.rnn.distill import compare, distill, teacher_logits
+from address_parser.rnn.rules import labelled_addresses
+from address_parser.tests import tiny_model
+
+
+class TestDistill(TestCase):
+    def setUp(self) -> None:
+        self.teacher = tiny_model()
+        self.X = torch.randint(0, len(VOCAB) - 1, (4, 30))
+
+    def test_padded_teacher_sees_its_padding(self):
+        full, _ = self.teacher(self.X, self.teacher.init_hidden(4))
+        trimmed = self.X.clone()
+        trimmed[:, 12:] = VOCAB_CHAR_TO_IDX[PADDING_CHAR]
+        expected, _ = self.teacher(trimmed, self.teacher.init_hidden(4))
+        logits = teacher_logits(self.teacher, self.X[:, :12])
+        self.assertEqual(logits.shape, (4 * 12, len(ADDRESS_FIELD_CLASSES)))
+        self.assertTrue(torch.allclose(logits, expected.view(4, 30, -1)[:, :12].reshape(-1, logits.shape[1])))
+        self.assertFalse(torch.allclose(logits, full.view(4, 30, -1)[:, :12].reshape(-1, logits.shape[1])))
+
+    def test_packed_teacher_runs_packed(self):
+        self.teacher.sequence_layout = "packed"
+        lengths = torch.tensor([12, 5, 9, 1])
+        expected, _ = self.teacher(self.X[:, :12], self.teacher.init_hidden(4), lengths)
+        self.assertTrue(torch.allclose(teacher_logits(self.teacher, self.X[:, :12], lengths), expected))
+
+    def test_distil_student(self):
+        student = distill(self.teacher, synthetic_batches_per_epoch=2, epochs=1)
+        self.assertEqual((student.seq_length, student.sequence_layout, student.training), (30, "trimmed", False))
+        self.assertLess(sum(p.numel() for p in student.parameters()),
+                        sum(p.numel() for p in self.teacher.parameters()) * 10)
+        report = compare(self.teacher, student, labelled_addresses(synthetic_records(20), 0), num_latency_examples=5)
+        self.assertEqual(set(report), {"teacher", "student", "agreement"})
+        self.assertEqual(set(report["student"]), {"parameters", "accuracy", "latency_p50_us", "latency_p95_us",
+                                                  "bulk_us_per_address"})
+
+    def test_nothing_to_distil_on(self):
+        with self.assertRaises(ValueError):
+            distill(self.teacher, synthetic_batches_per_epoch=0)
@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+import address_parser
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(address_parser.__file__)))
+# Modules that are needed to encode, decode and write out addresses, or to start up the scripts, and so shouldn't
+# import any of the heavy dependencies until a model is actually loaded or trained
+LIGHT_MODULES = [
+    "address_parser",
+    "address_parser.paf",
+    "address_parser.paf.util",
+    "address_parser.paf.preprocess",
+    "address_parser.paf.sample",
+    "address_parser.paf.index",
+    "address_parser.paf.match",
+    "address_parser.rnn",
+    "address_parser.rnn.util",
+    "address_parser.rnn.output",
+    "address_parser.rnn.cache",
+    "address_parser.rnn.checkpoint",
+    "address_parser.rnn.predict",
+    "address_parser.rnn.rules",
+    "address_parser.rnn.cascade",
+    "address_parser.rnn.columnar",
+    "address_parser.rnn.job",
+    "address_parser.bench.synthetic",
+]
+HEAVY_DEPENDENCIES = ["torch", "pandas", "pyarrow", "onnx", "onnxruntime"]
+# Milliseconds to import all of the light modules, on top of numpy which the encoder needs
+IMPORT_TIME_BUDGET_MS = 100
+# The fastest of a few runs is compared with the budget to even out noise from other processes
+IMPORT_TIME_RUNS = 3
+
+_IMPORT_SCRIPT = """
+import importlib, json, sys, time
+import numpy
+start = time.perf_counter()
+for module in {modules!r}:
+    importlib.import_module(module)
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def _import_in_fresh_interpreter(modules):
+    # Every run needs its own interpreter, otherwise the modules are already imported
+    script = _IMPORT_SCRIPT.format(modules=modules, heavy=HEAVY_DEPENDENCIES)
+    out = subprocess.run([sys.executable, "-c", script], cwd=REPO_ROOT, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout)
+
+
+class TestImports(TestCase):
+    def test_no_heavy_dependencies_on_import(self):
+        for module in LIGHT_MODULES:
+            with self.subTest(module=module):
+                self.assertEqual(_import_in_fresh_interpreter([module])["loaded"], [])
+
+    def test_import_time(self):
+        ms = min(_import_in_fresh_interpreter(LIGHT_MODULES)["ms"] for _ in range(IMPORT_TIME_RUNS))
+        self.assertLess(ms, IMPORT_TIME_BUDGET_MS)
+
+    def test_model_loaded_on_access(self):
+        import address_parser.rnn
+        from address_parser.rnn.model import AddressRNN
+        self.assertIs(address_parser.rnn.AddressRNN, AddressRNN)
+        with self.assertRaises(AttributeError):
+            address_parser.rnn.NotAModel
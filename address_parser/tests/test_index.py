@@ -0,0 +1,85 @@
+import csv
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from address_parser.paf import PAF_SCHEMA
+from address_parser.paf.index import PafIndex, build_index, correct_parsed, postcode_key
+
+
+def _record(postcode, posttown, thoroughfare, locality="", building_number="1"):
+    record = dict((field, "") for field in PAF_SCHEMA)
+    record.update(postcode=postcode, posttown=posttown, thoroughfare_and_descriptor=thoroughfare,
+                  dependent_locality=locality, building_number=building_number)
+    return [record[field] for field in PAF_SCHEMA]
+
+
+class TestPafIndex(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        paf_path = os.path.join(self.tmp_dir.name, "paf.csv")
+        with open(paf_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(PAF_SCHEMA)
+            writer.writerows([
+                _record("EC4A 2DY", "LONDON", "Fleet Street"),
+                _record("EC4A 2DY", "LONDON", "Fleet Street", building_number="2"),
+                _record("EC4A 2DY", "LONDON", "Bouverie Street"),
+                _record("TN22 1AA", "UCKFIELD", "High Street", locality="Fairwarp"),
+                # Quoted field with a comma
+                _record("LS6 3AB", "LEEDS", "St. John's Road, North"),
+            ])
+        self.path = os.path.join(self.tmp_dir.name, "index")
+        self.assertEqual(build_index(paf_path, self.path), 5)
+        self.index = PafIndex(self.path)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_postcode_rows(self):
+        rows = self.index.postcode_rows(["ec4a 2dy", "EC4A2DY", " ls6  3ab", "n1 9ab", "", None, "ec4a 2dyx"])
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(rows[0], rows[1])
+        self.assertTrue((rows[:3] >= 0).all())
+        self.assertTrue((rows[3:] == -1).all())
+        self.assertEqual(postcode_key("Ec4a 2DY"), "ec4a2dy")
+
+    def test_values_and_contains(self):
+        rows = self.index.postcode_rows(["ec4a 2dy", "ls6 3ab", "tn22 1aa", "n1 9ab"])
+        self.assertEqual(self.index.values(rows[0], "thoroughfare_and_descriptor"),
+                         ["bouverie street", "fleet street"])
+        self.assertEqual(self.index.values(rows[1], "thoroughfare_and_descriptor"), ["st. john's road, north"])
+        self.assertEqual(self.index.values(rows[3], "posttown"), [])
+        np.testing.assert_array_equal(
+            self.index.contains(rows, "posttown", ["london", "london", "uckfield", "london"]),
+            [True, False, True, False])
+        np.testing.assert_array_equal(
+            self.index.contains(rows, "dependent_locality", ["", "fairwarp", "fairwarp", "fairwarp"]),
+            [False, False, True, False])
+        np.testing.assert_array_equal(self.index.counts(rows, "thoroughfare_and_descriptor"), [2, 1, 1, 0])
+
+    def test_correct_parsed(self):
+        parsed = [
+            {"thoroughfare_and_descriptor": "fleet street", "postcode": "ec4a 2dy"},
+            {"thoroughfare_and_descriptor": "high st", "posttown": "uckfeld", "postcode": "tn22 1aa"},
+            {"posttown": "london", "postcode": "n1 9ab"},
+            {"building_name": "the gherkin"},
+        ]
+        corrected, outcomes = correct_parsed(parsed, self.index)
+        self.assertEqual(corrected[0]["posttown"], "london")
+        self.assertEqual(outcomes[0], {"postcode": "valid", "posttown": "filled",
+                                       "thoroughfare_and_descriptor": "valid"})
+        self.assertEqual(corrected[1]["posttown"], "uckfield")
+        self.assertEqual(corrected[1]["thoroughfare_and_descriptor"], "high st")
+        self.assertEqual(outcomes[1], {"postcode": "valid", "posttown": "corrected",
+                                       "thoroughfare_and_descriptor": "invalid"})
+        self.assertEqual(corrected[2], parsed[2])
+        self.assertEqual(outcomes[2:], [{"postcode": "unknown_postcode"}] * 2)
+        # Parses aren't changed in place
+        self.assertNotIn("posttown", parsed[0])
+
+    def test_index_not_overwritten(self):
+        with self.assertRaises(FileExistsError):
+            build_index(os.devnull, self.path)
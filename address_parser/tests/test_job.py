@@ -0,0 +1,206 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+from multiprocessing import Pool
+from unittest import TestCase
+
+from address_parser.rnn.job import BulkJob, plan_job, run_job
+from address_parser.rnn.output import open_output_writer
+from address_parser.rnn.predict import _read_addresses, parse_stream
+from address_parser.rnn.util import parse_raw_addresses
+from address_parser.tests import tiny_model
+
+
+def _upper_shard(addresses, output_path):
+    # Stand-in for parsing, so that the job can be checked without a model
+    lines = [address.upper() for address in addresses]
+    with open(output_path, "w") as f:
+        f.writelines(line + "\n" for line in lines)
+    return len(lines)
+
+
+def _run(job_path):
+    return run_job(BulkJob(job_path), _upper_shard)
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+class TestBulkJob(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmp_dir.name, "addresses.txt")
+        self.addresses = [f"{i} fleet street, london ec4a 2dy" for i in range(200)]
+        with open(self.input_path, "w") as f:
+            f.writelines(address + "\n" for address in self.addresses)
+        self.job_path = os.path.join(self.tmp_dir.name, "job")
+        self.job = plan_job(self.input_path, self.job_path, shard_size=1000)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _output(self, job):
+        lines = []
+        for path in job.outputs():
+            with open(path) as f:
+                lines.extend(f.read().splitlines())
+        return lines
+
+    def test_shards_cover_input(self):
+        self.assertGreater(len(self.job), 5)
+        self.assertEqual(self.job.shards[0]["start"], 0)
+        self.assertEqual(self.job.shards[-1]["end"], os.path.getsize(self.input_path))
+        for shard, next_shard in zip(self.job.shards, self.job.shards[1:]):
+            self.assertEqual(shard["end"], next_shard["start"])
+        self.assertEqual([a for i in range(len(self.job)) for a in self.job.addresses(i)], self.addresses)
+
+    def test_run_and_resume(self):
+        calls = []
+
+        def failing_shard(addresses, output_path):
+            calls.append(output_path)
+            if len(calls) == 3:
+                # Partial output of a shard that is killed part way
+                with open(output_path, "w") as f:
+                    f.write("PARTIAL\n")
+                raise KeyboardInterrupt
+            return _upper_shard(addresses, output_path)
+
+        with self.assertRaises(KeyboardInterrupt):
+            run_job(self.job, failing_shard)
+        self.assertEqual(self.job.status(), {"shards": len(self.job), "finished": 2, "claimed": 0,
+                                             "pending": len(self.job) - 2, "records": len(self._output(self.job))})
+        self.assertNotIn("PARTIAL", self._output(self.job))
+
+        # Only the shards that didn't finish are parsed again, and leftover partial output is cleared away
+        self.assertEqual(run_job(plan_job(self.input_path, self.job_path, shard_size=1000), _upper_shard),
+                         len(self.job) - 2)
+        self.assertEqual(self._output(self.job), [a.upper() for a in self.addresses])
+        self.assertEqual(self.job.status()["records"], len(self.addresses))
+        self.assertEqual([f for f in os.listdir(self.job_path) if f.endswith((".tmp", ".lock"))], [])
+        self.assertEqual(run_job(self.job, _upper_shard), 0)
+
+    def test_live_claims_skipped(self):
+        # A claim by a live process on the same host, or recently touched by one on another host, is left alone
+        with open(os.path.join(self.job_path, "shard-00000.lock"), "w") as f:
+            json.dump({"host": socket.gethostname(), "pid": os.getppid()}, f)
+        with open(os.path.join(self.job_path, "shard-00001.lock"), "w") as f:
+            json.dump({"host": "elsewhere", "pid": 1}, f)
+        self.assertEqual(run_job(self.job, _upper_shard), len(self.job) - 2)
+        self.assertEqual(self.job.status()["claimed"], 2)
+        self.assertFalse(self.job.finished(0) or self.job.finished(1))
+
+    def test_stale_claims_taken_over(self):
+        with open(os.path.join(self.job_path, "shard-00000.lock"), "w") as f:
+            json.dump({"host": socket.gethostname(), "pid": _dead_pid()}, f)
+        lock_path = os.path.join(self.job_path, "shard-00001.lock")
+        with open(lock_path, "w") as f:
+            json.dump({"host": "elsewhere", "pid": 1}, f)
+        os.utime(lock_path, (0, 0))
+        self.assertEqual(run_job(self.job, _upper_shard), len(self.job))
+        self.assertEqual(self._output(self.job), [a.upper() for a in self.addresses])
+
+    def test_claim_taken_over_from_live_process(self):
+        # Process a on another host stops touching its lock for longer than the lease but is still parsing
+        a = BulkJob(self.job_path)
+        a._owner = {"host": "elsewhere", "pid": 1}
+        self.assertTrue(a.claim(0))
+        records = _upper_shard(a.addresses(0), a.tmp_output_path(0))
+        os.utime(os.path.join(self.job_path, "shard-00000.lock"), (0, 0))
+        # A third process is still working on the shard too, after an earlier takeover
+        other_tmp_path = a.output_path(0) + ".third-2.tmp"
+        open(other_tmp_path, "w").close()
+        b = BulkJob(self.job_path)
+        self.assertTrue(b.claim(0))
+        self.assertTrue(os.path.exists(other_tmp_path))
+        # Taking the claim over clears away the output of a, so a leaves the shard to b without releasing its claim
+        self.assertFalse(a.finish(0, records, 1.0))
+        self.assertTrue(os.path.exists(os.path.join(self.job_path, "shard-00000.lock")))
+        self.assertFalse(b.finished(0))
+        self.assertEqual(_upper_shard(b.addresses(0), b.tmp_output_path(0)), records)
+        self.assertTrue(b.finish(0, records, 1.0))
+        self.assertEqual(self.job.status(), {"shards": len(self.job), "finished": 1, "claimed": 0,
+                                             "pending": len(self.job) - 1, "records": records})
+
+    def test_lost_output_left_to_other_process(self):
+        self.assertTrue(self.job.claim(0))
+        with open(os.path.join(self.job_path, "shard-00000.lock"), "w") as f:
+            json.dump({"host": "elsewhere", "pid": 1}, f)
+        self.assertFalse(self.job.finish(0, 40, 1.0))
+        self.assertFalse(self.job.finished(0))
+        self.assertEqual(self.job.status()["claimed"], 1)
+
+    def test_processes_share_job(self):
+        with Pool(3) as pool:
+            parsed = pool.map(_run, [self.job_path] * 3)
+        self.assertEqual(sum(parsed), len(self.job))
+        self.assertEqual(self._output(self.job), [a.upper() for a in self.addresses])
+
+    def test_changed_input_or_settings_rejected(self):
+        with self.assertRaises(ValueError):
+            plan_job(self.input_path, self.job_path, shard_size=2000)
+        with open(self.input_path, "a") as f:
+            f.write("1 new road, leeds ls1 1aa\n")
+        with self.assertRaises(ValueError):
+            plan_job(self.input_path, self.job_path, shard_size=1000)
+
+    def test_input_at_another_path(self):
+        # As on another machine that mounts the shared filesystem somewhere else
+        mounted_path = os.path.join(self.tmp_dir.name, "mounted-addresses.txt")
+        os.link(self.input_path, mounted_path)
+        job = plan_job(mounted_path, self.job_path, shard_size=1000)
+        os.remove(self.input_path)
+        self.assertEqual(run_job(job, _upper_shard), len(job))
+        self.assertEqual(self._output(job), [a.upper() for a in self.addresses])
+
+    def test_empty_input(self):
+        empty_path = os.path.join(self.tmp_dir.name, "empty.txt")
+        open(empty_path, "w").close()
+        job = plan_job(empty_path, os.path.join(self.tmp_dir.name, "empty-job"))
+        self.assertEqual(run_job(job, _upper_shard), 1)
+        self.assertEqual(job.status()["records"], 0)
+
+    def test_same_rows_as_without_job(self):
+        # Blank lines, Windows line endings and non-ASCII text, which the input is read with the same as without a job
+        addresses = [f"{i} fleet street, london ec4a 2dy" if i % 7 else "" for i in range(100)]
+        addresses[3] = "3 café royal,\r\nregent street"
+        input_path = os.path.join(self.tmp_dir.name, "blank-lines.txt")
+        with open(input_path, "w", newline="") as f:
+            f.writelines(address + "\n" for address in addresses)
+        model = tiny_model(lstm_layers=1)
+        job = plan_job(input_path, os.path.join(self.tmp_dir.name, "blank-lines-job"), shard_size=500,
+                       output_format="jsonl")
+        self.assertGreater(len(job), 3)
+
+        def parse_shard(addresses, output_path):
+            with open_output_writer(output_path, "jsonl") as writer:
+                return parse_stream(addresses, model, writer, chunk_size=16)
+
+        run_job(job, parse_shard)
+        output_path = os.path.join(self.tmp_dir.name, "blank-lines.jsonl")
+        with open_output_writer(output_path, "jsonl") as writer:
+            records = parse_stream(_read_addresses(input_path), model, writer, chunk_size=16)
+        self.assertEqual(job.status()["records"], records)
+        with open(output_path) as f:
+            self.assertEqual([line for path in job.outputs() for line in open(path)], f.readlines())
+
+    def test_parse_stream_shards(self):
+        model = tiny_model(lstm_layers=1)
+        job = plan_job(self.input_path, os.path.join(self.tmp_dir.name, "jsonl-job"), shard_size=2000,
+                       output_format="jsonl")
+
+        def parse_shard(addresses, output_path):
+            with open_output_writer(output_path, "jsonl") as writer:
+                return parse_stream(addresses, model, writer, chunk_size=16)
+
+        run_job(job, parse_shard)
+        records = [json.loads(line) for path in job.outputs() for line in open(path)]
+        self.assertEqual([r["input_address"] for r in records], self.addresses)
+        expected = parse_raw_addresses(self.addresses, model)
+        self.assertEqual([{k: v for k, v in r.items() if v and k != "input_address"} for r in records], expected)
@@ -0,0 +1,77 @@
+import csv
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from address_parser.paf import PAF_SCHEMA
+from address_parser.paf.match import UdprnMatcher, build_match_index, record_grams
+
+
+def _record(udprn, postcode, thoroughfare, building_number="", building_name="", sub_building_name=""):
+    record = dict((field, "") for field in PAF_SCHEMA)
+    record.update(udprn=str(udprn), postcode=postcode, posttown="LONDON", thoroughfare_and_descriptor=thoroughfare,
+                  building_number=building_number, building_name=building_name, sub_building_name=sub_building_name)
+    return [record[field] for field in PAF_SCHEMA]
+
+
+class TestUdprnMatcher(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        paf_path = os.path.join(self.tmp_dir.name, "paf.csv")
+        with open(paf_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(PAF_SCHEMA)
+            writer.writerows([
+                _record(101, "EC4A 2DY", "Fleet Street", building_number="165"),
+                _record(102, "EC4A 2DY", "Fleet Street", building_number="166"),
+                _record(103, "EC4A 2DY", "Fleet Street", building_number="16"),
+                _record(201, "N1 9AB", "High Road", building_name="Rose Cottage"),
+                _record(202, "N1 9AB", "High Road", building_name="Ivy Cottage"),
+                _record(301, "TN22 1AA", "Church Lane", building_number="2", sub_building_name="Flat 1"),
+                _record(302, "TN22 1AA", "Church Lane", building_number="2", sub_building_name="Flat 2"),
+                # Records without a UDPRN can't be matched to
+                _record("", "TN22 1AA", "Church Lane", building_number="3"),
+            ])
+        self.path = os.path.join(self.tmp_dir.name, "match")
+        self.assertEqual(build_match_index(paf_path, self.path), 7)
+        self.matcher = UdprnMatcher(self.path)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_record_grams_distinct_per_field(self):
+        indptr, grams = record_grams([{"building_number": "12", "building_name": "12"}, {}, {"building_number": "1"}])
+        np.testing.assert_array_equal(indptr, [0, 4, 4, 5])
+        # Trigrams " 12" and "12 " of each field, which differ by the field
+        self.assertEqual(len(set(grams[:4].tolist())), 4)
+
+    def test_exact_match_scores_one(self):
+        matches = self.matcher.match({"building_number": "165", "thoroughfare_and_descriptor": "fleet street",
+                                      "posttown": "london", "postcode": "ec4a 2dy"})
+        self.assertEqual(matches[0], (101, 1.0))
+        # 16 is a closer match for 165 than 166, as it's shorter
+        self.assertEqual([udprn for udprn, _ in matches], [101, 103, 102])
+        self.assertTrue(all(a[1] >= b[1] for a, b in zip(matches, matches[1:])))
+
+    def test_misspelt_and_abbreviated(self):
+        matches = self.matcher.match_many([
+            {"building_name": "rose cotage", "thoroughfare_and_descriptor": "high rd", "postcode": "n19ab"},
+            {"sub_building_name": "flat 2", "building_number": "2", "thoroughfare_and_descriptor": "church ln",
+             "postcode": "TN22 1AA"},
+        ], top_k=1)
+        self.assertEqual([m[0][0] for m in matches], [201, 302])
+        self.assertLess(matches[0][0][1], 1.0)
+
+    def test_unblocked_match_without_postcode(self):
+        matches = self.matcher.match({"building_name": "ivy cottage", "thoroughfare_and_descriptor": "high road"})
+        self.assertEqual(matches[0], (202, 1.0))
+        # An unknown postcode falls back the same way
+        matches = self.matcher.match({"building_name": "ivy cottage", "thoroughfare_and_descriptor": "high road",
+                                      "postcode": "zz9 9zz"})
+        self.assertEqual(matches[0], (202, 1.0))
+
+    def test_no_candidates(self):
+        self.assertEqual(self.matcher.match({"building_name": "xyz"}), [])
+        self.assertEqual(self.matcher.match({}), [])
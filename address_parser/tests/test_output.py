@@ -0,0 +1,45 @@
+import csv
+import json
+import os
+import tempfile
+from collections import defaultdict
+from unittest import TestCase
+
+from address_parser.rnn.output import OUTPUT_FIELDS, open_output_writer
+
+
+class TestOutputWriters(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        record = defaultdict(str, {"input_address": "165 Fleet Street, London", "building_number": "165",
+                                   "thoroughfare_and_descriptor": "fleet street", "posttown": "london"})
+        self.records = [record, {"input_address": ""}]
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_csv_writer(self):
+        path = os.path.join(self.tmp_dir.name, "out.csv")
+        with open_output_writer(path, "csv") as writer:
+            writer.write(self.records[:1])
+            writer.write(self.records[1:])
+        with open(path) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(list(rows[0].keys()), OUTPUT_FIELDS)
+        self.assertEqual(rows[0]["input_address"], "165 Fleet Street, London")
+        self.assertEqual(rows[0]["posttown"], "london")
+        self.assertEqual(rows[1]["posttown"], "")
+
+    def test_jsonl_writer(self):
+        path = os.path.join(self.tmp_dir.name, "out.jsonl")
+        with open_output_writer(path, "jsonl") as writer:
+            writer.write(self.records)
+        with open(path) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]["building_number"], "165")
+        self.assertEqual(rows[1]["postcode"], "")
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            open_output_writer("-", "xml")
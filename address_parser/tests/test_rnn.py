@@ -1,8 +1,19 @@
+import random
+
 import numpy as np
 import torch
 from unittest import TestCase
 
+from address_parser.paf import ADDRESS_FIELD_CLASSES
 from address_parser.rnn import AddressRNN
+from address_parser.bench.synthetic import synthetic_paf_lines
+from address_parser.paf.util import augment_addresses, csv_records_to_dicts, encode_address_str, encode_addresses
+from address_parser.rnn.pool import parse_in_pool
+from address_parser.rnn.quantize import per_field_accuracy, quantize_model
+from address_parser.rnn.util import (
+    parse_raw_address, parse_raw_addresses, address_components_from_pred, accuracy, components_from_pred, predict
+)
+from address_parser.tests import tiny_model
 
 
 class TestRnn(TestCase):
@@ -38,3 +49,128 @@ class TestRnn(TestCase):
         # Full forward pass through the network should produce a score per class (output_dim = 10)
         # per element in the flattened batch (3 * 4 = 12)
         self.assertEqual(out.size(), torch.Size([12, 10]))
+
+    def test_forward_packed_out_dim(self):
+        out, _ = self.model.forward(self.x, self.hidden, lengths=torch.tensor([4, 2, 3]))
+        # Packed sequences are padded back out to the full batch width
+        self.assertEqual(out.size(), torch.Size([12, 10]))
+
+    def test_forward_packed_ignores_padding(self):
+        self.model.eval()
+        out, _ = self.model.forward(self.x, self.hidden, lengths=torch.tensor([4, 2, 3]))
+        trimmed_out, _ = self.model.forward(self.x[1:2, :2], self.model.init_hidden(1))
+        self.assertTrue(torch.allclose(out.view(3, 4, 10)[1, :2], trimmed_out, atol=1e-6))
+
+    def test_cached_hidden_reused_per_batch_size(self):
+        hidden = self.model.cached_hidden(3)
+        self.assertIs(self.model.cached_hidden(3), hidden)
+        self.assertIsNot(self.model.cached_hidden(4), hidden)
+        self.assertEqual(hidden[0].size(), torch.Size([4, 3, 8]))
+
+
+class TestDecode(TestCase):
+    def setUp(self) -> None:
+        self.address = "25 christopher st"
+        self.encoded = np.stack([encode_address_str(self.address, 20)])
+        number, sep, street, pad = (ADDRESS_FIELD_CLASSES[c] for c in
+                                    ["building_number", "separator", "thoroughfare_and_descriptor", "padding"])
+        self.preds = np.array([[number] * 2 + [sep] + [street] * 14 + [pad] * 3])
+
+    def test_components_sliced_from_address(self):
+        parsed = address_components_from_pred(self.encoded, torch.from_numpy(self.preds), [self.address])
+        self.assertEqual(dict(parsed[0]), {"building_number": "25", "thoroughfare_and_descriptor": "christopher st"})
+
+    def test_components_reconstructed_from_encoded(self):
+        parsed = address_components_from_pred(self.encoded, self.preds)
+        self.assertEqual(dict(parsed[0]), {"building_number": "25", "thoroughfare_and_descriptor": "christopher st"})
+
+    def test_predictions_past_address_end_ignored(self):
+        # Predictions for padding positions that aren't padding, and repeated classes, are handled
+        preds = self.preds.copy()
+        preds[0, 17:] = ADDRESS_FIELD_CLASSES["postcode"]
+        preds[0, 5] = ADDRESS_FIELD_CLASSES["building_number"]
+        parsed = address_components_from_pred(self.encoded, preds, [self.address])
+        self.assertEqual(dict(parsed[0]), {"building_number": "25r", "thoroughfare_and_descriptor": "chistopher st"})
+
+    def test_component_confidence_is_least_confident_character(self):
+        confidence = np.full(self.preds.shape, 0.75, dtype=np.float32)
+        confidence[0, 1] = 0.5
+        # Separators and predictions past the end of the address don't count
+        confidence[0, 2] = confidence[0, 18] = 0.1
+        parsed, confidences = components_from_pred(self.preds, self.address, np.array([0, len(self.address)]),
+                                                   confidence)
+        self.assertEqual(dict(parsed[0]), {"building_number": "25", "thoroughfare_and_descriptor": "christopher st"})
+        self.assertEqual(confidences[0], {"building_number": 0.5, "thoroughfare_and_descriptor": 0.75})
+
+
+class TestParse(TestCase):
+    def setUp(self) -> None:
+        self.model = tiny_model()
+        self.addresses = [
+            "25 Christopher street, moorgate, london, eC2a 2bs, uk",
+            "165 Fleet Street, London EC4A 2DY",
+            "The Gherkin, London EC3A 8BF",
+            "",
+            "1 a road, somewhere, ab1 2cd"
+        ]
+
+    def test_accuracy(self):
+        out = torch.tensor([[0.9, 0.1], [0.2, 0.8], [0.6, 0.4], [0.3, 0.7]])
+        self.assertAlmostEqual(accuracy(out, torch.tensor([0, 1, 1, 1])), 0.75)
+
+    def test_parse_raw_addresses_matches_single_parse_in_input_order(self):
+        expected = [parse_raw_address(address, self.model) for address in self.addresses]
+        self.assertEqual(parse_raw_addresses(self.addresses, self.model, batch_size=2), expected)
+
+    def test_parse_raw_addresses_packed_independent_of_batching(self):
+        # Packing is exact per address so results don't depend on which addresses are batched together
+        self.assertEqual(parse_raw_addresses(self.addresses, self.model, batch_size=2, dynamic_length=True, packed=True),
+                         [parse_raw_addresses([address], self.model, dynamic_length=True, packed=True)[0]
+                          for address in self.addresses])
+
+    def test_parse_raw_addresses_with_confidence(self):
+        for dynamic_length in [False, True]:
+            with self.subTest(dynamic_length=dynamic_length):
+                parsed = parse_raw_addresses(self.addresses, self.model, batch_size=2, dynamic_length=dynamic_length,
+                                             with_confidence=True)
+                self.assertEqual([components for components, _ in parsed],
+                                 parse_raw_addresses(self.addresses, self.model, batch_size=2,
+                                                     dynamic_length=dynamic_length))
+                for components, confidences in parsed:
+                    self.assertEqual(set(confidences), set(components))
+                    self.assertTrue(all(0 < c <= 1 for c in confidences.values()))
+        self.assertEqual(parse_raw_address(self.addresses[3], self.model, with_confidence=True), ({}, {}))
+
+    def test_parse_raw_addresses_accepts_iterators(self):
+        self.assertEqual(len(parse_raw_addresses(iter(self.addresses), self.model, batch_size=3)), 5)
+
+    def test_predict_after_parse(self):
+        # The hidden state cached by parsing under inference mode can still be used by calls that autograd tracks
+        parsed = parse_raw_addresses(self.addresses, self.model, dynamic_length=False)
+        encoded = torch.from_numpy(encode_addresses(self.addresses, self.model.seq_length).encoded)
+        preds = predict(encoded, self.model)
+        self.assertEqual(parse_raw_addresses(self.addresses, self.model, dynamic_length=False), parsed)
+        self.assertEqual(tuple(preds.shape), (len(self.addresses), self.model.seq_length))
+
+    def test_parse_in_pool_preserves_order(self):
+        batches = [self.addresses[i:i + 2] for i in range(0, len(self.addresses), 2)] * 3
+        results = list(parse_in_pool(iter(batches), self.model, workers=2, threads_per_worker=1))
+        self.assertEqual([batch for batch, _ in results], batches)
+        self.assertEqual([parsed for _, parsed in results], [parse_raw_addresses(b, self.model) for b in batches])
+
+    def test_quantized_model_parses(self):
+        quantized = quantize_model(self.model)
+        self.assertIsInstance(self.model._fc, torch.nn.Linear)
+        self.assertIsNot(quantized, self.model)
+        self.assertEqual(len(parse_raw_addresses(self.addresses, quantized)), len(self.addresses))
+
+    def test_per_field_accuracy_runs_trimmed_models_trimmed(self):
+        self.model.sequence_layout = "trimmed"
+        features, labels = augment_addresses(csv_records_to_dicts(synthetic_paf_lines(20)), self.model.seq_length,
+                                             random.Random(0))
+        lengths = (labels != ADDRESS_FIELD_CLASSES["padding"]).sum(axis=1)
+        # Each address run on its own, as wide as it is
+        correct = sum((predict(torch.from_numpy(x[None, :n]), self.model).numpy()[0] == y[:n]).sum()
+                      for x, y, n in zip(features, labels, lengths))
+        self.assertAlmostEqual(per_field_accuracy(self.model, features, labels, batch_size=1)["all"],
+                               correct / lengths.sum())
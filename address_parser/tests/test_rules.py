@@ -0,0 +1,50 @@
+from unittest import TestCase
+
+from address_parser.rnn.rules import RuleParser
+from address_parser.rnn.util import parse_raw_addresses
+from address_parser.tests import tiny_model
+
+
+class TestRules(TestCase):
+    def setUp(self) -> None:
+        self.rules = RuleParser(posttowns=["London"])
+
+    def test_trivial_addresses(self):
+        self.assertEqual(self.rules.parse("165 Fleet Street, London EC4A 2DY"), {
+            "building_number": "165", "thoroughfare_and_descriptor": "fleet street", "posttown": "london",
+            "postcode": "ec4a 2dy"
+        })
+        self.assertEqual(self.rules.parse("25 Christopher st., london, eC2a2bs, u.k."), {
+            "building_number": "25", "thoroughfare_and_descriptor": "christopher st.", "posttown": "london",
+            "postcode": "ec2a2bs", "country": "u.k."
+        })
+        self.assertEqual(self.rules.parse("12,high road,n1 9ab"), {
+            "building_number": "12", "thoroughfare_and_descriptor": "high road", "postcode": "n1 9ab"
+        })
+
+    def test_ambiguous_addresses_fall_through(self):
+        for address in [
+            "The Gherkin, London EC3A 8BF",
+            "25 Christopher street, moorgate, london, ec2a 2bs",
+            # Could be a dependent locality
+            "25 Christopher street, moorgate, ec2a 2bs",
+            "165 fleet street london ec4a 2dy",
+            "flat 2, 165 fleet street, london, ec4a 2dy",
+            "165 fleet street, london",
+            # Numbers with a suffix are building names in PAF, which the model labels them as
+            "12a high street, london, sw1a 1aa",
+            "12a,high road,n1 9ab",
+        ]:
+            with self.subTest(address=address):
+                self.assertIsNone(self.rules.parse(address))
+        self.assertEqual((self.rules.addresses, self.rules.absorbed), (8, 0))
+
+    def test_parse_raw_addresses_with_rules(self):
+        model = tiny_model(seq_length=40)
+        addresses = ["The Gherkin, London EC3A 8BF", "165 Fleet Street, London EC4A 2DY", "1 a road", ""]
+        without_rules = parse_raw_addresses(addresses, model, batch_size=2)
+        parsed = parse_raw_addresses(addresses, model, batch_size=2, rules=self.rules)
+        self.assertEqual(parsed[1], self.rules.parse(addresses[1]))
+        self.assertEqual([parsed[i] for i in [0, 2, 3]], [without_rules[i] for i in [0, 2, 3]])
+        self.assertEqual((self.rules.addresses, self.rules.absorbed), (5, 2))
+        self.assertEqual(self.rules.absorption_rate, 0.4)
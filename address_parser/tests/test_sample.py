@@ -0,0 +1,61 @@
+import csv
+import os
+import tempfile
+from collections import Counter
+from unittest import TestCase
+
+from address_parser.bench.synthetic import synthetic_paf_lines
+from address_parser.paf import PAF_SCHEMA
+from address_parser.paf.sample import byte_ranges, postcode_area, sample_paf, write_sample
+
+
+class TestSample(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "paf.csv")
+        self.lines = [line.strip() for line in synthetic_paf_lines(3000, seed=0)]
+        with open(self.path, "w", encoding="windows-1252") as f:
+            f.writelines(line + "\n" for line in self.lines)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_byte_ranges_split_on_lines(self):
+        ranges = byte_ranges(self.path, 7)
+        self.assertEqual(len(ranges), 7)
+        self.assertEqual((ranges[0][0], ranges[-1][1]), (0, os.path.getsize(self.path)))
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[start - 1:start], b"\n")
+
+    def test_bernoulli_deterministic_across_workers(self):
+        sample = sample_paf(self.path, "bernoulli", proportion=0.1, workers=1, seed=1)
+        self.assertEqual(sample_paf(self.path, "bernoulli", proportion=0.1, workers=4, seed=1), sample)
+        self.assertNotEqual(sample_paf(self.path, "bernoulli", proportion=0.1, workers=1, seed=2), sample)
+        self.assertTrue(200 < len(sample) < 400)
+        self.assertTrue(set(sample) <= set(self.lines))
+        # Shuffled rather than in file order
+        self.assertNotEqual(sample, sorted(sample, key=self.lines.index))
+
+    def test_reservoir_exact_size(self):
+        sample = sample_paf(self.path, "reservoir", size=500, workers=3, seed=1)
+        self.assertEqual(len(sample), 500)
+        self.assertEqual(len(set(sample)), 500)
+        self.assertEqual(sample_paf(self.path, "reservoir", size=500, workers=1, seed=1), sample)
+        self.assertEqual(len(sample_paf(self.path, "reservoir", size=5000, workers=2)), len(self.lines))
+
+    def test_reservoir_stratified_by_postcode_area(self):
+        sample = sample_paf(self.path, "reservoir", size=20, stratify=True, workers=2, seed=1)
+        area_counts = Counter(postcode_area(line.encode()) for line in self.lines)
+        sample_counts = Counter(postcode_area(line.encode()) for line in sample)
+        self.assertEqual(sample_counts, Counter(dict((area, min(20, n)) for area, n in area_counts.items())))
+
+    def test_write_sample(self):
+        output_path = os.path.join(self.tmp_dir.name, "sample.csv")
+        write_sample(self.lines[:10], output_path)
+        with open(output_path, "r", encoding="utf-8") as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], PAF_SCHEMA)
+        self.assertEqual([",".join(row) for row in rows[1:]], self.lines[:10])
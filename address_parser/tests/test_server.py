@@ -0,0 +1,89 @@
+import asyncio
+import json
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from address_parser.rnn.server import MicroBatcher, start_server
+from address_parser.rnn.util import parse_raw_addresses
+from address_parser.tests import tiny_model
+
+
+async def _request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode()
+        if line == "\r\n":
+            break
+        name, _, value = line.partition(":")
+        headers[name.lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers["content-length"])))
+
+
+class TestServer(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.model = tiny_model()
+        self.addresses = ["165 Fleet Street, London EC4A 2DY", "The Gherkin, London EC3A 8BF", "", "1 a road"]
+        self.expected = [dict(c) for c in parse_raw_addresses(self.addresses, self.model)]
+        # A long wait so that concurrent requests always end up in the same batch
+        self.batcher = MicroBatcher(self.model, max_batch_size=3, max_wait_ms=200)
+        await self.batcher.start()
+        self.server = await start_server(self.batcher, port=0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def _call(self, method, path, payload=None):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        try:
+            return await _request(reader, writer, method, path, payload)
+        finally:
+            writer.close()
+
+    async def test_concurrent_requests_batched(self):
+        responses = await asyncio.gather(*(self._call("POST", "/parse", {"address": a}) for a in self.addresses))
+        self.assertEqual([status for status, _ in responses], [200] * 4)
+        self.assertEqual([r["components"] for _, r in responses], self.expected)
+
+        status, metrics = await self._call("GET", "/metrics")
+        self.assertEqual(status, 200)
+        self.assertEqual(metrics["requests"], 4)
+        # Four addresses with a maximum batch size of three
+        self.assertEqual(metrics["batches"], 2)
+        self.assertEqual(metrics["batch_size_histogram"]["count"], 2)
+        self.assertEqual(metrics["batch_size_histogram"]["mean"], 2)
+        self.assertEqual(metrics["queue_depth"], 0)
+
+    async def test_many_addresses_keep_alive(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        try:
+            status, response = await _request(reader, writer, "POST", "/parse", {"addresses": self.addresses})
+            self.assertEqual((status, response["components"]), (200, self.expected))
+            self.assertEqual(await _request(reader, writer, "GET", "/health"), (200, {"status": "ok"}))
+        finally:
+            writer.close()
+
+    async def test_bad_requests(self):
+        self.assertEqual((await self._call("POST", "/parse", {"address": 1}))[0], 400)
+        self.assertEqual((await self._call("GET", "/parse"))[0], 405)
+        self.assertEqual((await self._call("GET", "/nowhere"))[0], 404)
+
+    async def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "parser.sock")
+            server = await start_server(self.batcher, unix_socket=path)
+            reader, writer = await asyncio.open_unix_connection(path)
+            try:
+                status, response = await _request(reader, writer, "POST", "/parse", {"address": self.addresses[0]})
+                self.assertEqual((status, response["components"]), (200, self.expected[0]))
+            finally:
+                writer.close()
+                server.close()
+                await server.wait_closed()
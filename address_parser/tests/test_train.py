@@ -0,0 +1,51 @@
+import random
+from collections import Counter
+from unittest import TestCase
+
+import numpy as np
+from torch import nn, optim
+
+from address_parser.bench.synthetic import synthetic_records
+from address_parser.paf import VOCAB, PADDING_CHAR
+from address_parser.paf.util import augment_addresses
+from address_parser.rnn.train import bucketed_batches, train_step, PADDING_CLASS
+from address_parser.tests import tiny_model
+
+
+def _examples(features, labels):
+    lengths = (labels != PADDING_CLASS).sum(axis=1)
+    return Counter((f[:n].tobytes(), l[:n].tobytes()) for f, l, n in zip(features, labels, lengths))
+
+
+class TestTrain(TestCase):
+    def setUp(self) -> None:
+        self.features, self.labels = augment_addresses(synthetic_records(100), 50, random.Random(0))
+        self.batches = [(self.features[i:i + 16], self.labels[i:i + 16]) for i in range(0, 100, 16)]
+
+    def test_bucketed_batches(self):
+        batches = list(bucketed_batches(self.batches, np.random.default_rng(0), window_batches=3))
+        self.assertEqual(sorted(len(f) for f, _, _ in batches), [4, 16, 16, 16, 16, 16, 16])
+        for features, labels, lengths in batches:
+            # Trimmed to the longest address in the batch
+            self.assertEqual(features.shape[1], lengths.max())
+            np.testing.assert_array_equal((labels != PADDING_CLASS).sum(axis=1), lengths)
+        self.assertEqual(sum((_examples(f, l) for f, l, _ in batches), Counter()),
+                         _examples(self.features, self.labels))
+
+    def test_train_step_masks_padding(self):
+        # In eval mode, so no dropout, and no updates, so every step computes the loss of the same model
+        model = tiny_model(seq_length=50)
+        optimizer = optim.SGD(model.parameters(), lr=0.0)
+        criterion = nn.CrossEntropyLoss()
+        features, labels, lengths = next(bucketed_batches(self.batches, np.random.default_rng(0)))
+
+        def loss(extra_padding, with_lengths=True, packed=False):
+            padded_features = np.pad(features, ((0, 0), (0, extra_padding)),
+                                     constant_values=VOCAB.index(PADDING_CHAR))
+            padded_labels = np.pad(labels, ((0, 0), (0, extra_padding)), constant_values=PADDING_CLASS)
+            return train_step(model, optimizer, criterion, padded_features, padded_labels,
+                              lengths if with_lengths else None, packed)[0].item()
+
+        # Packed sequences never see the padding, and it's masked out of the loss
+        self.assertAlmostEqual(loss(0, packed=True), loss(10, packed=True), places=5)
+        self.assertNotAlmostEqual(loss(10), loss(10, with_lengths=False), places=3)
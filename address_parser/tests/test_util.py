@@ -1,9 +1,14 @@
+import random
+
 import numpy as np
 from unittest import TestCase
 
-from address_parser.paf import AddressField
+from address_parser.bench.synthetic import synthetic_paf_lines
+from address_parser.paf import AddressField, ADDRESS_LAYOUTS
+from address_parser.paf.preprocess import _address_char_level_labels
 from address_parser.paf.util import csv_records_to_dicts, split_component_chars, encode_address_and_labels, \
-    remove_empty_fields, chunks_from_iter
+    remove_empty_fields, chunks_from_iter, encode_addresses, encode_address_str, normalise_address_str, \
+    shuffle_components, augment_addresses
 
 
 class TestUtils(TestCase):
@@ -125,3 +130,58 @@ class TestUtils(TestCase):
             np.array_equal(y,
                            np.array([0, 0, 10, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 11, 11, 11]))
         )
+
+    def test_encode_addresses(self):
+        addresses = ["25 Christopher ST", "Caf\u00e9 \x01 road", "", "a" * 30]
+        encoded, text, offsets = encode_addresses(addresses, seq_length=20)
+        self.assertEqual(encoded.dtype, np.uint8)
+        self.assertEqual(encoded.shape, (4, 20))
+        self.assertTrue(
+            np.array_equal(encoded[0],
+                           np.array([2, 5, 68, 12, 17, 27, 18, 28, 29, 24, 25, 17, 14, 27, 68, 28, 29, 74, 74, 74]))
+        )
+        # Empty addresses are all padding and long ones are truncated
+        self.assertTrue(np.array_equal(encoded[2], np.full(20, 74)))
+        self.assertTrue(np.array_equal(encoded[3], np.full(20, 10)))
+        # Offsets index each normalised address in the text, which isn't truncated
+        self.assertEqual([text[offsets[i]:offsets[i + 1]] for i in range(4)],
+                         [normalise_address_str(a) for a in addresses])
+        self.assertEqual(text[offsets[1]:offsets[2]], "caf  road")
+
+    def test_encode_address_str(self):
+        self.assertTrue(np.array_equal(encode_address_str("25 Ab", 7), np.array([2, 5, 68, 10, 11, 74, 74])))
+
+    def test_shuffle_components_follows_a_layout(self):
+        address = {"building_number": "25", "building_name": "", "sub_building_name": "flat 2",
+                   "thoroughfare_and_descriptor": "christopher street", "dependent_locality": "",
+                   "posttown": "london", "postcode": "ec2a 2bs"}
+        rng = random.Random(0)
+        for _ in range(50):
+            parts = shuffle_components(address, rng)
+            fields = [label for _, label in parts[::2]]
+            self.assertTrue(any(fields == [f for f in layout if f in fields] for layout in ADDRESS_LAYOUTS))
+            self.assertNotIn("building_name", fields)
+            self.assertEqual(len(set(sep for sep, _ in parts[1::2])), 1)
+            self.assertTrue(all(label == AddressField.SEPARATOR.value for _, label in parts[1::2]))
+
+    def test_shuffle_components_keeps_streets_without_variants(self):
+        address = {"building_number": "3", "building_name": "", "sub_building_name": "",
+                   "thoroughfare_and_descriptor": "church lane", "dependent_locality": "",
+                   "posttown": "leeds", "postcode": "ls1 4ab"}
+        rng = random.Random(0)
+        for _ in range(20):
+            self.assertIn(("church lane", "thoroughfare_and_descriptor"), shuffle_components(address, rng))
+
+    def test_augment_addresses_matches_single_addresses(self):
+        records = csv_records_to_dicts(synthetic_paf_lines(300))
+        features, labels = augment_addresses(records, 40, random.Random(1))
+        rng = random.Random(1)
+        expected = [_address_char_level_labels(record, 40, rng) for record in records]
+        self.assertEqual((features.dtype, labels.dtype), (np.uint8, np.uint8))
+        np.testing.assert_array_equal(features, np.stack([x for x, _ in expected]))
+        np.testing.assert_array_equal(labels, np.stack([y for _, y in expected]))
+
+    def test_augment_addresses_rejects_chars_outside_vocab(self):
+        record = {"building_number": "1", "thoroughfare_and_descriptor": "caf\u00e9 road", "postcode": "n1 1aa"}
+        with self.assertRaises(KeyError):
+            augment_addresses([record], 40, random.Random(0))